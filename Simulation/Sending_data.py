@@ -1,9 +1,19 @@
 import paho.mqtt.client as mqtt
-from personal_arguments import DEV_CRT, DEV_KEY, AWS_ENDPOINT, CA_CERT, CLIENT_ID
 import ssl
 import time
-import json
 import random
+import argparse
+import multiprocessing
+import queue
+import json
+import os
+from functools import partial
+from payloads import (encode_reading, encode_batch, encode_binary, plant_topic, BINARY_MAX_RECORDS,
+                      DATA_TOPIC, AGGREGATE_TOPIC)
+from commands import CommandExecutor
+from metrics import Registry, SampledLog, ProfileSnapshots, export
+from publisher import Publisher, Sink, POLICIES
+from plant_model import PlantModel, ACTUATORS, PUMP, HEATER, COOLER, HUMIDIFIER
 
 
 def generate_sensor_ids(number_of_sensors):
@@ -12,35 +22,45 @@ def generate_sensor_ids(number_of_sensors):
     return plant_ids
 
 
-number_of_sensors = 100
-plant_ids = generate_sensor_ids(number_of_sensors)
-print("Sensor IDs:", plant_ids)
-
-# MQTT topic to publish the temperature readings
-MQTT_TOPIC = "sensor/data"
+# MQTT topic to publish the temperature readings, plant_topic(plant_id) for a single plant's
+MQTT_TOPIC = DATA_TOPIC
+# Low-rate summary of the fleet, next to the per-plant topics
+MQTT_TOPIC_AGGREGATE = AGGREGATE_TOPIC
 MQTT_TOPIC_COMMAND = "sensor/command"
-# Define sensor ranges
+# Ranges of the made-up readings of make_readings, the simulator itself runs a PlantModel
 temperature_range = (23, 24)  # Celsius
 humidity_range = (60, 61)  # Percentage
 water_level_range = (33000, 36000)  # Percentage
 
+# Seconds between two rate reports of the load generator
+REPORT_INTERVAL = 5
+# Seconds between two aggregate messages of a worker
+AGGREGATE_INTERVAL = 5
+# Seconds between two steps of a worker's plant model
+TICK = 1.0
+
+# Command lines printed per second at most, the rest are counted
+command_log = SampledLog(interval=1.0, burst=5)
 
-# Functions to be called based on the received command
+
+# Functions to be called based on the received command, the model runs the actuator
 def turn_pump_on():
-    print("Turning the pump on.")
-    time.sleep(5)
+    command_log.log("Turning the pump on.")
 
 
 def low_temp():
-    print("Temperature is low.")
+    command_log.log("Temperature is low, turning the heater on.")
 
 
 def high_temp():
-    print("Temperature is high.")
+    command_log.log("Temperature is high, turning the cooler on.")
 
 
 def change_humidity():
-    print("Changing humidity levels.")
+    command_log.log("Changing humidity levels.")
+
+
+COMMAND_FUNCTIONS = {PUMP: turn_pump_on, HEATER: low_temp, COOLER: high_temp, HUMIDIFIER: change_humidity}
 
 
 # Callback when connecting to the MQTT server
@@ -49,78 +69,386 @@ def on_connect(client, userdata, flags, rc, arg):
     client.subscribe(MQTT_TOPIC_COMMAND)
 
 
-# Callback when a message is received from the server
+def run_command(model, positions, plant_id, message):
+    # Runs on a command worker thread. The model switches the actuator on at
+    # its next step and runs it for a while, a command without a plant id
+    # is for every plant of the shard
+    if plant_id:
+        command_log.log("Command %s for %s", message, plant_id)
+    if message not in ACTUATORS:
+        command_log.log("Received unknown command: %s", message)
+        return
+    COMMAND_FUNCTIONS[message]()
+    model.command(positions[plant_id] if plant_id else None, message)
+
+
+# Callback when a message is received from the server, userdata is the CommandExecutor.
+# It runs on the network thread and must never block: commands are only queued here.
 def on_message(client, userdata, msg):
+    received = time.monotonic()
     message = msg.payload.decode()
     if message.isdigit():
-        message = int(message)
-        if message == 1:
-            turn_pump_on()
-            time.sleep(5)
-        elif message == 21:
-            low_temp()
-            time.sleep(5)
-        elif message == 22:
-            high_temp()
-            time.sleep(5)
-        elif message == 3:
-            change_humidity()
-            time.sleep(5)
-        else:
-            print(f"Received unknown command: {message}")
-    else:
-        print(f"Received non-numeric message: {message}")
-
-
-# Initialize MQTT client for AWS
-aws_mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-aws_mqtt_client.tls_set(ca_certs=CA_CERT,
-                        certfile=DEV_CRT,
-                        keyfile=DEV_KEY,
-                        cert_reqs=ssl.CERT_REQUIRED,
-                        tls_version=ssl.PROTOCOL_TLSv1_2,
-                        ciphers=None)
-aws_mqtt_client.on_connect = on_connect
-aws_mqtt_client.on_message = on_message
-
-aws_mqtt_client.connect(AWS_ENDPOINT, 8883, 60)
-
-# Initialize MQTT client for mqtt-dashboard.com
-dashboard_mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-mqtt_server = 'mqtt-dashboard.com'
-port = 1883  # Update with the port number provided by mqtt-dashboard.com if different
-dashboard_mqtt_client.connect(mqtt_server, port, 60)
-
-# Start the loop for both clients
-aws_mqtt_client.loop_start()
-dashboard_mqtt_client.loop_start()
-
-try:
-    while True:
-        for plant_id in plant_ids:
-            sensor_data = json.dumps({
-                "plant_id": plant_id,
-                "temperature": random.uniform(*temperature_range),
-                "humidity": random.uniform(*humidity_range),
-                "water_level": random.uniform(*water_level_range),
-                "time": time.ctime()
-            })
-            # Publish to AWS IoT Core
-            aws_mqtt_client.publish(MQTT_TOPIC, sensor_data)
-            # Publish to mqtt-dashboard.com
-            dashboard_mqtt_client.publish(MQTT_TOPIC, sensor_data)
-
-            print(f"Published to AWS and mqtt-dashboard.com: {sensor_data}")
-
-        # Wait before publishing the next set of readings
-        time.sleep(2)
-except KeyboardInterrupt:
-    print("Interrupted by user, stopping...")
-finally:
-    # Stop the loop and disconnect cleanly from both clients
-    aws_mqtt_client.loop_stop()
-    aws_mqtt_client.disconnect()
-    dashboard_mqtt_client.loop_stop()
-    dashboard_mqtt_client.disconnect()
-
-print("Finished publishing sensor readings.")
+        userdata.submit(None, [int(message)], received)
+        return
+    # The lambda sends every command for a plant in one JSON message
+    try:
+        command = json.loads(message)
+        commands = [int(c) for c in command["commands"]]
+    except (ValueError, KeyError, TypeError):
+        command_log.log("Received non-numeric message: %s", message)
+        return
+    userdata.submit(command.get("plant_id"), commands, received)
+
+
+def create_aws_client(executor=None):
+    # Initialize MQTT client for AWS, the one with the executor receives the commands
+    from personal_arguments import DEV_CRT, DEV_KEY, AWS_ENDPOINT, CA_CERT
+    aws_mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, userdata=executor)
+    aws_mqtt_client.tls_set(ca_certs=CA_CERT,
+                            certfile=DEV_CRT,
+                            keyfile=DEV_KEY,
+                            cert_reqs=ssl.CERT_REQUIRED,
+                            tls_version=ssl.PROTOCOL_TLSv1_2,
+                            ciphers=None)
+    if executor is not None:
+        aws_mqtt_client.on_connect = on_connect
+        aws_mqtt_client.on_message = on_message
+
+    aws_mqtt_client.connect(AWS_ENDPOINT, 8883, 60)
+    return aws_mqtt_client
+
+
+def create_local_client(host, port, executor=None):
+    # Initialize MQTT client for a local broker standing in for AWS IoT Core
+    local_mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, userdata=executor)
+    if executor is not None:
+        local_mqtt_client.on_connect = on_connect
+        local_mqtt_client.on_message = on_message
+    local_mqtt_client.connect(host, port, 60)
+    return local_mqtt_client
+
+
+def create_dashboard_client():
+    # Initialize MQTT client for mqtt-dashboard.com
+    dashboard_mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    mqtt_server = 'mqtt-dashboard.com'
+    port = 1883  # Update with the port number provided by mqtt-dashboard.com if different
+    dashboard_mqtt_client.connect(mqtt_server, port, 60)
+    return dashboard_mqtt_client
+
+
+def started(client):
+    # Start the network loop of a client
+    client.loop_start()
+    return client
+
+
+def create_publisher(args, executor):
+    """Create the publisher of a worker: one sink per broker, each with its own queue and connections.
+
+    The first connection to AWS IoT Core (or the local broker) also receives
+    the commands. The public dashboard is best effort: it drops messages
+    instead of slowing the worker down.
+    """
+    executors = iter([executor])
+
+    def connect_main():
+        if args.broker == 'local':
+            return started(create_local_client(args.host, args.port, next(executors, None)))
+        return started(create_aws_client(next(executors, None)))
+
+    sinks = [Sink(args.broker, connect_main, args.connections, args.queue_size, args.policy, args.qos,
+                  args.max_inflight)]
+    if args.dashboard:
+        sinks.append(Sink('dashboard', lambda: started(create_dashboard_client()), 1, args.queue_size,
+                          args.dashboard_policy, 0, args.max_inflight))
+    return Publisher(sinks)
+
+
+def make_readings(plant_ids):
+    """Make up independent readings of a group of plants: temperatures, humidities, water levels and their ts.
+
+    Without the plant model, for load tests that only need messages.
+    """
+    temperatures = [random.uniform(*temperature_range) for _ in plant_ids]
+    humidities = [random.uniform(*humidity_range) for _ in plant_ids]
+    water_levels = [random.uniform(*water_level_range) for _ in plant_ids]
+    return temperatures, humidities, water_levels, time.time_ns()
+
+
+def model_readings(model, index=slice(None)):
+    """Current readings of the plants of a PlantModel at index, in the form of make_readings."""
+    return (*[values.tolist() for values in model.readings(index)], time.time_ns())
+
+
+def encode_message(plant_ids, temperatures, humidities, water_levels, ts, batch_size, wire_format='json',
+                   seq=None):
+    """Encode the readings of a group of plants as one message."""
+    if wire_format == 'binary':
+        return encode_binary(plant_ids, temperatures, humidities, water_levels, ts)
+    if batch_size > 0:
+        return encode_batch(plant_ids, temperatures, humidities, water_levels, time.ctime(), ts, seq)
+    return encode_reading(plant_ids[0], temperatures[0], humidities[0], water_levels[0], time.ctime(), ts, seq)
+
+
+def make_message(plant_ids, batch_size, wire_format='json', seq=None):
+    """Make up the readings of a group of plants and encode them as one message.
+
+    seq is the message sequence number, sent in JSON messages only: the
+    binary format has no room for it, its send timestamp identifies a message.
+    """
+    return encode_message(plant_ids, *make_readings(plant_ids), batch_size, wire_format, seq)
+
+
+def plant_messages(plant_ids, temperatures, humidities, water_levels, ts, wire_format='json', seq=0):
+    """Yield the topic and message of every plant of a group, one reading each."""
+    for i, plant_id in enumerate(plant_ids):
+        yield plant_topic(plant_id), encode_message(
+            [plant_id], [temperatures[i]], [humidities[i]], [water_levels[i]], ts, 0, wire_format, seq + i)
+
+
+def aggregate_messages(plant_ids, temperatures, humidities, water_levels, ts, wire_format='json'):
+    """Encode the readings of every plant of a shard for the aggregate topic, in as few messages as fit."""
+    size = BINARY_MAX_RECORDS if wire_format == 'binary' else len(plant_ids) or 1
+    for start in range(0, len(plant_ids), size):
+        end = start + size
+        yield encode_message(plant_ids[start:end], temperatures[start:end], humidities[start:end],
+                             water_levels[start:end], ts, size, wire_format)
+
+
+def publisher_worker(worker_id, shard, rate, args, stats_queue, stop_event):
+    """Publish the readings of one shard of plants at a steady rate.
+
+    Messages are spread evenly over time: message n is due at start + n *
+    interval. A worker that falls more than one interval behind skips the
+    missed slots instead of bursting to catch up, and counts them as late.
+    The readings come from a PlantModel of the shard, stepped every --tick
+    seconds, and the commands for its plants run on the worker's
+    CommandExecutor, which switches the model's actuators on.
+    With per-plant topics every reading is also sent on its plant's topic,
+    and the state of every plant of the shard on the aggregate topic every
+    --aggregate-interval seconds.
+    The worker's metrics are served on --metrics-port plus its id and written
+    to --metrics-file with its id appended to the name.
+    """
+    model = PlantModel(len(shard), None if args.seed is None else args.seed + worker_id)
+    positions = {plant_id: i for i, plant_id in enumerate(shard)}
+    executor = CommandExecutor(partial(run_command, model, positions), args.command_workers, shard)
+    publisher = create_publisher(args, executor)
+    metrics = Registry()
+    messages_sent = metrics.counter('simulator_messages_sent', "Sensor messages handed to the publisher")
+    readings_sent = metrics.counter('simulator_readings_sent', "Readings published")
+    late_slots = metrics.counter('simulator_late_slots', "Send slots skipped because the worker fell behind")
+    publish_seconds = metrics.histogram('simulator_publish_seconds',
+                                        "Time to make up a message and queue it for every broker")
+    step_seconds = metrics.histogram('simulator_step_seconds', "Time to advance the plant model of the shard")
+    publisher.register(metrics)
+    metrics.gauge('simulator_commands_received', "Commands received", fn=lambda: executor.received)
+    metrics.gauge('simulator_commands_executed', "Commands run", fn=lambda: executor.executed)
+    metrics.gauge('simulator_commands_applied', "Commands applied to the plant model", fn=lambda: model.applied)
+    for command, actuator in ACTUATORS.items():
+        metrics.gauge(f'simulator_{actuator}s_running', f"Plants with the {actuator} on",
+                      fn=lambda command=command: int(model.running(command).sum()))
+    metrics_file = ''
+    if args.metrics_file:
+        base, extension = os.path.splitext(args.metrics_file)
+        metrics_file = f'{base}-{worker_id}{extension}'
+    stop_metrics = export(metrics, args.metrics_port + worker_id if args.metrics_port else 0, metrics_file)
+    profile = None
+    if args.profile_dir:
+        profile = ProfileSnapshots(args.profile_dir, f'publisher-{worker_id}', args.profile_interval,
+                                   args.profile_duration)
+    publish_log = SampledLog(args.log_interval)
+    size = args.batch_size if args.batch_size > 0 else 1
+    # Every group with the slice of the model holding its plants
+    groups = [(shard[i:i + size], slice(i, i + size)) for i in range(0, len(shard), size)]
+    interval = len(groups[0][0]) / rate
+    sent_readings = sent_messages = late = 0
+    last_report = last_step = start = time.monotonic()
+    next_send = start
+    next_aggregate = start + args.aggregate_interval
+    try:
+        while not stop_event.is_set():
+            for group, span in groups:
+                now = time.monotonic()
+                if next_send > now:
+                    time.sleep(next_send - now)
+                elif now - next_send > interval:
+                    missed = int((now - next_send) / interval)
+                    late += missed
+                    late_slots.inc(missed)
+                    next_send += missed * interval
+                next_send += interval
+                if now - last_step >= args.tick:
+                    t0 = time.perf_counter()
+                    model.step(now - last_step)
+                    step_seconds.observe(time.perf_counter() - t0)
+                    last_step = now
+
+                t0 = time.perf_counter()
+                readings = model_readings(model, span)
+                messages = []
+                if args.topics != 'plant':
+                    messages.append((MQTT_TOPIC, encode_message(group, *readings, args.batch_size, args.format,
+                                                                sent_messages)))
+                if args.topics != 'flat':
+                    messages.extend(plant_messages(group, *readings, args.format, sent_messages + len(messages)))
+                    if now >= next_aggregate:
+                        messages.extend((MQTT_TOPIC_AGGREGATE, payload) for payload in
+                                        aggregate_messages(shard, *model_readings(model), args.format))
+                        next_aggregate = now + args.aggregate_interval
+                # Blocks while a sink with the block policy is full, the next slots then come late
+                for topic, sensor_data in messages:
+                    publisher.publish(topic, sensor_data)
+                    if args.verbose:
+                        publish_log.log("Worker %d published on %s: %s", worker_id, topic, sensor_data)
+                publish_seconds.observe(time.perf_counter() - t0)
+                messages_sent.inc(len(messages))
+                readings_sent.inc(len(group))
+                sent_readings += len(group)
+                sent_messages += len(messages)
+                if profile is not None:
+                    profile.tick()
+
+                if now - last_report >= REPORT_INTERVAL:
+                    stats_queue.put((worker_id, sent_readings, sent_messages, late, now - start))
+                    last_report = now
+                if stop_event.is_set() or (args.duration and now - start >= args.duration):
+                    return
+    finally:
+        stats_queue.put((worker_id, sent_readings, sent_messages, late, time.monotonic() - start))
+        # Send what is queued, then disconnect cleanly from every broker
+        publisher.close()
+        for name, sink_stats in publisher.stats().items():
+            print(f"Worker {worker_id} to {name}: {sink_stats['published']} published, "
+                  f"{sink_stats['dropped']} dropped, {sink_stats['failed']} failed, "
+                  f"{sink_stats['queued'] + sink_stats['inflight']} unsent")
+        executor.stop()
+        if profile is not None:
+            profile.close()
+        stop_metrics()
+        stats = executor.stats()
+        if stats['received']:
+            print(f"Worker {worker_id}: {stats['received']} commands received, {stats['merged']} merged, "
+                  f"{stats['executed']} executed, receipt to actuation p50 {stats['p50'] * 1e3:.1f} ms, "
+                  f"p99 {stats['p99'] * 1e3:.1f} ms")
+
+
+def report(worker_stats, target_rate, final=False):
+    readings = sum(s[0] for s in worker_stats.values())
+    messages = sum(s[1] for s in worker_stats.values())
+    late = sum(s[2] for s in worker_stats.values())
+    elapsed = max((s[3] for s in worker_stats.values()), default=0)
+    if not elapsed:
+        return
+    # Workers report at different moments, so add up their own rates
+    achieved = sum(s[0] / s[3] for s in worker_stats.values() if s[3])
+    print(f"{'Total' if final else 'Running'}: {readings} readings in {messages} messages over {elapsed:.1f} s, "
+          f"{achieved:.0f} readings/s of {target_rate:.0f} target ({100 * achieved / target_rate:.1f}%), "
+          f"{late} late slots skipped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish simulated plant sensor readings.")
+    parser.add_argument("--plants", type=int, default=100, help="number of simulated plants")
+    parser.add_argument("--rate", type=float,
+                        help="target readings per second over all plants (default: every plant every 2 s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="publisher processes, each with its own share of the plants and MQTT clients")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="send up to this many plants per message (0 sends one message per plant)")
+    parser.add_argument("--format", choices=("json", "binary"), default="json",
+                        help="wire format of the readings, subscribers accept both")
+    parser.add_argument("--topics", choices=("flat", "plant", "both"), default="flat",
+                        help=f"publish on {MQTT_TOPIC}, on {plant_topic('<plant_id>')} with a summary on "
+                             f"{MQTT_TOPIC_AGGREGATE}, or on both")
+    parser.add_argument("--aggregate-interval", type=float, default=AGGREGATE_INTERVAL,
+                        help=f"seconds between two summaries of the fleet on {MQTT_TOPIC_AGGREGATE}")
+    parser.add_argument("--tick", type=float, default=TICK, help="seconds between two steps of the plant model")
+    parser.add_argument("--seed", type=int, help="random seed of the plant model, for repeatable runs")
+    parser.add_argument("--duration", type=float, default=0, help="seconds to run for (0 runs until interrupted)")
+    parser.add_argument("--broker", choices=("aws", "local"), default="aws",
+                        help="publish to AWS IoT Core or to a local broker stand-in")
+    parser.add_argument("--host", default="127.0.0.1", help="local broker host")
+    parser.add_argument("--port", type=int, default=1883, help="local broker port")
+    parser.add_argument("--no-dashboard", dest="dashboard", action="store_false",
+                        help="do not also publish to mqtt-dashboard.com")
+    parser.add_argument("--connections", type=int, default=1,
+                        help="connections per worker to AWS IoT Core or the local broker")
+    parser.add_argument("--queue-size", type=int, default=1000, help="messages queued per broker at most")
+    parser.add_argument("--policy", choices=POLICIES, default="block",
+                        help="what a full queue to AWS IoT Core or the local broker does")
+    parser.add_argument("--dashboard-policy", choices=POLICIES, default="drop-oldest",
+                        help="what a full queue to mqtt-dashboard.com does")
+    parser.add_argument("--qos", type=int, choices=(0, 1), default=0,
+                        help="QoS of the messages to AWS IoT Core or the local broker")
+    parser.add_argument("--max-inflight", type=int, default=20,
+                        help="messages per connection sent and not yet acknowledged (written at QoS 0)")
+    parser.add_argument("--command-workers", type=int, default=8,
+                        help="threads per publisher running the received commands")
+    parser.add_argument("--verbose", action="store_true", help="print a sample of the published messages")
+    parser.add_argument("--log-interval", type=float, default=1.0,
+                        help="seconds between two published messages printed by --verbose")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics at /metrics, worker N on this port plus N (0 to disable)")
+    parser.add_argument("--metrics-file", default="",
+                        help="write every worker's metrics to this file name with the worker id appended")
+    parser.add_argument("--profile-dir", default="",
+                        help="dump periodic cProfile snapshots of the publish loops to this directory")
+    parser.add_argument("--profile-interval", type=float, default=60,
+                        help="seconds between two profile snapshots")
+    parser.add_argument("--profile-duration", type=float, default=5, help="seconds profiled per snapshot")
+    args = parser.parse_args()
+
+    if args.plants < 1:
+        parser.error("--plants must be at least 1")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("--rate must be positive")
+    if args.format == 'binary' and args.batch_size > BINARY_MAX_RECORDS:
+        parser.error(f"binary messages hold at most {BINARY_MAX_RECORDS} readings")
+
+    plant_ids = generate_sensor_ids(args.plants)
+    target_rate = args.rate or args.plants / 2
+    workers = max(1, min(args.workers, args.plants))
+    print(f"Simulating {args.plants} plants at {target_rate:.0f} readings/s with {workers} workers")
+
+    # Every worker gets an interleaved share of the plants and of the rate
+    shards = [plant_ids[i::workers] for i in range(workers)]
+    stats_queue = multiprocessing.Queue()
+    stop_event = multiprocessing.Event()
+    processes = [
+        multiprocessing.Process(target=publisher_worker,
+                                args=(i, shard, target_rate * len(shard) / args.plants, args,
+                                      stats_queue, stop_event))
+        for i, shard in enumerate(shards)
+    ]
+    for process in processes:
+        process.start()
+
+    worker_stats = {}
+    last_report = time.monotonic()
+    try:
+        while any(process.is_alive() for process in processes):
+            try:
+                worker_id, *stats = stats_queue.get(timeout=1)
+                worker_stats[worker_id] = stats
+            except queue.Empty:
+                pass
+            if time.monotonic() - last_report >= REPORT_INTERVAL:
+                report(worker_stats, target_rate)
+                last_report = time.monotonic()
+    except KeyboardInterrupt:
+        print("Interrupted by user, stopping...")
+        stop_event.set()
+    for process in processes:
+        process.join()
+    while not stats_queue.empty():
+        worker_id, *stats = stats_queue.get()
+        worker_stats[worker_id] = stats
+    report(worker_stats, target_rate, final=True)
+
+    print("Finished publishing sensor readings.")
+
+
+if __name__ == '__main__':
+    main()
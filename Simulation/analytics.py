@@ -0,0 +1,242 @@
+import math
+import time
+import numpy as np
+from store import METRICS
+
+
+# Readings in the rolling window of every plant
+WINDOW = 50
+# Weight of the newest reading in the exponentially weighted moving average
+EWMA_ALPHA = 0.1
+# Readings farther than this many standard deviations from the window's mean are anomalies
+Z_THRESHOLD = 3.0
+# Readings needed in the window before anything is flagged
+MIN_SAMPLES = 10
+
+
+class RollingStats:
+    """Rolling statistics of every plant, updated in constant time per reading.
+
+    For each plant and metric (in METRICS order) the stats of the last
+    window readings are kept as they arrive, with no pass over the window:
+
+    * mean and variance by Welford's update, extended to a sliding window by
+      also taking out the reading that leaves it. The sums are recomputed
+      from the window once per window length, so rounding cannot build up;
+    * an exponentially weighted moving average;
+    * minimum and maximum from a monotonic deque per plant and metric, held
+      in preallocated arrays: the front is the extremum, each reading is
+      pushed once and popped at most once;
+    * the z-score of the newest reading against the window before it, and
+      an anomaly flag when it is beyond z_threshold.
+
+    update() is vectorized over the plants of a batch. Memory is fixed at
+    creation: one ring of window readings per plant, which the sliding
+    variance needs, plus the deques. Like RingStore there must be a single
+    writer, and readers of one plant use its seqlock.
+    """
+
+    def __init__(self, capacity, window=WINDOW, alpha=EWMA_ALPHA, z_threshold=Z_THRESHOLD,
+                 min_samples=MIN_SAMPLES):
+        self.capacity = capacity
+        self.window = window
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.min_samples = min_samples
+        metrics = len(METRICS)
+        # Readings ever seen per plant, and the last window of them
+        self.counts = self._allocate('counts', (capacity,), np.int64)
+        self.values = self._allocate('values', (capacity, window, metrics), np.float32)
+        self.means = self._allocate('means', (capacity, metrics), np.float64)
+        # Sum of squared differences from the mean, the variance is m2 / (n - 1)
+        self.m2 = self._allocate('m2', (capacity, metrics), np.float64)
+        self.ewmas = self._allocate('ewmas', (capacity, metrics), np.float64)
+        self.mins = self._allocate('mins', (capacity, metrics), np.float32)
+        self.maxs = self._allocate('maxs', (capacity, metrics), np.float32)
+        self.zscores = self._allocate('zscores', (capacity, metrics), np.float32)
+        self.anomalies = self._allocate('anomalies', (capacity, metrics), np.bool_)
+        # Monotonic deques as rings: values, reading numbers, front position and length
+        self.min_values = self._allocate('min_values', (capacity, metrics, window), np.float32)
+        self.min_index = self._allocate('min_index', (capacity, metrics, window), np.int64)
+        self.min_start = self._allocate('min_start', (capacity, metrics), np.int64)
+        self.min_size = self._allocate('min_size', (capacity, metrics), np.int64)
+        self.max_values = self._allocate('max_values', (capacity, metrics, window), np.float32)
+        self.max_index = self._allocate('max_index', (capacity, metrics, window), np.int64)
+        self.max_start = self._allocate('max_start', (capacity, metrics), np.int64)
+        self.max_size = self._allocate('max_size', (capacity, metrics), np.int64)
+        self.seqs = self._allocate('seqs', (capacity,), np.int64)
+
+    def _allocate(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def update(self, slots, temperatures, humidities, water_levels):
+        """Add one reading for each of many plants."""
+        slots = np.asarray(slots)
+        x = np.stack([np.asarray(temperatures), np.asarray(humidities), np.asarray(water_levels)], axis=1)
+        valid = (slots >= 0) & (slots < self.capacity)
+        if not valid.all():
+            slots, x = slots[valid], x[valid]
+        if len(slots) == 1:
+            self._update_one(int(slots[0]), x[0])
+            return
+        if len(np.unique(slots)) != len(slots):
+            # The same plant twice in one batch, add its readings in order
+            for slot, values in zip(slots.tolist(), x):
+                self._update_one(slot, values)
+            return
+        # Computed on the values as the store keeps them
+        x = x.astype(np.float32)
+        wide = x.astype(np.float64)
+        n = self.counts[slots]
+        k = np.minimum(n, self.window)[:, None]
+        mean = self.means[slots]
+        m2 = self.m2[slots]
+        self.seqs[slots] += 1
+
+        # z-score against the readings in the window before this one
+        std = np.sqrt(m2 / np.maximum(k - 1, 1))
+        deviation = wide - mean
+        z = np.divide(deviation, std, out=np.zeros_like(deviation), where=std > 0)
+        self.zscores[slots] = z
+        self.anomalies[slots] = (k >= self.min_samples) & (np.abs(z) > self.z_threshold)
+
+        # Sliding Welford: add the reading, and take out the one it replaces once the window is full
+        position = n % self.window
+        full = (n >= self.window)[:, None]
+        old = self.values[slots, position].astype(np.float64)
+        new_mean = np.where(full, mean + (wide - old) / self.window, mean + deviation / (k + 1))
+        new_m2 = np.where(full, m2 + (wide - old) * (wide - new_mean + old - mean),
+                          m2 + deviation * (wide - new_mean))
+        self.values[slots, position] = x
+        wrapped = position == self.window - 1
+        if wrapped.any():
+            # The window was filled anew, start again from its exact sums
+            window = self.values[slots[wrapped]].astype(np.float64)
+            new_mean[wrapped] = window.mean(axis=1)
+            new_m2[wrapped] = ((window - new_mean[wrapped][:, None]) ** 2).sum(axis=1)
+        self.means[slots] = new_mean
+        self.m2[slots] = np.maximum(new_m2, 0.0)
+        self.ewmas[slots] = np.where((n == 0)[:, None], wide,
+                                     self.alpha * wide + (1 - self.alpha) * self.ewmas[slots])
+
+        self.mins[slots] = self._push(self.min_values, self.min_index, self.min_start, self.min_size,
+                                      np.less, slots, x, n)
+        self.maxs[slots] = self._push(self.max_values, self.max_index, self.max_start, self.max_size,
+                                      np.greater, slots, x, n)
+        self.counts[slots] = n + 1
+        self.seqs[slots] += 1
+
+    def _update_one(self, slot, x):
+        # update() for a single reading, per-plant messages: with scalar
+        # arithmetic, as numpy's cost per call outweighs its work on 3 values
+        window = self.window
+        n = int(self.counts[slot])
+        k = min(n, window)
+        position = n % window
+        x = x.astype(np.float32)
+        self.seqs[slot] += 1
+        old = self.values[slot, position].tolist()
+        self.values[slot, position] = x
+        means, m2s, ewmas = self.means[slot].tolist(), self.m2[slot].tolist(), self.ewmas[slot].tolist()
+        zscores, anomalies, mins, maxs = [], [], [], []
+        for i, value in enumerate(x.tolist()):
+            mean, m2 = means[i], m2s[i]
+            std = math.sqrt(m2 / max(k - 1, 1))
+            z = (value - mean) / std if std > 0 else 0.0
+            zscores.append(z)
+            anomalies.append(k >= self.min_samples and abs(z) > self.z_threshold)
+            if n >= window:
+                means[i] = mean + (value - old[i]) / window
+                m2s[i] = max(m2 + (value - old[i]) * (value - means[i] + old[i] - mean), 0.0)
+            else:
+                means[i] = mean + (value - mean) / (k + 1)
+                m2s[i] = max(m2 + (value - mean) * (value - means[i]), 0.0)
+            ewmas[i] = value if n == 0 else self.alpha * value + (1 - self.alpha) * ewmas[i]
+            mins.append(self._push_one(self.min_values[slot, i], self.min_index[slot, i], self.min_start[slot],
+                                       self.min_size[slot], i, value, n, lambda back: back < value))
+            maxs.append(self._push_one(self.max_values[slot, i], self.max_index[slot, i], self.max_start[slot],
+                                       self.max_size[slot], i, value, n, lambda back: back > value))
+        if position == window - 1:
+            # The window was filled anew, start again from its exact sums
+            values = self.values[slot].astype(np.float64)
+            means = values.mean(axis=0)
+            m2s = ((values - means) ** 2).sum(axis=0)
+        self.means[slot] = means
+        self.m2[slot] = m2s
+        self.ewmas[slot] = ewmas
+        self.zscores[slot] = zscores
+        self.anomalies[slot] = anomalies
+        self.mins[slot] = mins
+        self.maxs[slot] = maxs
+        self.counts[slot] = n + 1
+        self.seqs[slot] += 1
+
+    def _push_one(self, values, index, start, size, metric, value, n, keeps):
+        # _push for one deque: values and index are its rows, start and size the slot's rows
+        window = self.window
+        head, length = int(start[metric]), int(size[metric])
+        if length and index[head] <= n - window:
+            head = (head + 1) % window
+            length -= 1
+        while length and not keeps(values[(head + length - 1) % window]):
+            length -= 1
+        tail = (head + length) % window
+        values[tail] = value
+        index[tail] = n
+        start[metric] = head
+        size[metric] = length + 1
+        return float(values[head])
+
+    def _push(self, values, index, start, size, keeps, slots, x, n):
+        # Push reading n of every slot on a monotonic deque and return the fronts.
+        # keeps(back, new) tells whether a back entry stays in front of the new reading.
+        # Works on flat views: one deque per (slot, metric) row of window entries.
+        metrics = x.shape[1]
+        window = self.window
+        rows = (slots[:, None] * metrics + np.arange(metrics)).ravel()
+        values, index = values.reshape(-1), index.reshape(-1)
+        start, size = start.reshape(-1), size.reshape(-1)
+        base = rows * window
+        new = x.ravel()
+        number = np.repeat(n, metrics)
+        head = start[rows]
+        length = size[rows]
+        # The front leaves once it is window readings old; only one can be
+        expired = (length > 0) & (index[base + head] <= number - window)
+        head = np.where(expired, (head + 1) % window, head)
+        length = length - expired
+        # Pop the back entries the new reading supersedes, amortized once per reading
+        active = np.flatnonzero(length > 0)
+        while len(active):
+            back = (head[active] + length[active] - 1) % window
+            pop = ~keeps(values[base[active] + back], new[active])
+            active = active[pop]
+            length[active] -= 1
+            active = active[length[active] > 0]
+        tail = base + (head + length) % window
+        values[tail] = new
+        index[tail] = number
+        start[rows] = head
+        size[rows] = length + 1
+        return values[base + head].reshape(-1, metrics)
+
+    def stats(self, slot):
+        """Return the statistics of one plant, a dict of arrays in METRICS order."""
+        while True:
+            seq = self.seqs[slot]
+            if seq % 2:
+                time.sleep(0)
+                continue
+            k = min(int(self.counts[slot]), self.window)
+            stats = {
+                'count': k,
+                'mean': self.means[slot].copy(),
+                'std': np.sqrt(self.m2[slot] / max(k - 1, 1)),
+                'ewma': self.ewmas[slot].copy(),
+                'min': self.mins[slot].copy(),
+                'max': self.maxs[slot].copy(),
+                'z': self.zscores[slot].copy(),
+                'anomaly': self.anomalies[slot].copy(),
+            }
+            if self.seqs[slot] == seq:
+                return stats
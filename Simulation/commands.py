@@ -0,0 +1,103 @@
+import collections
+import queue
+import threading
+import time
+import numpy as np
+
+
+# Receipt to actuation latencies kept for the percentiles
+LATENCY_SAMPLES = 10000
+
+
+class CommandExecutor:
+    """Runs plant commands on a pool of worker threads.
+
+    submit only records the commands and returns, so it is safe to call from
+    the MQTT network thread. Commands are queued per plant and a plant is
+    handled by one worker at a time, in the order its commands arrived.
+    A command already waiting for the same plant is merged with the new one
+    instead of being run twice. handler(plant_id, command) does the actual
+    work and may take as long as it needs.
+
+    The latency of a command is the time from its receipt to the moment its
+    handler starts. When plant_ids is given, commands addressed to other
+    plants are ignored; commands without a plant id are always run.
+    """
+
+    def __init__(self, handler, workers=8, plant_ids=None):
+        self.handler = handler
+        self.plant_ids = None if plant_ids is None else set(plant_ids)
+        self.lock = threading.Lock()
+        # Per plant: command -> receipt time, for commands not started yet
+        self.pending = {}
+        self.busy = set()
+        self.ready = queue.Queue()
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.received = self.merged = self.executed = 0
+        self.threads = [threading.Thread(target=self._work, name=f'command-worker-{i}', daemon=True)
+                        for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, plant_id, commands, received=None):
+        if plant_id is not None and self.plant_ids is not None and plant_id not in self.plant_ids:
+            return
+        received = time.monotonic() if received is None else received
+        with self.lock:
+            waiting = self.pending.get(plant_id)
+            if waiting is None:
+                waiting = self.pending[plant_id] = {}
+                # A busy plant is queued again by its worker when it is done
+                if plant_id not in self.busy:
+                    self.ready.put(plant_id)
+            for command in commands:
+                self.received += 1
+                if command in waiting:
+                    self.merged += 1
+                else:
+                    waiting[command] = received
+
+    def _work(self):
+        while True:
+            plant_id = self.ready.get()
+            if plant_id is StopIteration:
+                return
+            with self.lock:
+                commands = self.pending.pop(plant_id)
+                self.busy.add(plant_id)
+            try:
+                for command, received in commands.items():
+                    latency = time.monotonic() - received
+                    with self.lock:
+                        self.latencies.append(latency)
+                    try:
+                        self.handler(plant_id, command)
+                    except Exception as e:
+                        print(f"Command {command} for {plant_id} failed: {e}")
+                    with self.lock:
+                        self.executed += 1
+            finally:
+                with self.lock:
+                    self.busy.discard(plant_id)
+                    if plant_id in self.pending:
+                        self.ready.put(plant_id)
+
+    def stats(self):
+        """Return the command counters and the receipt to actuation latency percentiles in seconds."""
+        with self.lock:
+            latencies = np.array(self.latencies)
+            received, merged, executed = self.received, self.merged, self.executed
+        p50, p99, worst = np.percentile(latencies, [50, 99, 100]) if len(latencies) else (0.0, 0.0, 0.0)
+        return {
+            'received': received,
+            'merged': merged,
+            'executed': executed,
+            'p50': p50,
+            'p99': p99,
+            'max': worst,
+        }
+
+    def stop(self):
+        """Stop the workers once the plants already queued are done, without waiting for them."""
+        for _ in self.threads:
+            self.ready.put(StopIteration)
@@ -0,0 +1,103 @@
+"""Downsampling of long series before they are plotted.
+
+A line with more points than the canvas has pixels costs drawing time
+without showing anything more. MinMaxDownsampler keeps, for every bucket of
+one pixel width, the lowest and the highest sample, so spikes and the shape
+of the line survive; it is fed only the new samples as they arrive. lttb
+(Largest-Triangle-Three-Buckets) picks one representative sample per bucket
+for a whole series at once.
+"""
+import numpy as np
+
+
+class MinMaxDownsampler:
+    """Min/max per bucket of a growing series, updated incrementally.
+
+    Buckets are bucket_width wide on the x axis and start at origin. Only the
+    last bucket is still open; extend folds new samples into it and into new
+    buckets, earlier buckets are never computed again.
+    """
+
+    def __init__(self, bucket_width, origin):
+        self.bucket_width = bucket_width
+        self.origin = origin
+        # Per closed or open bucket: index, x and y of its lowest and highest sample
+        self.index = np.zeros(0, dtype=np.int64)
+        self.low_x = np.zeros(0)
+        self.low_y = np.zeros(0)
+        self.high_x = np.zeros(0)
+        self.high_y = np.zeros(0)
+
+    def extend(self, x, y):
+        """Add samples, in x order, that come after every sample added so far."""
+        if not len(x):
+            return
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        index = np.floor((x - self.origin) / self.bucket_width).astype(np.int64)
+        if len(self.index) and index[0] <= self.index[-1]:
+            # The open bucket takes part again, through its two extreme samples
+            index = np.concatenate([[self.index[-1]] * 2, index])
+            x = np.concatenate([[self.low_x[-1], self.high_x[-1]], x])
+            y = np.concatenate([[self.low_y[-1], self.high_y[-1]], y])
+            self._drop_last()
+        # Sort by bucket then value: the first sample of a bucket is its lowest, the last its highest
+        order = np.lexsort((y, index))
+        index, x, y = index[order], x[order], y[order]
+        first = np.flatnonzero(np.concatenate([[True], index[1:] != index[:-1]]))
+        last = np.append(first[1:], len(index)) - 1
+        self.index = np.concatenate([self.index, index[first]])
+        self.low_x = np.concatenate([self.low_x, x[first]])
+        self.low_y = np.concatenate([self.low_y, y[first]])
+        self.high_x = np.concatenate([self.high_x, x[last]])
+        self.high_y = np.concatenate([self.high_y, y[last]])
+
+    def _drop_last(self):
+        self.index, self.low_x, self.low_y, self.high_x, self.high_y = (
+            column[:-1] for column in (self.index, self.low_x, self.low_y, self.high_x, self.high_y))
+
+    def trim(self, x_min):
+        """Forget the buckets entirely left of x_min, after old samples left the store."""
+        keep = np.searchsorted(self.index, np.floor((x_min - self.origin) / self.bucket_width))
+        if keep:
+            self.index, self.low_x, self.low_y, self.high_x, self.high_y = (
+                column[keep:] for column in (self.index, self.low_x, self.low_y, self.high_x, self.high_y))
+
+    def points(self):
+        """Return the downsampled x and y, two samples per bucket in x order."""
+        low_first = self.low_x <= self.high_x
+        x = np.empty(2 * len(self.index))
+        y = np.empty(2 * len(self.index))
+        x[0::2] = np.where(low_first, self.low_x, self.high_x)
+        x[1::2] = np.where(low_first, self.high_x, self.low_x)
+        y[0::2] = np.where(low_first, self.low_y, self.high_y)
+        y[1::2] = np.where(low_first, self.high_y, self.low_y)
+        return x, y
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets downsampling to threshold points.
+
+    Keeps the first and last sample and, from each bucket in between, the
+    sample forming the largest triangle with the sample kept from the
+    previous bucket and the mean of the next bucket.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    size = len(x)
+    if threshold >= size or threshold < 3:
+        return x, y
+    edges = np.linspace(1, size - 1, threshold - 1).astype(np.int64)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, size - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else size
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(np.argmax(areas))
+        kept[i + 1] = previous
+    return x[kept], y[kept]
@@ -0,0 +1,171 @@
+import math
+import tkinter as tk
+from tkinter import ttk
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+
+# Same ranges as lamda/lamda_func.py, plants outside them get a command
+RANGES = {
+    'temperatures': (23, 24),
+    'humidities': (60, 61),
+    'water_levels': (33000, 36000),
+}
+
+# Overview panels, left to right, with their titles
+PANELS = (
+    ('temperatures', 'Temperature (°C)'),
+    ('humidities', 'Humidity (%)'),
+    ('water_levels', 'Water Level'),
+)
+
+# Colour of out-of-range cells, drawn over the heatmap
+ALERT_RGBA = (1.0, 0.0, 0.0, 0.85)
+# Colour of cells whose latest reading is a rolling z-score anomaly, but in range
+ANOMALY_RGBA = (1.0, 0.6, 0.0, 0.85)
+
+
+def grid_shape(count):
+    """Rows and columns of the most square grid holding count cells."""
+    columns = max(1, math.ceil(math.sqrt(count)))
+    return math.ceil(count / columns), columns
+
+
+def to_grid(values, shape, fill):
+    """Lay a flat array of per-plant values out row by row on a grid."""
+    grid = np.full(shape[0] * shape[1], fill, dtype=values.dtype)
+    grid[:len(values)] = values
+    return grid.reshape(shape)
+
+
+class FleetOverview:
+    """Heatmaps of the latest readings of the whole fleet.
+
+    One cell per plant and one panel per metric, all refreshed from
+    RingStore.latest() with array operations only: the cost of a refresh
+    does not depend on how many plants are out of range. Plants outside the
+    RANGES are painted over in red, plants without data are grey. Clicking a
+    cell calls on_select with its plant id.
+
+    With a RollingStats, plants whose latest reading is an anomaly against
+    their rolling window are painted orange, from its flags as they are.
+    """
+
+    def __init__(self, master, store, plant_ids, on_select, interval=1000, analytics=None):
+        self.master = master
+        self.store = store
+        self.analytics = analytics
+        self.plant_ids = plant_ids
+        self.on_select = on_select
+        self.interval = interval
+        self.shape = grid_shape(len(plant_ids))
+
+        self.fig = Figure(figsize=(9, 3.5))
+        axs = self.fig.subplots(1, len(PANELS))
+        self.images = {}
+        self.alerts = {}
+        empty = np.full(self.shape, np.nan)
+        for ax, (name, title) in zip(axs, PANELS):
+            low, high = RANGES[name]
+            width = high - low
+            image = ax.imshow(empty, cmap='viridis', vmin=low - width, vmax=high + width,
+                              interpolation='nearest', aspect='auto')
+            image.cmap.set_bad('lightgrey')
+            self.images[name] = image
+            self.alerts[name] = ax.imshow(np.zeros(self.shape + (4,)), interpolation='nearest', aspect='auto')
+            ax.set_title(title)
+            ax.set_xticks([])
+            ax.set_yticks([])
+            self.fig.colorbar(image, ax=ax, orientation='horizontal', pad=0.05)
+
+        self.canvas = FigureCanvasTkAgg(self.fig, master=master)
+        self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+        self.canvas.mpl_connect('button_press_event', self._on_click)
+        self.refresh()
+
+    def refresh(self):
+        latest = self.store.latest()
+        missing = ~latest['valid'][:len(self.plant_ids)]
+        if self.analytics is not None:
+            anomalies = self.analytics.anomalies[:len(self.plant_ids)]
+        for i, (name, image) in enumerate(self.images.items()):
+            values = latest[name][:len(self.plant_ids)].astype(np.float64)
+            values[missing] = np.nan
+            low, high = RANGES[name]
+            out_of_range = (values < low) | (values > high)
+            image.set_data(to_grid(values, self.shape, np.nan))
+            alert = np.zeros(self.shape + (4,))
+            if self.analytics is not None:
+                alert[to_grid(anomalies[:, i] & ~missing, self.shape, False)] = ANOMALY_RGBA
+            alert[to_grid(out_of_range, self.shape, False)] = ALERT_RGBA
+            self.alerts[name].set_data(alert)
+        self.canvas.draw_idle()
+        self.master.after(self.interval, self.refresh)
+
+    def _on_click(self, event):
+        if event.inaxes is None or event.xdata is None:
+            return
+        row, column = int(round(event.ydata)), int(round(event.xdata))
+        index = row * self.shape[1] + column
+        if 0 <= row < self.shape[0] and 0 <= column < self.shape[1] and index < len(self.plant_ids):
+            self.on_select(self.plant_ids[index])
+
+
+class VirtualPlantList(ttk.Frame):
+    """Scrollable list of plant ids that only creates its visible rows.
+
+    The listbox always holds one screen of rows; scrolling replaces their
+    text, so building the list costs the same for ten plants or a hundred
+    thousand. Double clicking or pressing Enter on a row calls on_select.
+    """
+
+    def __init__(self, master, plant_ids, on_select, rows=20):
+        super().__init__(master)
+        self.plant_ids = plant_ids
+        self.on_select = on_select
+        self.rows = rows
+        self.first = 0
+
+        self.search = ttk.Entry(self)
+        self.search.pack(side=tk.TOP, fill=tk.X)
+        self.search.bind('<Return>', self._on_search)
+        self.listbox = tk.Listbox(self, height=rows, activestyle='dotbox', exportselection=False,
+                                  font=('calibri', 14, 'bold'))
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self._on_scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.listbox.bind('<Double-Button-1>', self._on_activate)
+        self.listbox.bind('<Return>', self._on_activate)
+        self.listbox.bind('<MouseWheel>', lambda e: self.scroll_to(self.first - int(e.delta / 120)))
+        self.listbox.bind('<Button-4>', lambda e: self.scroll_to(self.first - 1))
+        self.listbox.bind('<Button-5>', lambda e: self.scroll_to(self.first + 1))
+        self.scroll_to(0)
+
+    def scroll_to(self, first):
+        self.first = max(0, min(first, len(self.plant_ids) - self.rows))
+        self.listbox.delete(0, tk.END)
+        self.listbox.insert(tk.END, *self.plant_ids[self.first:self.first + self.rows])
+        total = max(len(self.plant_ids), 1)
+        self.scrollbar.set(self.first / total, min(1.0, (self.first + self.rows) / total))
+        return 'break'
+
+    def _on_scroll(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.scroll_to(int(float(amount) * len(self.plant_ids)))
+        elif unit == 'pages':
+            self.scroll_to(self.first + int(amount) * self.rows)
+        else:
+            self.scroll_to(self.first + int(amount))
+
+    def _on_search(self, event):
+        text = self.search.get().strip()
+        if text in self.plant_ids:
+            self.on_select(text)
+        elif text.isdigit():
+            self.scroll_to(int(text) - 1)
+
+    def _on_activate(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            self.on_select(self.plant_ids[self.first + selection[0]])
@@ -0,0 +1,364 @@
+"""Persistent, memory-mapped history of every plant's readings.
+
+Readings are appended to fixed-width records in segment files; every
+segment is preallocated, memory-mapped and starts with a small header that
+holds its record count and time range. Reopening the history only reads the
+headers. Next to the raw samples, min/max/mean rollups are built at several
+resolutions as readings arrive and appended to their own segment logs, so a
+view of weeks reads a few thousand rollup records instead of every sample.
+
+All writes happen on one background thread: HistoryStore.append only puts
+the readings on a queue and never blocks the MQTT callback.
+"""
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+
+
+SEGMENT_MAGIC = b'PLNTSEG1'
+# magic, record count, record capacity, first and last timestamp
+SEGMENT_HEADER = struct.Struct('<8sqqqq')
+HEADER_SIZE = 64
+
+# One raw reading, the same layout as a record of the binary wire format
+RAW_DTYPE = np.dtype([('plant', '<u4'), ('temperature', '<f4'), ('humidity', '<f4'),
+                      ('water_level', '<f4'), ('ts', '<i8')])
+RAW_FIELDS = ('temperature', 'humidity', 'water_level')
+
+# One closed rollup bucket of a plant, metrics in RAW_FIELDS order
+ROLLUP_DTYPE = np.dtype([('plant', '<u4'), ('count', '<u4'), ('start', '<i8'),
+                         ('min', '<f4', 3), ('max', '<f4', 3), ('mean', '<f4', 3)])
+
+# Rollup resolutions in seconds: 10 s, 1 min, 10 min, 1 h, 6 h
+ROLLUP_RESOLUTIONS = (10, 60, 600, 3600, 21600)
+
+SEGMENT_RECORDS = 1 << 20
+# Seconds between two flushes of the memory maps to disk
+FLUSH_INTERVAL = 5
+
+NANOSECONDS = 10 ** 9
+
+
+class Segment:
+    """One preallocated, memory-mapped file of fixed-width records."""
+
+    def __init__(self, path, dtype, capacity=SEGMENT_RECORDS):
+        self.path = path
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, 0, capacity, 0, 0).ljust(HEADER_SIZE, b'\0'))
+                f.truncate(HEADER_SIZE + capacity * dtype.itemsize)
+        self.header = np.memmap(path, dtype=np.uint8, mode='r+', shape=(HEADER_SIZE,))
+        magic, self.count, self.capacity, self.first_ts, self.last_ts = SEGMENT_HEADER.unpack_from(self.header)
+        if magic != SEGMENT_MAGIC:
+            raise ValueError(f"{path} is not a history segment")
+        self.records = np.memmap(path, dtype=dtype, mode='r+', offset=HEADER_SIZE, shape=(self.capacity,))
+
+    @property
+    def free(self):
+        return self.capacity - self.count
+
+    def append(self, records, timestamps):
+        """Append records, the caller makes sure they fit."""
+        self.records[self.count:self.count + len(records)] = records
+        first = int(timestamps.min())
+        self.first_ts = min(self.first_ts, first) if self.count else first
+        self.last_ts = max(self.last_ts, int(timestamps.max()))
+        self.count += len(records)
+        # The count is written last, readers never see records it does not cover
+        SEGMENT_HEADER.pack_into(self.header, 0, SEGMENT_MAGIC, self.count, self.capacity,
+                                 self.first_ts, self.last_ts)
+
+    def overlaps(self, start, end):
+        return self.count and self.first_ts <= end and self.last_ts >= start
+
+    def valid(self):
+        return self.records[:self.count]
+
+    def flush(self):
+        self.records.flush()
+        self.header.flush()
+
+
+class SegmentLog:
+    """Append-only sequence of segments sharing a name prefix and record type."""
+
+    def __init__(self, directory, prefix, dtype, time_field, capacity=SEGMENT_RECORDS):
+        self.directory = directory
+        self.prefix = prefix
+        self.dtype = dtype
+        self.time_field = time_field
+        self.capacity = capacity
+        names = sorted(name for name in os.listdir(directory)
+                       if name.startswith(prefix + '_') and name.endswith('.seg'))
+        self.segments = [Segment(os.path.join(directory, name), dtype) for name in names]
+
+    def _new_segment(self):
+        path = os.path.join(self.directory, f'{self.prefix}_{len(self.segments):06d}.seg')
+        self.segments.append(Segment(path, self.dtype, self.capacity))
+        return self.segments[-1]
+
+    def append(self, records):
+        while len(records):
+            segment = self.segments[-1] if self.segments and self.segments[-1].free else self._new_segment()
+            part = records[:segment.free]
+            segment.append(part, part[self.time_field])
+            records = records[len(part):]
+
+    def select(self, plant, start, end):
+        """Return the records of a plant between two timestamps, in time order."""
+        parts = []
+        for segment in self.segments:
+            if segment.overlaps(start, end):
+                records = segment.valid()
+                times = records[self.time_field]
+                parts.append(records[(records['plant'] == plant) & (times >= start) & (times <= end)])
+        if not parts:
+            return np.zeros(0, dtype=self.dtype)
+        selected = np.concatenate(parts)
+        return selected[np.argsort(selected[self.time_field], kind='stable')]
+
+    def flush(self):
+        for segment in self.segments:
+            segment.flush()
+
+
+class Rollup:
+    """Open min/max/sum buckets of every plant at one resolution.
+
+    The buckets being filled are kept in arrays indexed by plant, and a
+    block of readings is folded into them with array operations. A bucket is
+    written to the log once a reading of a later bucket arrives for its plant.
+    """
+
+    def __init__(self, resolution, log):
+        self.resolution = resolution * NANOSECONDS
+        self.log = log
+        self.start = np.full(0, -1, dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.low = np.zeros((0, 3))
+        self.high = np.zeros((0, 3))
+        self.total = np.zeros((0, 3))
+
+    def _grow(self, size):
+        extra = size - len(self.start)
+        self.start = np.concatenate([self.start, np.full(extra, -1, dtype=np.int64)])
+        self.count = np.concatenate([self.count, np.zeros(extra, dtype=np.int64)])
+        self.low, self.high, self.total = (np.concatenate([column, np.zeros((extra, 3))])
+                                           for column in (self.low, self.high, self.total))
+
+    def add(self, records):
+        if not len(records):
+            return
+        plants = records['plant'].astype(np.int64)
+        if plants.max() >= len(self.start):
+            self._grow(int(plants.max()) + 1)
+        buckets = records['ts'] // self.resolution * self.resolution
+        order = np.lexsort((buckets, plants))
+        plants, buckets = plants[order], buckets[order]
+        values = np.stack([records[name][order] for name in RAW_FIELDS], axis=1).astype(np.float64)
+
+        # One group per plant and bucket
+        first = np.flatnonzero(np.concatenate([[True], (plants[1:] != plants[:-1]) | (buckets[1:] != buckets[:-1])]))
+        g_plant, g_bucket = plants[first], buckets[first]
+        g_count = np.diff(np.append(first, len(plants)))
+        g_low = np.minimum.reduceat(values, first)
+        g_high = np.maximum.reduceat(values, first)
+        g_total = np.add.reduceat(values, first)
+
+        # Fold the open bucket of a plant into the group of the same bucket
+        open_start = self.start[g_plant]
+        merge = g_bucket == open_start
+        merged_plants = g_plant[merge]
+        g_count[merge] += self.count[merged_plants]
+        g_low[merge] = np.minimum(g_low[merge], self.low[merged_plants])
+        g_high[merge] = np.maximum(g_high[merge], self.high[merged_plants])
+        g_total[merge] += self.total[merged_plants]
+        merged = np.zeros(len(self.start), dtype=bool)
+        merged[merged_plants] = True
+
+        # The newest group of a plant stays open, older groups and a replaced open bucket are closed
+        last = np.append(g_plant[1:] != g_plant[:-1], True)
+        stays_open = last & (g_bucket >= open_start)
+        replaced = last & (open_start >= 0) & (open_start < g_bucket) & ~merged[g_plant]
+        replaced_plants = g_plant[replaced]
+
+        closed = np.zeros(int((~stays_open).sum()) + len(replaced_plants), dtype=ROLLUP_DTYPE)
+        n = len(replaced_plants)
+        closed['plant'][:n] = replaced_plants
+        closed['count'][:n] = self.count[replaced_plants]
+        closed['start'][:n] = self.start[replaced_plants]
+        closed['min'][:n] = self.low[replaced_plants]
+        closed['max'][:n] = self.high[replaced_plants]
+        closed['mean'][:n] = self.total[replaced_plants] / self.count[replaced_plants, None]
+        done = ~stays_open
+        closed['plant'][n:] = g_plant[done]
+        closed['count'][n:] = g_count[done]
+        closed['start'][n:] = g_bucket[done]
+        closed['min'][n:] = g_low[done]
+        closed['max'][n:] = g_high[done]
+        closed['mean'][n:] = g_total[done] / g_count[done, None]
+        if len(closed):
+            self.log.append(closed)
+
+        opened = g_plant[stays_open]
+        self.start[opened] = g_bucket[stays_open]
+        self.count[opened] = g_count[stays_open]
+        self.low[opened] = g_low[stays_open]
+        self.high[opened] = g_high[stays_open]
+        self.total[opened] = g_total[stays_open]
+
+    def _open_records(self, plants):
+        records = np.zeros(len(plants), dtype=ROLLUP_DTYPE)
+        records['plant'] = plants
+        records['count'] = self.count[plants]
+        records['start'] = self.start[plants]
+        records['min'] = self.low[plants]
+        records['max'] = self.high[plants]
+        records['mean'] = self.total[plants] / self.count[plants, None]
+        return records
+
+    def close_all(self):
+        """Write every open bucket, at shutdown."""
+        plants = np.flatnonzero(self.start >= 0)
+        if len(plants):
+            self.log.append(self._open_records(plants))
+        self.start[:] = -1
+
+    def open_bucket(self, plant):
+        """The bucket still being filled for a plant, as a record array, or None."""
+        if plant >= len(self.start) or self.start[plant] < 0:
+            return None
+        return self._open_records(np.array([plant]))
+
+
+class HistoryStore:
+    """Raw readings and rollups of every plant, persisted in a directory."""
+
+    def __init__(self, directory, resolutions=ROLLUP_RESOLUTIONS, segment_records=SEGMENT_RECORDS):
+        os.makedirs(directory, exist_ok=True)
+        self.raw = SegmentLog(directory, 'raw', RAW_DTYPE, 'ts', segment_records)
+        self.rollups = [Rollup(resolution, SegmentLog(directory, f'rollup_{resolution}s', ROLLUP_DTYPE,
+                                                      'start', segment_records))
+                        for resolution in resolutions]
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        # Batches of readings that failed to be written and were dropped
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self.thread.start()
+
+    def append(self, plants, timestamps, temperatures, humidities, water_levels):
+        """Queue readings for writing, called from the ingest path."""
+        if not len(plants):
+            return
+        self.queue.put((plants, timestamps, temperatures, humidities, water_levels))
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            batches = [self.queue.get()]
+            # Write everything that piled up while the previous batch was written
+            while True:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batches[-1] is None
+            batches = [batch for batch in batches if batch is not None]
+            if batches:
+                try:
+                    self._write(batches)
+                except Exception as e:
+                    # One bad batch must not stop the history for good
+                    self.dropped += len(batches)
+                    print(f"History write of {len(batches)} batches failed, dropped: {e!r}")
+            if stop or time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                with self.lock:
+                    self.raw.flush()
+                    for rollup in self.rollups:
+                        rollup.log.flush()
+                last_flush = time.monotonic()
+            if stop:
+                return
+
+    def _write(self, batches):
+        size = sum(len(batch[0]) for batch in batches)
+        if not size:
+            return
+        records = np.empty(size, dtype=RAW_DTYPE)
+        offset = 0
+        for plants, timestamps, temperatures, humidities, water_levels in batches:
+            end = offset + len(plants)
+            records['plant'][offset:end] = plants
+            records['ts'][offset:end] = timestamps
+            records['temperature'][offset:end] = temperatures
+            records['humidity'][offset:end] = humidities
+            records['water_level'][offset:end] = water_levels
+            offset = end
+        with self.lock:
+            self.raw.append(records)
+            for rollup in self.rollups:
+                rollup.add(records)
+
+    def close(self):
+        """Write what is queued, close the open buckets and flush to disk."""
+        self.queue.put(None)
+        self.thread.join()
+        for rollup in self.rollups:
+            rollup.close_all()
+            rollup.log.flush()
+
+    def pick_resolution(self, start, end, max_points):
+        """Finest resolution in seconds showing a time range in at most max_points, 0 for raw samples."""
+        span = (end - start) / NANOSECONDS
+        # A plant reports at most about once a second
+        if span <= max_points:
+            return 0
+        for rollup in self.rollups:
+            resolution = rollup.resolution // NANOSECONDS
+            if span / resolution <= max_points:
+                break
+        return resolution
+
+    def query(self, plant, start, end, max_points=500):
+        """Return the history of a plant between two epoch nanosecond timestamps.
+
+        The resolution is picked so that at most about max_points buckets are
+        returned. The result holds 'ts' and, for every metric, 'min', 'max'
+        and 'mean' arrays; for raw samples the three are the same values.
+        """
+        resolution = self.pick_resolution(start, end, max_points)
+        with self.lock:
+            if not resolution:
+                records = self.raw.select(plant, start, end)
+                values = np.stack([records[name] for name in RAW_FIELDS], axis=1)
+                return {'resolution': 0, 'ts': records['ts'], 'min': values, 'max': values, 'mean': values}
+            rollup = next(r for r in self.rollups if r.resolution == resolution * NANOSECONDS)
+            records = rollup.log.select(plant, start - rollup.resolution, end)
+            current = rollup.open_bucket(plant)
+        if current is not None:
+            records = np.concatenate([records, current])
+        return dict(merge_buckets(records), resolution=resolution)
+
+
+def merge_buckets(records):
+    """Combine rollup records of the same bucket, written across restarts."""
+    starts, index = np.unique(records['start'], return_index=True)
+    if len(starts) == len(records):
+        return {'ts': records['start'], 'min': records['min'], 'max': records['max'], 'mean': records['mean']}
+    order = np.argsort(records['start'], kind='stable')
+    records = records[order]
+    index = np.searchsorted(records['start'], starts)
+    counts = records['count'].astype(np.float64)
+    weighted = records['mean'] * counts[:, None]
+    total = np.add.reduceat(counts, index)
+    return {
+        'ts': starts,
+        'min': np.minimum.reduceat(records['min'], index),
+        'max': np.maximum.reduceat(records['max'], index),
+        'mean': (np.add.reduceat(weighted, index) / total[:, None]).astype(np.float32),
+    }
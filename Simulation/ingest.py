@@ -0,0 +1,290 @@
+"""Sharded ingest tier of the monitor.
+
+N worker processes decode the sensor messages and write them into a
+SharedRingStore, so decoding never competes with Tk and matplotlib for the
+GUI process' GIL. Plants are hash-partitioned over the workers by their
+index (plant_N goes to worker N % workers): every worker receives the
+messages, keeps only the readings of its own plants, and is the single
+writer of their slots, in the store and in the SharedRollingStats of the
+plants' rolling statistics. A message of a single plant is recognised from its
+first bytes and skipped by the other workers without being decoded; of a
+binary batch each worker selects the records of its plants before
+converting any, only a JSON batch is decoded whole by every worker. A
+message without readings of the worker's plants is counted as skipped, one
+that fails to decode as failed, and is dropped.
+
+Each worker also keeps the persistent history of its plants in its own
+directory; the GUI queries it through IngestTier.query, which has the
+signature of HistoryStore.query.
+"""
+import itertools
+import multiprocessing
+import os
+import queue
+import re
+import struct
+import threading
+import time
+import numpy as np
+from payloads import (decode_columns, binary_records, record_columns, content_type, ReportState, BINARY_MAGIC,
+                      CONTENT_TYPE_BINARY)
+from shared_store import SharedRingStore, SharedRollingStats
+from analytics import WINDOW
+from history import HistoryStore
+from metrics import LATE_AFTER, SampledLog
+
+
+# The per-plant and device JSON messages start with their plant id
+SINGLE_PLANT = re.compile(rb'\{"plant_id": "plant_(\d+)"')
+
+# Per worker counters in the shared stats array
+STATS = ('messages', 'readings', 'skipped', 'failed')
+
+# What decoding a malformed message raises
+DECODE_ERRORS = (ValueError, KeyError, TypeError, struct.error)
+
+decode_log = SampledLog(interval=1.0, burst=5)
+
+# Seconds IngestTier.query waits for a worker, it is called from the GUI thread
+QUERY_TIMEOUT = 1.0
+
+
+def single_plant(raw):
+    """Index of the only plant of a message, None for a batch of several plants."""
+    if raw[:1] == bytes([BINARY_MAGIC]):
+        return None
+    match = SINGLE_PLANT.match(raw)
+    return int(match.group(1)) if match else None
+
+
+class Ingestor:
+    """The monitor's ingest of one sensor message, in the process calling it.
+
+    Decodes the message, writes its readings into the store, the rolling
+    statistics and the history, and returns how many readings it held.
+    Called from a single thread, the single writer of all three. With
+    metrics, an IngestMetrics, the decode and store times, the counts and
+    the age of every message are recorded too. A message that fails to
+    decode is counted, logged and dropped: it is often called from the MQTT
+    client's thread, which must not see the exception.
+    """
+
+    def __init__(self, store, analytics=None, history=None, metrics=None):
+        self.store = store
+        self.analytics = analytics
+        self.history = history
+        self.metrics = metrics
+        # Last full report of every device reporting by exception, to rebuild their deltas
+        self.report_state = ReportState()
+        # Messages dropped because they failed to decode
+        self.failed = 0
+
+    def __call__(self, raw):
+        started = time.perf_counter()
+        try:
+            columns = decode_columns(raw, self.report_state)
+        except DECODE_ERRORS as e:
+            self.failed += 1
+            if self.metrics is not None:
+                self.metrics.failed.inc()
+            decode_log.log("Dropped a message that failed to decode: %r", e)
+            return 0
+        if self.metrics is None:
+            return self._store(*columns)
+        metrics = self.metrics
+        decoded = time.perf_counter()
+        count = self._store(*columns)
+        metrics.decode_seconds.observe(decoded - started)
+        metrics.store_seconds.observe(time.perf_counter() - decoded)
+        metrics.messages.inc()
+        metrics.readings.inc(count)
+        if count:
+            age = (time.time_ns() - int(columns[4].max())) / 1e9
+            metrics.age.observe(age)
+            if age > LATE_AFTER:
+                metrics.late.inc()
+        return count
+
+    def _store(self, plants, temperatures, humidities, water_levels, timestamps):
+        self.store.append_many(plants - 1, timestamps, temperatures, humidities, water_levels)
+        if self.analytics is not None:
+            self.analytics.update(plants - 1, temperatures, humidities, water_levels)
+        if self.history is not None:
+            self.history.append(plants, timestamps, temperatures, humidities, water_levels)
+        return len(plants)
+
+
+def connect(source, worker_id, on_payload):
+    """Subscribe a worker to the sensor data and return a function disconnecting it.
+
+    source is ('aws',) for AWS IoT Core, ('mqtt', host, port) for a plain
+    MQTT broker or ('replay', payloads, start) to ingest a list of payloads
+    once the start event is set, for benchmarks.
+    """
+    kind = source[0]
+    if kind == 'aws':
+        from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+        from personal_arguments import DEV_CRT, DEV_KEY, AWS_ENDPOINT, CA_CERT, CLIENT_ID
+        client = AWSIoTMQTTClient(f'{CLIENT_ID}-ingest-{worker_id}')
+        client.configureEndpoint(AWS_ENDPOINT, 8883)
+        client.configureCredentials(CA_CERT, DEV_KEY, DEV_CRT)
+        client.connect()
+        client.subscribe("sensor/data", 1, lambda c, userdata, message: on_payload(message.payload))
+        return client.disconnect
+    if kind == 'mqtt':
+        import paho.mqtt.client as mqtt
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        client.on_connect = lambda c, userdata, flags, rc, properties: c.subscribe("sensor/data", 1)
+        client.on_message = lambda c, userdata, message: on_payload(message.payload)
+        client.connect(source[1], source[2], 60)
+        client.loop_start()
+
+        def disconnect():
+            client.loop_stop()
+            client.disconnect()
+        return disconnect
+    if kind == 'replay':
+        source[2].wait()
+        for raw in source[1]:
+            on_payload(raw)
+        return lambda: None
+    raise ValueError(f"unknown source {kind!r}")
+
+
+def ingest_worker(worker_id, workers, store_name, capacity, depth, window, source, history_dir, stats, ready,
+                  requests, responses, stop_event):
+    """Decode the readings of one partition of the plants into the shared store."""
+    store = SharedRingStore(store_name, capacity, depth, create=False)
+    analytics = SharedRollingStats(f'{store_name}_stats', capacity, window, create=False)
+    history = HistoryStore(os.path.join(history_dir, f'shard-{worker_id}')) if history_dir else None
+    report_state = ReportState()
+    offset = worker_id * len(STATS)
+
+    def decode_mine(raw):
+        # The columns of the readings of this worker's plants
+        plant = single_plant(raw)
+        if plant is not None and plant % workers != worker_id:
+            return None
+        if content_type(raw) == CONTENT_TYPE_BINARY:
+            records = binary_records(raw)
+            return record_columns(records[records['plant'] % workers == worker_id])
+        columns = decode_columns(raw, report_state)
+        if plant is None:
+            mine = columns[0] % workers == worker_id
+            columns = tuple(column[mine] for column in columns)
+        return columns
+
+    def on_payload(raw):
+        # The message counter goes last, once it is up the readings are in the store.
+        # Nothing may raise into the MQTT client's callback
+        try:
+            columns = decode_mine(raw)
+        except DECODE_ERRORS:
+            stats[offset + 3] += 1
+            stats[offset] += 1
+            return
+        if columns is None or not len(columns[0]):
+            stats[offset + 2] += 1
+            stats[offset] += 1
+            return
+        plants, temperatures, humidities, water_levels, timestamps = columns
+        store.append_many(plants - 1, timestamps, temperatures, humidities, water_levels)
+        analytics.update(plants - 1, temperatures, humidities, water_levels)
+        if history is not None:
+            history.append(plants, timestamps, temperatures, humidities, water_levels)
+        stats[offset + 1] += len(plants)
+        stats[offset] += 1
+
+    def serve_queries():
+        # History queries of the GUI for the plants of this worker
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            query_id, *arguments = request
+            responses.put((query_id, history.query(*arguments) if history is not None else None))
+
+    server = threading.Thread(target=serve_queries, daemon=True)
+    server.start()
+    ready.release()
+    disconnect = connect(source, worker_id, on_payload)
+    try:
+        stop_event.wait()
+    finally:
+        disconnect()
+        requests.put(None)
+        server.join(timeout=10)
+        if history is not None:
+            history.close()
+        analytics.close()
+        store.close()
+
+
+class IngestTier:
+    """The ingest worker processes and the shared store they write.
+
+    store and analytics are the GUI's views of the shared SharedRingStore
+    and SharedRollingStats, to read only.
+    """
+
+    def __init__(self, workers, capacity, depth, source, history_dir=None, window=WINDOW):
+        self.workers = workers
+        self.store = SharedRingStore(f'plants_{os.getpid()}', capacity, depth, create=True)
+        self.analytics = SharedRollingStats(f'{self.store.name}_stats', capacity, window, create=True)
+        # messages, readings, skipped and failed messages of every worker, updated without locking
+        self.stats = multiprocessing.Array('q', workers * len(STATS), lock=False)
+        self.stop_event = multiprocessing.Event()
+        ready = multiprocessing.Semaphore(0)
+        self.requests = [multiprocessing.Queue() for _ in range(workers)]
+        self.responses = [multiprocessing.Queue() for _ in range(workers)]
+        self.lock = threading.Lock()
+        self.query_ids = itertools.count()
+        self.processes = [
+            multiprocessing.Process(target=ingest_worker, name=f'ingest-{i}', daemon=True,
+                                    args=(i, workers, self.store.name, capacity, depth, window, source, history_dir,
+                                          self.stats, ready, self.requests[i], self.responses[i],
+                                          self.stop_event))
+            for i in range(workers)
+        ]
+        for process in self.processes:
+            process.start()
+        # Wait until every worker has mapped the store
+        for _ in self.processes:
+            ready.acquire()
+
+    def totals(self):
+        """Counters summed over the workers, as a dict."""
+        counters = np.frombuffer(self.stats, dtype=np.int64).reshape(self.workers, len(STATS)).sum(axis=0)
+        return dict(zip(STATS, counters.tolist()))
+
+    def register(self, registry):
+        """Export the counters summed over the workers as gauges of a metrics Registry."""
+        for name in STATS:
+            registry.gauge(f'monitor_ingest_{name}', f"{name.capitalize()} counted by the ingest workers",
+                           fn=lambda name=name: self.totals()[name])
+
+    def query(self, plant, start, end, max_points=500):
+        """HistoryStore.query, answered by the worker owning the plant.
+
+        Returns None if the worker does not answer within QUERY_TIMEOUT. Its
+        late answer is told apart by the query id and discarded later.
+        """
+        owner = plant % self.workers
+        deadline = time.monotonic() + QUERY_TIMEOUT
+        with self.lock:
+            query_id = next(self.query_ids)
+            self.requests[owner].put((query_id, plant, start, end, max_points))
+            while True:
+                try:
+                    answer_id, history = self.responses[owner].get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    return None
+                if answer_id == query_id:
+                    return history
+
+    def close(self):
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(timeout=10)
+        self.analytics.close()
+        self.store.close()
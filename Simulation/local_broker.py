@@ -0,0 +1,190 @@
+"""Minimal local MQTT 3.1.1 broker used as a stand-in for AWS IoT Core.
+
+It supports what the simulator, the monitor and the benchmarks use:
+CONNECT, PUBLISH with QoS 0 and 1, SUBSCRIBE/UNSUBSCRIBE with '+' and '#'
+wildcards, PINGREQ and DISCONNECT. There is no TLS, authentication,
+retained messages or session persistence.
+
+    python local_broker.py --port 1883
+"""
+import argparse
+import asyncio
+import struct
+import threading
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(topic_filter, topic):
+    """Return True if topic matches an MQTT topic filter."""
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_packet(packet_type, flags, body):
+    header = bytearray([(packet_type << 4) | flags])
+    length = len(body)
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes(header) + body
+
+
+def encode_string(value):
+    return struct.pack('!H', len(value)) + value
+
+
+class Session:
+    def __init__(self, broker, writer):
+        self.broker = broker
+        self.writer = writer
+        self.subscriptions = {}
+        self.next_packet_id = 1
+
+    def deliver(self, topic, payload, qos):
+        if qos:
+            packet_id = self.next_packet_id
+            self.next_packet_id = packet_id % 65535 + 1
+            body = encode_string(topic) + struct.pack('!H', packet_id) + payload
+            self.writer.write(encode_packet(PUBLISH, 0x02, body))
+        else:
+            self.writer.write(encode_packet(PUBLISH, 0x00, encode_string(topic) + payload))
+
+
+class LocalBroker:
+    def __init__(self, host='127.0.0.1', port=1883):
+        self.host = host
+        self.port = port
+        self.sessions = set()
+        self.messages_in = 0
+        self.messages_out = 0
+        self._server = None
+        self._loop = None
+        self._thread = None
+
+    async def _read_packet(self, reader):
+        first = await reader.readexactly(1)
+        multiplier, length = 1, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await reader.readexactly(length) if length else b''
+        return first[0] >> 4, first[0] & 0x0F, body
+
+    def _publish(self, topic, payload, qos):
+        self.messages_in += 1
+        topic_name = topic.decode()
+        for session in list(self.sessions):
+            granted = None
+            for topic_filter, sub_qos in session.subscriptions.items():
+                if topic_matches(topic_filter, topic_name):
+                    granted = max(granted or 0, sub_qos)
+            if granted is not None:
+                session.deliver(topic, payload, min(qos, granted))
+                self.messages_out += 1
+
+    async def _handle(self, reader, writer):
+        session = Session(self, writer)
+        try:
+            packet_type, _, _ = await self._read_packet(reader)
+            if packet_type != CONNECT:
+                return
+            writer.write(encode_packet(CONNACK, 0, b'\x00\x00'))
+            self.sessions.add(session)
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                if packet_type == PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    topic_length = struct.unpack_from('!H', body)[0]
+                    topic = body[2:2 + topic_length]
+                    offset = 2 + topic_length
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        writer.write(encode_packet(PUBACK, 0, packet_id))
+                    self._publish(topic, body[offset:], min(qos, 1))
+                elif packet_type == SUBSCRIBE:
+                    packet_id, offset, granted = body[:2], 2, bytearray()
+                    while offset < len(body):
+                        length = struct.unpack_from('!H', body, offset)[0]
+                        topic_filter = body[offset + 2:offset + 2 + length].decode()
+                        qos = min(body[offset + 2 + length], 1)
+                        session.subscriptions[topic_filter] = qos
+                        granted.append(qos)
+                        offset += 3 + length
+                    writer.write(encode_packet(SUBACK, 0, packet_id + bytes(granted)))
+                elif packet_type == UNSUBSCRIBE:
+                    packet_id, offset = body[:2], 2
+                    while offset < len(body):
+                        length = struct.unpack_from('!H', body, offset)[0]
+                        session.subscriptions.pop(body[offset + 2:offset + 2 + length].decode(), None)
+                        offset += 2 + length
+                    writer.write(encode_packet(UNSUBACK, 0, packet_id))
+                elif packet_type == PINGREQ:
+                    writer.write(encode_packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    return
+                # PUBACK from subscribers needs no answer
+                if writer.transport.get_write_buffer_size() > 1 << 20:
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            writer.close()
+
+    async def serve(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start(self):
+        """Run the broker on a background thread and return once it listens."""
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._server.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a local MQTT broker stand-in.")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+    print(f"Local broker listening on {args.host}:{args.port}")
+    try:
+        asyncio.run(LocalBroker(args.host, args.port).serve())
+    except KeyboardInterrupt:
+        print("Broker stopped.")
@@ -1,81 +1,155 @@
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
 from personal_arguments import DEV_CRT, DEV_KEY, AWS_ENDPOINT, CA_CERT, CLIENT_ID
 import time
-import json
 import matplotlib.pyplot as plt
-from datetime import datetime
-import matplotlib.dates as mdates
-import queue
 import tkinter as tk
 from tkinter import ttk
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import numpy as np
-import collections
-
+import argparse
+from store import RingStore
+from analytics import RollingStats
+from plant_plot import PlantPlot
+from fleet_overview import FleetOverview, VirtualPlantList
+from history import HistoryStore
+from ingest import IngestTier, Ingestor
+from monitor_client import MonitorClient
+from payloads import DATA_TOPIC, AGGREGATE_TOPIC, plant_topic
+from metrics import Registry, IngestMetrics, ProfileSnapshots, export, watch_loop_lag
+
+
+parser = argparse.ArgumentParser(description="Show live plant sensor data.")
+parser.add_argument("--plants", type=int, default=100, help="number of plants to keep data for")
+parser.add_argument("--history", type=int, default=50, help="samples of history kept per plant")
+parser.add_argument("--history-dir", default="history",
+                    help="directory of the persistent history of every plant (empty to disable)")
+parser.add_argument("--ingest-workers", type=int, default=0,
+                    help="decode the sensor data in this many worker processes (0 to decode in the GUI process)")
+parser.add_argument("--window", type=int, default=50,
+                    help="readings in the rolling mean, variance, min and max of every plant")
+parser.add_argument("--server", default="",
+                    help="HOST:PORT of a monitor_server.py to view instead of subscribing to AWS IoT")
+parser.add_argument("--topics", choices=("flat", "plant"), default="flat",
+                    help=f"subscribe to all of {DATA_TOPIC}, or only to the plants with an open window and to "
+                         f"{AGGREGATE_TOPIC} for the overview (needs the simulator's --topics plant or both)")
+parser.add_argument("--metrics-port", type=int, default=0,
+                    help="serve Prometheus metrics on this port at /metrics (0 to disable)")
+parser.add_argument("--metrics-file", default="",
+                    help="also write the metrics to this file every few seconds, for a textfile collector")
+parser.add_argument("--profile-dir", default="",
+                    help="dump periodic cProfile snapshots of the GUI and MQTT threads to this directory")
+parser.add_argument("--profile-interval", type=float, default=60,
+                    help="seconds between two profile snapshots")
+parser.add_argument("--profile-duration", type=float, default=5, help="seconds profiled per snapshot")
+args = parser.parse_args()
+if args.topics == 'plant' and (args.server or args.ingest_workers):
+    parser.error("--topics plant subscribes in the GUI process, without --server or --ingest-workers")
+
+# Metrics of the ingest and the GUI, exported as asked
+metrics = Registry()
+redraw_seconds = metrics.histogram('monitor_redraw_seconds', "Time to redraw a plant window", labels=('plant',))
+loop_lag_seconds = metrics.histogram('monitor_tk_loop_lag_seconds', "How late Tk runs a scheduled callback")
+stop_metrics = export(metrics, args.metrics_port, args.metrics_file)
+profiles = []
+if args.profile_dir:
+    # cProfile sees one thread, the GUI and the MQTT callback thread get a snapshot series each
+    profiles = [ProfileSnapshots(args.profile_dir, name, args.profile_interval, args.profile_duration)
+                for name in ('gui', 'ingest')]
 
 # Simulated sensor IDs
-sensor_ids = [f'sensor_{i + 1}' for i in range(100)]
-plant_ids = [f'plant_{i + 1}' for i in range(100)]
+sensor_ids = [f'sensor_{i + 1}' for i in range(args.plants)]
+plant_ids = [f'plant_{i + 1}' for i in range(args.plants)]
 sensor_windows = {}
 
 # Initialize a dictionary of queues for thread-safe data transfer, one for each sensor
 sensor_queues = {}
 
-# Dictionaries to store data for each sensor
-data_store = {
-    'timestamps': {},
-    'temperatures': {},
-    'humidities': {},
-    'water_levels': {}
+ingest_tier = monitor_client = None
+if args.server:
+    # The server ingests and streams the new samples, this window is one of its viewers
+    server_host, _, server_port = args.server.rpartition(':')
+    data_store = RingStore(capacity=len(plant_ids), depth=args.history)
+    monitor_client = MonitorClient(server_host, int(server_port), data_store).start()
+    fleet_store = monitor_client.fleet_store
+    # The server does not stream the rolling statistics
+    analytics = None
+    history_store = monitor_client
+elif args.ingest_workers:
+    # The workers decode the messages into shared memory and keep the history
+    # of their plants, the GUI only reads
+    ingest_tier = IngestTier(args.ingest_workers, len(plant_ids), args.history, ('aws',),
+                             args.history_dir or None, args.window)
+    data_store = fleet_store = ingest_tier.store
+    analytics = ingest_tier.analytics
+    history_store = ingest_tier if args.history_dir else None
+    ingest_tier.register(metrics)
+else:
+    # Columnar history of every plant, plant_N is kept in slot N - 1.
+    # The MQTT callback thread is its only writer.
+    data_store = fleet_store = RingStore(capacity=len(plant_ids), depth=args.history)
+    if args.topics == 'plant':
+        # Only the plants with an open window get all their readings, the
+        # overview shows the fleet from the aggregate messages
+        fleet_store = RingStore(capacity=len(plant_ids), depth=1)
+    # Rolling statistics of every plant, updated with each reading by the same thread
+    analytics = RollingStats(len(plant_ids), args.window)
+
+    # Every reading is also kept on disk, with rollups to zoom out over weeks.
+    # Writing happens on the history's own thread.
+    history_store = HistoryStore(args.history_dir) if args.history_dir else None
+
+    # Decodes a message into all three, rebuilding the deltas of devices reporting by exception
+    if args.topics == 'plant':
+        # The history then keeps every plant at the rate of the aggregate messages
+        ingest = Ingestor(data_store, analytics, None, IngestMetrics(metrics))
+        aggregate_ingest = Ingestor(fleet_store, None, history_store, IngestMetrics(metrics, 'monitor_aggregate'))
+    else:
+        ingest = Ingestor(data_store, analytics, history_store, IngestMetrics(metrics))
+
+# Time spans the plant windows can zoom out to, in seconds
+ZOOM_SPANS = {
+    'Live': None,
+    '1 hour': 3600,
+    '1 day': 86400,
+    '1 week': 7 * 86400,
+    '4 weeks': 28 * 86400,
 }
 
+
+def plant_slot(plant_id):
+    return int(plant_id.rpartition('_')[2]) - 1
+
+
 # Custom MQTT message callback function
 def customCallback(client, userdata, message):
-    # Parse the message payload and enqueue it
-    global data_store
-    payload = json.loads(message.payload)
-    plant_id = payload['plant_id']
-
-    if plant_id not in data_store:
-        # Initialize storage for a new sensor
-        data_store[plant_id] = {
-            'timestamps': collections.deque(maxlen=50),
-            'temperatures': collections.deque(maxlen=50),
-            'humidities': collections.deque(maxlen=50),
-            'water_levels': collections.deque(maxlen=50)
-        }
-
-    # Update data for the sensor
-    # timestamp = datetime.strptime(payload['time'], "%a %b %d %H:%M:%S %Y")
-    data_store[plant_id]['timestamps'].append(datetime.strptime(payload['time'], "%a %b %d %H:%M:%S %Y"))
-    data_store[plant_id]['temperatures'].append(payload['temperature'])
-    data_store[plant_id]['humidities'].append(payload['humidity'])
-    data_store[plant_id]['water_levels'].append(payload['water_level'])
-
-
-# Replace with your AWS IoT endpoint, client ID, and paths to your certificates and private key
-myMQTTClient = AWSIoTMQTTClient(CLIENT_ID)
-myMQTTClient.configureEndpoint(AWS_ENDPOINT, 8883)
-myMQTTClient.configureCredentials(CA_CERT, DEV_KEY, DEV_CRT)
-
-# Connect and subscribe to AWS IoT
-myMQTTClient.connect()
-myMQTTClient.subscribe("sensor/data", 1, customCallback)
+    # Parse the message payload, a batch message is stored with one vectorized write
+    ingest(message.payload)
+    if profiles:
+        profiles[1].tick()
+
+
+def aggregateCallback(client, userdata, message):
+    aggregate_ingest(message.payload)
+
+
+if ingest_tier is None and monitor_client is None:
+    # Replace with your AWS IoT endpoint, client ID, and paths to your certificates and private key
+    myMQTTClient = AWSIoTMQTTClient(CLIENT_ID)
+    myMQTTClient.configureEndpoint(AWS_ENDPOINT, 8883)
+    myMQTTClient.configureCredentials(CA_CERT, DEV_KEY, DEV_CRT)
+
+    # Connect and subscribe to AWS IoT
+    myMQTTClient.connect()
+    if args.topics == 'plant':
+        # The plants' own topics are subscribed to while their windows are open
+        myMQTTClient.subscribe(AGGREGATE_TOPIC, 1, aggregateCallback)
+    else:
+        myMQTTClient.subscribe(DATA_TOPIC, 1, customCallback)
 
 
 def fetch_latest_sensor_data(plant_id):
-    """Simulate fetching the latest sensor data."""
-    global data_store
-    # Extract data
-    # sensor_id = payload['sensor_id']
-    # temperature = payload['temperature']
-    # humidity = payload['humidity']
-    water_level = data_store[plant_id]['water_levels']
-    timestamp = data_store[plant_id]['timestamps']
-
-    # timestamps = np.arange(10)
-    # values = np.random.rand(10) * 100  # Simulate data as an example
-    return timestamp, water_level
+    """Fetch the latest water level data of a plant."""
+    history = data_store.snapshot(plant_slot(plant_id))
+    return history['timestamps'], history['water_levels']
 
 # def update_plot(sensor_id, fig, ax, canvas):
 #     """Simulate updating the plot with new data."""
@@ -89,51 +163,41 @@ def fetch_latest_sensor_data(plant_id):
 #     sensor_windows[sensor_id].after(1000, update_plot, sensor_id, fig, ax, canvas)
 
 
-def update_plot(plant_id, fig, axs, canvas):
-    global data_store
+def update_plot(plant_id, plot):
+    if plant_id not in sensor_windows:
+        return  # Window was closed
 
-    # Define the function to format the x-axis to prevent overlap for upper plots
-    def format_ax(ax, ylabel):
-        ax.clear()  # Clear the existing plot
-        ax.set_ylabel(ylabel)
-        ax.tick_params(axis='x', which='both', bottom=False, top=False, labelbottom=False)  # Hide x-axis labels for upper plots
+    # Draws only when a new sample arrived, and then only the changed lines
+    started = time.perf_counter()
+    if plot.update():
+        redraw_seconds.labels(plant_id).observe(time.perf_counter() - started)
 
-    # Define the function to format the x-axis to prevent overlap for the bottom plot
-    def format_bottom_ax(ax, xlabel, ylabel):
-        ax.clear()  # Clear the existing plot
-        ax.set_xlabel(xlabel)
-        ax.set_ylabel(ylabel)
-        ax.tick_params(axis='x', rotation=45)  # Rotate x-axis labels to prevent overlap
-
-        #ax.xaxis.set_major_formatter(plt.matplotlib.dates.DateFormatter('%H:%M:%S'))
-
-    temperatures = data_store[plant_id]['temperatures']
-    humidities = data_store[plant_id]['humidities']
-    water_levels = data_store[plant_id]['water_levels']
-    timestamps = data_store[plant_id]['timestamps']
-
-    fig.suptitle(f"{plant_id} Data", fontsize='large')
-
-    # Plot temperatures
-    format_ax(axs[0], 'Temperature (°C)')
-    axs[0].plot(timestamps, temperatures, marker='o', linestyle='-')
-
-    # Plot humidities
-    format_ax(axs[1], 'Humidity (%)')
-    axs[1].plot(timestamps, humidities, marker='o', linestyle='-')
+    # Assuming sensor_windows is a dictionary that holds Tkinter windows, and after is a method to schedule updates
+    sensor_windows[plant_id].after(1000, update_plot, plant_id, plot)
 
-    # Plot water levels
-    format_bottom_ax(axs[2], 'Time', 'Water Level (%)')
-    axs[2].plot(timestamps, water_levels, marker='o', linestyle='-')
 
-    # Adjust subplot spacing to prevent overlap
-    plt.subplots_adjust(hspace=0.4, bottom=0.15)
-    fig.autofmt_xdate()  # Auto format x-axis labels to fit and prevent overlap
+def zoom_sensor_data(plant_id, plot, span_name):
+    span = ZOOM_SPANS[span_name]
+    if span is None:
+        plot.show_live()
+        return
+    end = time.time_ns()
+    width = plot.canvas.get_tk_widget().winfo_width()
+    history = history_store.query(plant_slot(plant_id) + 1, end - span * 10 ** 9, end,
+                                  max_points=max(width, 100))
+    if history is not None:
+        plot.show_history(history)
 
-    canvas.draw()  # Redraw the canvas with the new plot
 
-    # Assuming sensor_windows is a dictionary that holds Tkinter windows, and after is a method to schedule updates
-    sensor_windows[plant_id].after(1000, update_plot, plant_id, fig, axs, canvas)
+def close_sensor_data(plant_id, fig):
+    sensor_window = sensor_windows.pop(plant_id, None)
+    if sensor_window is not None:
+        sensor_window.destroy()
+        if monitor_client is not None:
+            monitor_client.unsubscribe(plant_id)
+        elif args.topics == 'plant':
+            myMQTTClient.unsubscribeAsync(plant_topic(plant_id))
+    plt.close(fig)
 
 
 def show_sensor_data(plant_id):
@@ -144,23 +208,42 @@ def show_sensor_data(plant_id):
     sensor_window = tk.Toplevel(root)
     sensor_window.title(f"Data for {plant_id}")
     sensor_windows[plant_id] = sensor_window
-
-    # Ensure the window is removed from the tracking dict when closed
-    sensor_window.protocol("WM_DELETE_WINDOW",
-                           lambda sid=plant_id: (sensor_window.destroy(), sensor_windows.pop(sid, None)))
-
-    # Create a Matplotlib figure and axes
-    fig, axs = plt.subplots(3, 1)
+    if monitor_client is not None:
+        # Stream all samples of this plant while its window is open
+        monitor_client.subscribe(plant_id)
+    elif args.topics == 'plant':
+        # Receive this plant's readings while its window is open, without blocking on the acknowledgement
+        myMQTTClient.subscribeAsync(plant_topic(plant_id), 1, messageCallback=customCallback)
+
+    # Create a Matplotlib figure and axes, the plots share the time axis
+    fig, axs = plt.subplots(3, 1, sharex=True)
     canvas = FigureCanvasTkAgg(fig, master=sensor_window)
     canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
 
+    # Ensure the window is removed from the tracking dict when closed
+    sensor_window.protocol("WM_DELETE_WINDOW", lambda sid=plant_id: close_sensor_data(sid, fig))
+
     # Button to close the sensor data window
     ttk.Button(sensor_window, text="Return",
-               command=lambda sid=plant_id: (sensor_window.destroy(), sensor_windows.pop(sid, None))).pack(
-        side=tk.BOTTOM)
+               command=lambda sid=plant_id: close_sensor_data(sid, fig)).pack(side=tk.BOTTOM)
 
     # Start periodic update of the plot
-    update_plot(plant_id, fig, axs, canvas)
+    plot = PlantPlot(plant_id, data_store, plant_slot(plant_id), fig, axs, canvas, analytics)
+
+    if history_store is not None:
+        # Zoom out from the live samples to the stored history
+        zoom = ttk.Combobox(sensor_window, values=list(ZOOM_SPANS), state='readonly')
+        zoom.set('Live')
+        zoom.bind('<<ComboboxSelected>>', lambda e, sid=plant_id: zoom_sensor_data(sid, plot, zoom.get()))
+        zoom.pack(side=tk.BOTTOM)
+
+    canvas.draw()
+    update_plot(plant_id, plot)
+
+
+def profile_gui():
+    profiles[0].tick()
+    root.after(1000, profile_gui)
 
 
 try:
@@ -170,60 +253,37 @@ try:
         root = tk.Tk()
         root.title("Sensor Data Viewer")
         # Set Geometry(widthxheight)
-        root.geometry('500x500')
-        # Create a Canvas and a Scrollbar
-        canvas = tk.Canvas(root)
-        scrollbar = ttk.Scrollbar(root, orient="vertical", command=canvas.yview)
-
-        # Create a frame inside the canvas
-        scrollable_frame = ttk.Frame(canvas)
-
-        # Link a scrollable region with the scrollable frame
-        scrollable_frame.bind(
-            "<Configure>",
-            lambda e: canvas.configure(
-                scrollregion=canvas.bbox("all")
-            )
-        )
-
-        # Create a window inside the canvas that contains the scrollable_frame
-        canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-
-        canvas.configure(yscrollcommand=scrollbar.set)
-
-        # Pack the scrollbar to the right and fill in the y-direction
-        scrollbar.pack(side="right", fill="y")
-        # Pack the canvas to expand and fill in both directions
-        canvas.pack(side="left", fill="both", expand=True)
-
-        # Create style Object
-        style = ttk.Style()
-
-        style.configure('TButton', font=
-        ('calibri', 20, 'bold'),
-                        borderwidth='4')
-
-        style.map('TButton', foreground=[('active', '!disabled', 'green')],
-                  background=[('active', 'black')])
-
-        # Generate a button for each sensor
-        for plant_id in plant_ids:
-            ttk.Button(scrollable_frame, text=plant_id, command=lambda sid=plant_id: show_sensor_data(sid)).pack()
-
-
-        # Function to handle mouse scrolling
-        def _on_mousewheel(event):
-            canvas.yview_scroll(int(-1 * (event.delta / 120)), "units")
+        root.geometry('1200x600')
 
+        # Plant list on the left, only the visible rows are created
+        plant_list = VirtualPlantList(root, plant_ids, show_sensor_data)
+        plant_list.pack(side="left", fill="y")
 
-        # Bind the mousewheel event to the canvas
-        canvas.bind_all("<MouseWheel>", _on_mousewheel)
+        # Heatmaps of the latest readings of every plant, click a cell to open its window.
+        # With per-plant topics only the open plants have statistics, so no anomalies are shown.
+        overview_frame = ttk.Frame(root)
+        overview_frame.pack(side="left", fill="both", expand=True)
+        overview = FleetOverview(overview_frame, fleet_store, plant_ids, show_sensor_data,
+                                 analytics=analytics if args.topics == "flat" else None)
 
+        watch_loop_lag(root, loop_lag_seconds)
+        if profiles:
+            profile_gui()
 
         root.mainloop()
 except KeyboardInterrupt:
     print("Disconnecting...")
-    myMQTTClient.disconnect()
+    if monitor_client is not None:
+        monitor_client.close()
+    elif ingest_tier is not None:
+        ingest_tier.close()
+    else:
+        myMQTTClient.disconnect()
+        if history_store is not None:
+            history_store.close()
+    for profile in profiles:
+        profile.close()
+    stop_metrics()
     plt.close('all')
 
 
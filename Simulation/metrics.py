@@ -0,0 +1,328 @@
+"""Low-overhead instrumentation of the simulator and the monitor.
+
+Metrics live in a Registry and cost an addition or a bisect over a few
+bucket bounds when updated, so they can sit on the hot paths: the MQTT
+callbacks, the publish loop and the redraws. Each metric has a single
+writer thread, like the stores, so updates take no lock; a scrape may read
+a histogram halfway through an update, which a monitoring system does not
+notice. The registry renders the Prometheus text format, served over HTTP
+by MetricsServer or written to a file by MetricsFile for the node
+exporter's textfile collector:
+
+    simulator_messages_sent_total 12000
+    monitor_decode_seconds_bucket{le="0.0001"} 9712
+
+Rates are left to the monitoring system, e.g. rate(monitor_messages_total[1m]).
+
+ProfileSnapshots profiles one thread for a few seconds now and then and
+dumps the pstats, and SampledLog replaces printing a line per message with
+at most a few lines per interval and a count of those it held back.
+"""
+import bisect
+import cProfile
+import http.server
+import os
+import threading
+import time
+
+
+# Upper bounds in seconds of the latency histograms, 50 us to 10 s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds in seconds of the message age histograms, 1 ms to 5 min
+AGE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# A reading older than this many seconds when ingested is counted as late
+LATE_AFTER = 5.0
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name + '_total', labels, self.value
+
+
+class Gauge:
+    """A value that is set, or read from fn at every scrape."""
+
+    def __init__(self, fn=None):
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name, labels, self.fn() if self.fn is not None else self.value
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = list(buckets)
+        # One count per bucket and one for the values above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        total = 0
+        for bound, count in zip(self.bounds + ['+Inf'], self.counts):
+            total += count
+            yield name + '_bucket', labels + (('le', str(bound)),), total
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class Family:
+    """The metrics of one name, one per value of its labels."""
+
+    def __init__(self, kind, labelnames, factory):
+        self.kind = kind
+        self.labelnames = labelnames
+        self.factory = factory
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+    def remove(self, *values):
+        self.children.pop(values, None)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Registry:
+    """Named metrics, rendered in the Prometheus text format.
+
+    counter(), gauge() and histogram() return the metric itself, or with
+    labels its Family, whose labels(*values) returns the metric of a value.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def _add(self, name, description, kind, labels, factory):
+        with self.lock:
+            family = self.families[name] = (description, Family(kind, tuple(labels), factory))
+        return family[1] if labels else family[1].labels()
+
+    def counter(self, name, description, labels=()):
+        return self._add(name, description, 'counter', labels, Counter)
+
+    def gauge(self, name, description, labels=(), fn=None):
+        return self._add(name, description, 'gauge', labels, lambda: Gauge(fn))
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(name, description, 'histogram', labels, lambda: Histogram(buckets))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            families = list(self.families.items())
+        for name, (description, family) in families:
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {family.kind}')
+            for values, metric in list(family.children.items()):
+                for sample, labels, value in metric.samples(name, tuple(zip(family.labelnames, values))):
+                    lines.append(f'{sample}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """Serves GET /metrics of a registry on a background thread."""
+
+    def __init__(self, registry, host='127.0.0.1', port=9100):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsFile:
+    """Writes a registry to a file every interval seconds, replacing it atomically."""
+
+    def __init__(self, registry, path, interval=5.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def write(self):
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.registry.render())
+        os.replace(temporary, self.path)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='metrics-file', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.write()
+
+
+def export(registry, port=0, path='', host='127.0.0.1'):
+    """Start serving and/or writing a registry as asked; returns a function stopping both."""
+    exporters = []
+    if port:
+        exporters.append(MetricsServer(registry, host, port).start())
+    if path:
+        exporters.append(MetricsFile(registry, path).start())
+
+    def stop():
+        for exporter in exporters:
+            exporter.stop()
+    return stop
+
+
+class ProfileSnapshots:
+    """cProfile snapshots of the thread calling tick().
+
+    Every interval seconds the thread is profiled for duration seconds and
+    the stats are dumped to <directory>/<name>-<epoch seconds>.pstats, to
+    read with pstats or snakeviz. cProfile only sees the thread it was
+    enabled on, so each thread of interest ticks its own ProfileSnapshots;
+    tick() costs a clock read between snapshots.
+    """
+
+    def __init__(self, directory, name, interval=60.0, duration=5.0):
+        self.directory = directory
+        self.name = name
+        self.interval = interval
+        self.duration = duration
+        self.profile = None
+        self.next_change = time.monotonic() + interval
+        self.snapshots = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def tick(self):
+        now = time.monotonic()
+        if now < self.next_change:
+            return
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            self.next_change = now + self.duration
+        else:
+            self.close()
+            self.next_change = now + self.interval
+
+    def close(self):
+        """Stop and dump the snapshot being taken, if any."""
+        if self.profile is None:
+            return
+        self.profile.disable()
+        self.profile.dump_stats(os.path.join(self.directory, f'{self.name}-{int(time.time())}.pstats'))
+        self.profile = None
+        self.snapshots += 1
+
+
+class SampledLog:
+    """Prints at most burst lines per interval seconds and counts the rest.
+
+    The line is only formatted when it is printed, so a suppressed call costs
+    a clock read. The first line printed after some were held back tells how
+    many.
+    """
+
+    def __init__(self, interval=1.0, burst=1, write=print):
+        self.interval = interval
+        self.burst = burst
+        self.write = write
+        self.window_start = -interval
+        self.printed = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def log(self, message, *args):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.window_start >= self.interval:
+                self.window_start = now
+                self.printed = 0
+            if self.printed >= self.burst:
+                self.suppressed += 1
+                return
+            self.printed += 1
+            suppressed, self.suppressed = self.suppressed, 0
+        line = message % args if args else message
+        self.write(f'{line} ({suppressed} similar lines suppressed)' if suppressed else line)
+
+
+class IngestMetrics:
+    """The metrics of Ingestor: decode and store latencies, messages, readings, failures and lateness."""
+
+    def __init__(self, registry, prefix='monitor'):
+        self.decode_seconds = registry.histogram(f'{prefix}_decode_seconds', "Time to decode a sensor message")
+        self.store_seconds = registry.histogram(
+            f'{prefix}_store_seconds', "Time to write a decoded message into the store, statistics and history")
+        self.messages = registry.counter(f'{prefix}_messages', "Sensor messages ingested")
+        self.readings = registry.counter(f'{prefix}_readings', "Readings ingested")
+        self.failed = registry.counter(f'{prefix}_messages_failed', "Sensor messages that could not be decoded")
+        self.late = registry.counter(
+            f'{prefix}_messages_late', f"Sensor messages whose newest reading was over {LATE_AFTER:g} s old")
+        self.age = registry.histogram(f'{prefix}_message_age_seconds',
+                                      "Age of the newest reading of a message when ingested", buckets=AGE_BUCKETS)
+
+
+def watch_loop_lag(widget, histogram, interval=0.1):
+    """Observe how late a Tk after() callback fires, every interval seconds, as the event loop's lag."""
+    delay = int(interval * 1000)
+
+    def check(due):
+        now = time.monotonic()
+        histogram.observe(max(now - due, 0.0))
+        widget.after(delay, check, now + interval)
+
+    widget.after(delay, check, time.monotonic() + interval)
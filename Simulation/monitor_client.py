@@ -0,0 +1,153 @@
+"""Viewer side of monitor_server.py.
+
+MonitorClient mirrors what the server streams into local RingStores, so the
+Tk monitor draws from them exactly as it does from its own ingest: the
+newest sample of every plant goes into fleet_store and all samples of the
+subscribed plants into store. History queries are HTTP requests with the
+signature of HistoryStore.query.
+"""
+import base64
+import http.client
+import json
+import os
+import socket
+import threading
+import urllib.parse
+import numpy as np
+from store import RingStore
+from monitor_server import (encode_frame, mask_payload, parse_frame_header, accept_key,
+                            TEXT, CLOSE, PING, PONG, FIELDS)
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("monitor server closed the connection")
+        data += chunk
+    return bytes(data)
+
+
+def columns_of(entry):
+    """Timestamps and metric columns of a frame entry, as the store takes them."""
+    return (np.asarray(entry['ts'], dtype=np.int64),) + tuple(
+        np.asarray(entry[field], dtype=np.float32) for field in FIELDS)
+
+
+class MonitorClient:
+    def __init__(self, host, port, store, fleet_store=None):
+        self.host = host
+        self.port = port
+        self.store = store
+        self.fleet_store = fleet_store if fleet_store is not None else RingStore(store.capacity, 1)
+        # Server count of the newest sample kept of every slot, to skip the ones already stored
+        self.seen = np.zeros(store.capacity, dtype=np.int64)
+        self.slots = {}
+        self.frames = 0
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        """Connect, ask for the fleet and start receiving on a background thread."""
+        response = self._get('/plants')
+        self.slots = {plant_id: slot for slot, plant_id in enumerate(response['plants'])}
+        self.sock = socket.create_connection((self.host, self.port))
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((f'GET /ws HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nUpgrade: websocket\r\n'
+                           f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n'
+                           'Sec-WebSocket-Version: 13\r\n\r\n').encode())
+        response = b''
+        while not response.endswith(b'\r\n\r\n'):
+            response += recv_exactly(self.sock, 1)
+        if accept_key(key).encode() not in response:
+            raise ConnectionError(f"monitor server refused the WebSocket: {response[:80]!r}")
+        self.thread = threading.Thread(target=self._receive, daemon=True)
+        self.thread.start()
+        self.send({'fleet': True})
+        return self
+
+    def send(self, request):
+        with self.send_lock:
+            self.sock.sendall(encode_frame(TEXT, json.dumps(request).encode(), os.urandom(4)))
+
+    def subscribe(self, plant_id):
+        self.send({'subscribe': [plant_id]})
+
+    def unsubscribe(self, plant_id):
+        self.send({'unsubscribe': [plant_id]})
+
+    def _read_frame(self):
+        opcode, masked, length = parse_frame_header(recv_exactly(self.sock, 2))
+        if length == 126:
+            length = int.from_bytes(recv_exactly(self.sock, 2), 'big')
+        elif length == 127:
+            length = int.from_bytes(recv_exactly(self.sock, 8), 'big')
+        mask = recv_exactly(self.sock, 4) if masked else None
+        payload = recv_exactly(self.sock, length) if length else b''
+        return opcode, mask_payload(payload, mask) if mask else payload
+
+    def _receive(self):
+        # The only writer of both stores
+        try:
+            while True:
+                opcode, payload = self._read_frame()
+                if opcode == TEXT:
+                    self.apply(json.loads(payload))
+                    self.frames += 1
+                elif opcode == PING:
+                    with self.send_lock:
+                        self.sock.sendall(encode_frame(PONG, payload, os.urandom(4)))
+                elif opcode == CLOSE:
+                    return
+        except (ConnectionError, OSError):
+            pass
+
+    def apply(self, frame):
+        """Store the samples of one frame."""
+        for entry in frame['plants']:
+            slot = self.slots.get(entry['plant'])
+            if slot is None or slot >= self.store.capacity:
+                continue
+            # The entry holds the samples up to number count, skip the ones stored before
+            first = entry['count'] - len(entry['ts'])
+            for k, row in enumerate(zip(*columns_of(entry))):
+                if first + k + 1 > self.seen[slot]:
+                    self.store.append(slot, *row)
+            self.seen[slot] = max(self.seen[slot], entry['count'])
+        fleet = frame['fleet']
+        if fleet is not None:
+            slots = np.asarray(fleet['slots'], dtype=np.int64)
+            self.fleet_store.append_many(slots, *columns_of(fleet))
+
+    def query(self, plant, start, end, max_points=500):
+        """HistoryStore.query answered by the server, None if it keeps no history."""
+        path = '/history/plant_%d?%s' % (plant, urllib.parse.urlencode(
+            {'start': int(start), 'end': int(end), 'max_points': max_points}))
+        history = self._get(path)
+        if history is None:
+            return None
+        values = {name: np.asarray(history[name], dtype=np.float32).reshape(-1, len(FIELDS))
+                  for name in ('min', 'max', 'mean')}
+        return dict(values, resolution=history['resolution'], ts=np.asarray(history['ts'], dtype=np.int64))
+
+    def _get(self, path):
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            body = response.read()
+        finally:
+            connection.close()
+        return json.loads(body) if response.status == 200 else None
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                with self.send_lock:
+                    self.sock.sendall(encode_frame(CLOSE, b'', os.urandom(4)))
+            except OSError:
+                pass
+            self.sock.close()
+            self.thread.join(timeout=5)
@@ -0,0 +1,428 @@
+"""Headless monitor: ingests the sensor data once and serves it to many viewers.
+
+The readings go into a RingStore, decoded in process or by the ingest
+workers (--ingest-workers), and are served over HTTP and WebSocket on one
+port:
+
+    GET /plants                  plant ids and history depth
+    GET /fleet                   newest sample of every plant
+    GET /plants/<plant_id>       live samples of a plant
+    GET /history/<plant_id>      HistoryStore.query, ?start=&end=&max_points=
+    GET /stats                   viewers, frames and bytes sent
+    GET /metrics                 the same and the ingest's, in the Prometheus text format
+    GET /ws                      WebSocket stream of new samples
+
+A WebSocket viewer sends JSON text messages: {"fleet": true} for the newest
+sample of every plant that changed, {"subscribe": ["plant_3"]} and
+{"unsubscribe": [...]} for all samples of some plants. Every FRAME_INTERVAL
+the server pushes one frame with only the samples each viewer has not got
+yet. Viewers asking for the same thing share one encoded frame. A viewer
+whose connection has more than HIGH_WATER bytes unsent gets no frame; what
+it misses is coalesced into the next frame it can take, so a slow viewer
+never holds up the others nor grows the server's memory.
+
+    python monitor_server.py --source mqtt --broker-port 1883 --port 8765
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import http
+import json
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+import numpy as np
+from store import RingStore, METRICS
+from history import HistoryStore
+from ingest import IngestTier, Ingestor, connect
+from metrics import Registry, IngestMetrics, CONTENT_TYPE
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+TEXT, BINARY, CLOSE, PING, PONG = 0x1, 0x2, 0x8, 0x9, 0xA
+
+# Seconds between two frames pushed to the viewers
+FRAME_INTERVAL = 0.25
+# Unsent bytes above which a viewer is skipped until its connection catches up
+HIGH_WATER = 16 * 1024
+# Kernel send buffer of a viewer connection, kept small so that a slow link
+# shows up as unsent bytes in the transport instead of queueing in the kernel
+SEND_BUFFER = 16 * 1024
+# Names of the store's metrics in the frames
+FIELDS = ('temperature', 'humidity', 'water_level')
+# Decimals sent for the metrics
+DECIMALS = 2
+
+
+def accept_key(key):
+    """Sec-WebSocket-Accept answer to a Sec-WebSocket-Key."""
+    return base64.b64encode(hashlib.sha1(key.encode() + WS_GUID).digest()).decode()
+
+
+def mask_payload(payload, key):
+    """XOR a payload with a 4 byte masking key, done both to mask and unmask."""
+    if not payload:
+        return payload
+    repeated = (key * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(len(payload), 'big')
+
+
+def encode_frame(opcode, payload, mask=None):
+    """One final WebSocket frame; clients pass a 4 byte mask, servers do not mask."""
+    length = len(payload)
+    mask_bit = 0x80 if mask else 0
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, mask_bit | length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, mask_bit | 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, mask_bit | 127, length)
+    if mask:
+        return header + mask + mask_payload(payload, mask)
+    return header + payload
+
+
+def parse_frame_header(header):
+    """Opcode, masked flag and length field of the first two bytes of a frame."""
+    return header[0] & 0x0F, bool(header[1] & 0x80), header[1] & 0x7F
+
+
+async def read_frame(reader):
+    """Read one frame, return its opcode and unmasked payload."""
+    opcode, masked, length = parse_frame_header(await reader.readexactly(2))
+    if length == 126:
+        length = struct.unpack('!H', await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', await reader.readexactly(8))[0]
+    mask = await reader.readexactly(4) if masked else None
+    payload = await reader.readexactly(length) if length else b''
+    return opcode, mask_payload(payload, mask) if mask else payload
+
+
+def rounded(values):
+    return np.round(values.astype(np.float64), DECIMALS).tolist()
+
+
+def plant_json(plant_id, total, columns):
+    """Frame entry of the new samples of one plant; count is the number of the last one."""
+    entry = {'plant': plant_id, 'count': total, 'ts': columns['timestamps'].view(np.int64).tolist()}
+    for field, name in zip(FIELDS, METRICS):
+        entry[field] = rounded(columns[name])
+    return json.dumps(entry)
+
+
+def fleet_json(latest, counts, slots):
+    """Frame entry of the newest sample of the given slots."""
+    entry = {'slots': slots.tolist(), 'count': counts[slots].tolist(),
+             'ts': latest['timestamps'][slots].view(np.int64).tolist()}
+    for field, name in zip(FIELDS, METRICS):
+        entry[field] = rounded(latest[name][slots])
+    return json.dumps(entry)
+
+
+def history_json(history):
+    """JSON of a HistoryStore.query result."""
+    return json.dumps({'resolution': history['resolution'], 'ts': history['ts'].tolist(),
+                       'min': rounded(history['min']), 'max': rounded(history['max']),
+                       'mean': rounded(history['mean'])})
+
+
+class Viewer:
+    """What one WebSocket viewer asked for and has been sent."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        # Count of the last sample sent of every subscribed slot
+        self.plants = {}
+        self.fleet = False
+        # Store counts of the last fleet entry sent, None before the first one
+        self.fleet_counts = None
+        self.frames = 0
+        self.skipped = 0
+
+
+class MonitorServer:
+    def __init__(self, store, plant_ids, history=None, host='127.0.0.1', port=8765,
+                 frame_interval=FRAME_INTERVAL, high_water=HIGH_WATER, metrics=None):
+        self.store = store
+        self.plant_ids = plant_ids
+        self.slots = {plant_id: slot for slot, plant_id in enumerate(plant_ids)}
+        self.history = history
+        self.host = host
+        self.port = port
+        self.frame_interval = frame_interval
+        self.high_water = high_water
+        self.viewers = set()
+        self.ticks = 0
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.encoded = 0
+        self.bytes_sent = 0
+        self.tick_seconds = 0.0
+        self.max_tick_seconds = 0.0
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._pusher = None
+        # A metrics Registry to serve at /metrics, with the server's stats added to it
+        self.metrics = metrics
+        self.tick_histogram = None
+        if metrics is not None:
+            self.tick_histogram = metrics.histogram('monitor_server_tick_seconds', "Time to push one frame tick")
+            for name, description in (('viewers', "Connected viewers"), ('frames_sent', "Frames sent"),
+                                      ('frames_skipped', "Frames skipped for slow viewers"),
+                                      ('frames_encoded', "Distinct frames encoded"), ('bytes_sent', "Bytes sent")):
+                metrics.gauge(f'monitor_server_{name}', description, fn=lambda name=name: self.stats()[name])
+
+    def stats(self):
+        return {'viewers': len(self.viewers), 'ticks': self.ticks, 'frames_sent': self.frames_sent,
+                'frames_skipped': self.frames_skipped, 'frames_encoded': self.encoded,
+                'bytes_sent': self.bytes_sent,
+                'mean_tick_ms': 1000 * self.tick_seconds / max(self.ticks, 1),
+                'max_tick_ms': 1000 * self.max_tick_seconds}
+
+    def tick(self):
+        """Push the samples each viewer has not got yet, encoding every distinct frame once."""
+        started = time.perf_counter()
+        counts = self.store.counts.copy()
+        latest = None
+        plant_entries = {}
+        fleet_entries = {}
+        frames = {}
+        for viewer in list(self.viewers):
+            if viewer.writer.transport.get_write_buffer_size() > self.high_water:
+                # Slow connection: nothing is marked sent, the next frame it takes catches up
+                viewer.skipped += 1
+                self.frames_skipped += 1
+                continue
+            plant_keys = []
+            for slot, sent in viewer.plants.items():
+                if counts[slot] > sent:
+                    key = (slot, sent)
+                    if key not in plant_entries:
+                        plant_entries[key] = self.store.since(slot, sent)
+                    viewer.plants[slot] = plant_entries[key][0]
+                    plant_keys.append(key)
+            fleet_key = None
+            if viewer.fleet:
+                # Viewers that took the same frames share the same counts array
+                fleet_key = id(viewer.fleet_counts)
+                if fleet_key not in fleet_entries:
+                    if viewer.fleet_counts is None:
+                        changed = np.flatnonzero(counts > 0)
+                    else:
+                        changed = np.flatnonzero(counts != viewer.fleet_counts)
+                    if len(changed):
+                        latest = self.store.latest(counts) if latest is None else latest
+                        fleet_entries[fleet_key] = fleet_json(latest, counts, changed)
+                    else:
+                        fleet_entries[fleet_key] = None
+                viewer.fleet_counts = counts
+                if fleet_entries[fleet_key] is None:
+                    fleet_key = None
+            if not plant_keys and fleet_key is None:
+                continue
+            frame_key = (tuple(plant_keys), fleet_key)
+            frame = frames.get(frame_key)
+            if frame is None:
+                plants = ', '.join(plant_json(self.plant_ids[slot], *plant_entries[slot, sent])
+                                   for slot, sent in plant_keys)
+                fleet = 'null' if fleet_key is None else fleet_entries[fleet_key]
+                text = '{"tick": %d, "plants": [%s], "fleet": %s}' % (self.ticks, plants, fleet)
+                frame = frames[frame_key] = encode_frame(TEXT, text.encode())
+                self.encoded += 1
+            viewer.writer.write(frame)
+            viewer.frames += 1
+            self.frames_sent += 1
+            self.bytes_sent += len(frame)
+        self.ticks += 1
+        elapsed = time.perf_counter() - started
+        self.tick_seconds += elapsed
+        self.max_tick_seconds = max(self.max_tick_seconds, elapsed)
+        if self.tick_histogram is not None:
+            self.tick_histogram.observe(elapsed)
+
+    async def _push(self):
+        while True:
+            await asyncio.sleep(self.frame_interval)
+            self.tick()
+
+    def _on_message(self, viewer, message):
+        request = json.loads(message)
+        if 'fleet' in request:
+            viewer.fleet = bool(request['fleet'])
+            viewer.fleet_counts = None
+        for plant_id in request.get('subscribe', ()):
+            if plant_id in self.slots:
+                viewer.plants.setdefault(self.slots[plant_id], 0)
+        for plant_id in request.get('unsubscribe', ()):
+            viewer.plants.pop(self.slots.get(plant_id), None)
+
+    async def _websocket(self, reader, writer, headers):
+        writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                      f'Sec-WebSocket-Accept: {accept_key(headers["sec-websocket-key"])}\r\n\r\n').encode())
+        writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+        viewer = Viewer(writer)
+        self.viewers.add(viewer)
+        try:
+            while True:
+                opcode, payload = await read_frame(reader)
+                if opcode == TEXT:
+                    try:
+                        self._on_message(viewer, payload)
+                    except (ValueError, TypeError, AttributeError):
+                        pass  # Not a request, ignore it
+                elif opcode == PING:
+                    writer.write(encode_frame(PONG, payload))
+                elif opcode == CLOSE:
+                    writer.write(encode_frame(CLOSE, payload[:2]))
+                    return
+        finally:
+            self.viewers.discard(viewer)
+
+    async def _get(self, path, query):
+        # Returns the status and the JSON body of a GET request
+        parts = path.strip('/').split('/')
+        if parts == ['plants']:
+            return 200, json.dumps({'plants': self.plant_ids, 'depth': self.store.depth})
+        if parts == ['fleet']:
+            counts = self.store.counts.copy()
+            return 200, fleet_json(self.store.latest(counts), counts, np.flatnonzero(counts > 0))
+        if parts == ['stats']:
+            return 200, json.dumps(self.stats())
+        if len(parts) != 2 or parts[1] not in self.slots:
+            return 404, json.dumps({'error': 'not found'})
+        if parts[0] == 'plants':
+            return 200, plant_json(parts[1], *self.store.since(self.slots[parts[1]], 0))
+        if parts[0] == 'history' and self.history is not None:
+            end = int(query.get('end', [time.time_ns()])[0])
+            start = int(query.get('start', [end - 86400 * 10 ** 9])[0])
+            max_points = int(query.get('max_points', [500])[0])
+            # Reads disk, keep the frames going meanwhile
+            history = await asyncio.get_running_loop().run_in_executor(
+                None, self.history.query, self.slots[parts[1]] + 1, start, end, max_points)
+            if history is not None:
+                return 200, history_json(history)
+        return 404, json.dumps({'error': 'not found'})
+
+    async def _handle(self, reader, writer):
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            url = urllib.parse.urlsplit(target)
+            if url.path == '/ws' and headers.get('upgrade', '').lower() == 'websocket':
+                await self._websocket(reader, writer, headers)
+                return
+            content_type = 'application/json'
+            if method != 'GET':
+                status, body = 405, json.dumps({'error': 'only GET'})
+            elif url.path == '/metrics' and self.metrics is not None:
+                status, body, content_type = 200, self.metrics.render(), CONTENT_TYPE
+            else:
+                try:
+                    status, body = await self._get(url.path, urllib.parse.parse_qs(url.query))
+                except ValueError:
+                    status, body = 400, json.dumps({'error': 'bad request'})
+            body = body.encode()
+            writer.write((f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n'
+                          f'Content-Type: {content_type}\r\n'
+                          f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n').encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        pusher = asyncio.ensure_future(self._push())
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            pusher.cancel()
+
+    def start(self):
+        """Run the server on a background thread and return once it listens."""
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port))
+            self.port = self._server.sockets[0].getsockname()[1]
+            self._pusher = self._loop.create_task(self._push())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._pusher.cancel)
+            self._loop.call_soon_threadsafe(self._server.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve live plant sensor data to many viewers.")
+    parser.add_argument("--plants", type=int, default=100, help="number of plants to keep data for")
+    parser.add_argument("--history", type=int, default=50, help="samples of history kept per plant")
+    parser.add_argument("--history-dir", default="history",
+                        help="directory of the persistent history of every plant (empty to disable)")
+    parser.add_argument("--ingest-workers", type=int, default=0,
+                        help="decode the sensor data in this many worker processes (0 to decode in process)")
+    parser.add_argument("--source", choices=("aws", "mqtt"), default="aws",
+                        help="AWS IoT Core or a plain MQTT broker such as local_broker.py")
+    parser.add_argument("--broker-host", default="127.0.0.1", help="MQTT broker of --source mqtt")
+    parser.add_argument("--broker-port", type=int, default=1883, help="MQTT broker port of --source mqtt")
+    parser.add_argument("--host", default="127.0.0.1", help="address to serve the viewers on")
+    parser.add_argument("--port", type=int, default=8765, help="port to serve the viewers on")
+    parser.add_argument("--frame-interval", type=float, default=FRAME_INTERVAL,
+                        help="seconds between two frames pushed to the viewers")
+    args = parser.parse_args()
+
+    plant_ids = [f'plant_{i + 1}' for i in range(args.plants)]
+    source = ('aws',) if args.source == 'aws' else ('mqtt', args.broker_host, args.broker_port)
+    ingest_tier = disconnect = None
+    metrics = Registry()
+    if args.ingest_workers:
+        ingest_tier = IngestTier(args.ingest_workers, len(plant_ids), args.history, source,
+                                 args.history_dir or None)
+        store = ingest_tier.store
+        history = ingest_tier if args.history_dir else None
+        ingest_tier.register(metrics)
+    else:
+        store = RingStore(capacity=len(plant_ids), depth=args.history)
+        history = HistoryStore(args.history_dir) if args.history_dir else None
+        disconnect = connect(source, 0, Ingestor(store, history=history, metrics=IngestMetrics(metrics)))
+
+    server = MonitorServer(store, plant_ids, history, args.host, args.port, args.frame_interval, metrics=metrics)
+    print(f"Monitor server listening on {args.host}:{args.port}")
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        print("Monitor server stopped.")
+    finally:
+        if ingest_tier is not None:
+            ingest_tier.close()
+        else:
+            disconnect()
+            if history is not None:
+                history.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+import json
+import math
+import struct
+import time
+from datetime import datetime
+import numpy as np
+
+
+# Topics of the readings: every message on the flat DATA_TOPIC, or the
+# readings of each plant on plant_topic(plant_id) next to a low-rate summary
+# of the whole fleet on AGGREGATE_TOPIC, so a subscriber can take only the
+# plants it shows
+DATA_TOPIC = "sensor/data"
+AGGREGATE_TOPIC = "sensor/aggregate"
+
+# Keys of a single reading, in the order they are sent
+READING_FIELDS = ("plant_id", "temperature", "humidity", "water_level", "time", "ts")
+
+# Content types of the two wire formats
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_BINARY = "application/vnd.plant-reading.v1"
+
+# Binary format, version 1, little endian:
+#   header: magic byte, format version, number of records
+#   record: plant index (the N of plant_N), temperature, humidity and
+#           water level as float32, time as int64 nanoseconds since the epoch
+# The magic byte can never start a JSON text, so both formats can share a topic.
+BINARY_MAGIC = 0xB7
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<BBH')
+BINARY_RECORD = struct.Struct('<Ifffq')
+# The same record as a NumPy dtype, to decode a whole batch in one call
+BINARY_DTYPE = np.dtype([('plant', '<u4'), ('temperature', '<f4'), ('humidity', '<f4'),
+                         ('water_level', '<f4'), ('ts', '<i8')])
+# Largest number of records the header can count
+BINARY_MAX_RECORDS = 0xFFFF
+
+CTIME_FORMAT = "%a %b %d %H:%M:%S %Y"
+
+# Fields a device reporting by exception may leave out of a delta
+DELTA_FIELDS = ("temperature", "humidity", "water_level")
+
+
+def plant_topic(plant_id):
+    """Topic of the readings of one plant."""
+    return f"{DATA_TOPIC}/{plant_id}"
+
+
+def plant_index(plant_id):
+    """Return the number N of a 'plant_N' id."""
+    prefix, _, number = plant_id.rpartition('_')
+    if prefix != 'plant' or not number.isdigit():
+        raise ValueError(f"{plant_id!r} is not a plant_N id")
+    return int(number)
+
+
+def encode_reading(plant_id, temperature, humidity, water_level, timestamp, ts=None, seq=None):
+    """Encode one plant reading as the original per-plant JSON message.
+
+    ts is the reading time in nanoseconds since the epoch, it is sent next to
+    the human readable time so subscribers do not have to parse it. seq, when
+    given, is the publisher's message sequence number, for subscribers to
+    detect lost messages.
+    """
+    message = {
+        "plant_id": plant_id,
+        "temperature": temperature,
+        "humidity": humidity,
+        "water_level": water_level,
+        "time": timestamp,
+        "ts": time.time_ns() if ts is None else ts
+    }
+    if seq is not None:
+        message["seq"] = seq
+    return json.dumps(message)
+
+
+def encode_batch(plant_ids, temperatures, humidities, water_levels, timestamp, ts=None, seq=None):
+    """Encode the readings of many plants as one columnar JSON message.
+
+    Every key is sent once and each column holds one value per plant, so the
+    message stays small compared to the same readings sent one by one.
+    All readings of a tick share the same timestamp.
+    """
+    message = {
+        "plant_id": list(plant_ids),
+        "temperature": list(temperatures),
+        "humidity": list(humidities),
+        "water_level": list(water_levels),
+        "time": timestamp,
+        "ts": time.time_ns() if ts is None else ts
+    }
+    if seq is not None:
+        message["seq"] = seq
+    return json.dumps(message)
+
+
+def encode_binary(plant_ids, temperatures, humidities, water_levels, ts):
+    """Encode one or more readings in the fixed layout binary format.
+
+    ts is either one epoch nanoseconds value shared by all readings or one
+    value per reading.
+    """
+    count = len(plant_ids)
+    if count > BINARY_MAX_RECORDS:
+        raise ValueError(f"at most {BINARY_MAX_RECORDS} readings fit in one message")
+    if np.ndim(ts) == 0:
+        ts = [int(ts)] * count
+    buffer = bytearray(BINARY_HEADER.size + count * BINARY_RECORD.size)
+    BINARY_HEADER.pack_into(buffer, 0, BINARY_MAGIC, BINARY_VERSION, count)
+    offset = BINARY_HEADER.size
+    for record in zip(map(plant_index, plant_ids), temperatures, humidities, water_levels, ts):
+        BINARY_RECORD.pack_into(buffer, offset, *record)
+        offset += BINARY_RECORD.size
+    return bytes(buffer)
+
+
+def content_type(raw):
+    """Tell which wire format a raw payload uses from its first byte."""
+    if raw[:1] == bytes([BINARY_MAGIC]):
+        return CONTENT_TYPE_BINARY
+    return CONTENT_TYPE_JSON
+
+
+def decode_binary(raw):
+    """Decode a binary payload into a list of per-plant readings."""
+    magic, version, count = BINARY_HEADER.unpack_from(raw)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"unsupported binary payload version {version}")
+    end = BINARY_HEADER.size + count * BINARY_RECORD.size
+    return [
+        {
+            "plant_id": f"plant_{index}",
+            "temperature": temperature,
+            "humidity": humidity,
+            "water_level": water_level,
+            "ts": ts
+        }
+        for index, temperature, humidity, water_level, ts in BINARY_RECORD.iter_unpack(
+            memoryview(raw)[BINARY_HEADER.size:end])
+    ]
+
+
+def is_batch(payload):
+    """Return True if a decoded message carries a batch of readings."""
+    return isinstance(payload.get("temperature"), list)
+
+
+def split_batch(payload):
+    """Split a decoded batch message back into per-plant readings.
+
+    The simulator sends one plant id per reading and one ts for the batch;
+    a device sends its buffered readings with its own plant id once and
+    one ts per reading.
+    """
+    count = len(payload["temperature"])
+    plant_ids = payload["plant_id"]
+    if not isinstance(plant_ids, list):
+        plant_ids = [plant_ids] * count
+    timestamp = payload.get("time")
+    ts = payload.get("ts")
+    ts = ts if isinstance(ts, list) else [ts] * count
+    return [
+        {
+            "plant_id": plant_id,
+            "temperature": temperature,
+            "humidity": humidity,
+            "water_level": water_level,
+            "time": timestamp,
+            "ts": reading_ts
+        }
+        for plant_id, temperature, humidity, water_level, reading_ts in zip(
+            plant_ids, payload["temperature"], payload["humidity"], payload["water_level"], ts)
+    ]
+
+
+class ReportState:
+    """Last full report of every device reporting by exception.
+
+    Such a device sends its readings as deltas against its last acknowledged
+    full report, named by its ts in "base": fields that stayed within their
+    deadband are null. The message lists the positions of its own full
+    reports in "full", the last one becomes the base of the next messages.
+    Fields of a delta whose base is unknown, e.g. after a restart, are NaN
+    until the device's next full report.
+
+    lamda/lamda_func.py rebuilds deltas the same way in fill_deltas, keep the
+    two in step: the lambda is deployed on its own and cannot import this.
+    """
+
+    def __init__(self):
+        self.bases = {}
+
+    def fill(self, payload):
+        """Replace the null fields of a delta message with those of its base, in place."""
+        plant_id = payload["plant_id"]
+        known = self.bases.get(plant_id)
+        base = known[1] if known is not None and known[0] == payload.get("base") else {}
+        for name in DELTA_FIELDS:
+            payload[name] = [base.get(name, math.nan) if value is None else value for value in payload[name]]
+        if payload["full"]:
+            last = payload["full"][-1]
+            self.bases[plant_id] = (payload["ts"][last], {name: payload[name][last] for name in DELTA_FIELDS})
+
+
+def decode_payload(raw, state=None):
+    """Decode a raw MQTT payload into a list of per-plant readings.
+
+    Works for the binary format and for both the per-plant and the batched
+    JSON message, so subscribers do not need to know which mode the simulator
+    runs in. Every reading gets a 'ts' in nanoseconds since the epoch.
+    Delta messages of devices reporting by exception are rebuilt with state,
+    a ReportState kept by the subscriber.
+    """
+    if content_type(raw) == CONTENT_TYPE_BINARY:
+        return decode_binary(raw)
+    payload = json.loads(raw)
+    if "full" in payload:
+        (state or ReportState()).fill(payload)
+    readings = split_batch(payload) if is_batch(payload) else [payload]
+    for reading in readings:
+        if reading.get("ts") is None:
+            # Older senders only have the ctime string, with 1 second resolution
+            reading["ts"] = int(datetime.strptime(reading["time"], CTIME_FORMAT).timestamp()) * 1_000_000_000
+    return readings
+
+
+def chunks(items, size):
+    """Yield consecutive slices of items with at most size elements each."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def binary_records(raw):
+    """View the records of a binary payload as a structured array of BINARY_DTYPE, without copying."""
+    magic, version, count = BINARY_HEADER.unpack_from(raw)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"unsupported binary payload version {version}")
+    return np.frombuffer(raw, dtype=BINARY_DTYPE, count=count, offset=BINARY_HEADER.size)
+
+
+def record_columns(records):
+    """The columns of decode_columns from binary records."""
+    return (records['plant'].astype(np.int64), records['temperature'], records['humidity'],
+            records['water_level'], records['ts'])
+
+
+def decode_columns(raw, state=None):
+    """Decode a raw MQTT payload into whole columns of readings.
+
+    Returns the plant indices, temperatures, humidities, water levels and
+    epoch nanosecond timestamps as NumPy arrays. A binary batch is decoded
+    without a Python loop over its records. state is passed on to decode_payload.
+    """
+    if content_type(raw) == CONTENT_TYPE_BINARY:
+        return record_columns(binary_records(raw))
+    readings = decode_payload(raw, state)
+    return (np.array([plant_index(r['plant_id']) for r in readings], dtype=np.int64),
+            np.array([r['temperature'] for r in readings], dtype=np.float32),
+            np.array([r['humidity'] for r in readings], dtype=np.float32),
+            np.array([r['water_level'] for r in readings], dtype=np.float32),
+            np.array([r['ts'] for r in readings], dtype=np.int64))
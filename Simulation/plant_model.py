@@ -0,0 +1,129 @@
+import collections
+import math
+import numpy as np
+
+
+# Commands of the lambda's rules and the actuator each one switches on
+PUMP, HEATER, COOLER, HUMIDIFIER = 1, 21, 22, 3
+ACTUATORS = {PUMP: 'pump', HEATER: 'heater', COOLER: 'cooler', HUMIDIFIER: 'humidifier'}
+
+# Water level, in sensor units: starting range, depletion per second at
+# AMBIENT and how much faster per degree above it, pump refill per second,
+# the level at which the pump stops and the most the pot holds
+WATER_LEVEL_RANGE = (33000, 36000)
+DEPLETION_RANGE = (2.0, 8.0)
+DEPLETION_PER_DEGREE = 0.05
+PUMP_RATE = 100.0
+PUMP_TARGET = 35500.0
+WATER_LEVEL_MAX = 40000.0
+
+# Temperature in Celsius: mean and spread of the plants' ambient temperature,
+# how much the heater or cooler moves it, relaxation time in seconds and the
+# standard deviation of the noise around the equilibrium
+AMBIENT = 23.5
+AMBIENT_SPREAD = 0.5
+HEATER_POWER = 1.0
+TEMPERATURE_TAU = 120.0
+TEMPERATURE_NOISE = 0.1
+
+# Relative humidity in percent: mean and spread of the plants' own level, its
+# drop per degree above AMBIENT, the level the humidifier holds, relaxation
+# time in seconds and noise
+HUMIDITY = 60.5
+HUMIDITY_SPREAD = 0.5
+HUMIDITY_PER_DEGREE = 1.5
+HUMIDITY_SETPOINT = 60.5
+HUMIDITY_TAU = 60.0
+HUMIDITY_NOISE = 0.1
+
+# Seconds an actuator runs per command at most, the pump stops earlier at PUMP_TARGET
+ACTUATION_SECONDS = {PUMP: 60.0, HEATER: 120.0, COOLER: 120.0, HUMIDIFIER: 120.0}
+
+
+class PlantModel:
+    """State of many simulated plants, advanced together one tick at a time.
+
+    Every plant has a water level, a temperature and a humidity, each in an
+    array with one element per plant, and four actuators switched on by the
+    lambda's commands. step(dt) advances all plants by dt seconds with
+    array operations, no Python loop over the plants:
+
+    * the water level drops at the plant's own rate, faster when it is warm,
+      and rises while the pump runs, for the part of the tick it ran;
+    * the temperature relaxes towards the plant's ambient temperature, moved
+      up by the heater or down by the cooler while they run;
+    * the humidity relaxes towards the plant's own level, lower when it is
+      warm, or towards HUMIDITY_SETPOINT while the humidifier runs.
+
+    Temperature and humidity are Ornstein-Uhlenbeck processes, their noise
+    is scaled to dt so the spread does not depend on the tick length.
+    command() can be called from any thread: commands are queued and applied
+    at the start of the next step, which is the only writer of the arrays.
+    """
+
+    def __init__(self, count, seed=None):
+        self.count = count
+        self.rng = np.random.default_rng(seed)
+        # Seconds of simulated time since the start, actuators run until a time on this clock
+        self.time = 0.0
+        self.water_levels = self.rng.uniform(*WATER_LEVEL_RANGE, count)
+        self.depletion = self.rng.uniform(*DEPLETION_RANGE, count)
+        self.ambient = self.rng.normal(AMBIENT, AMBIENT_SPREAD, count)
+        self.temperatures = self.ambient.copy()
+        self.humidity_levels = self.rng.normal(HUMIDITY, HUMIDITY_SPREAD, count)
+        self.humidities = self.humidity_levels.copy()
+        self.running_until = {command: np.zeros(count) for command in ACTUATORS}
+        self.commands = collections.deque()
+        self.applied = 0
+
+    def command(self, position, command):
+        """Queue a command for the plant at position, or for every plant when position is None."""
+        if command not in ACTUATORS:
+            raise ValueError(f"unknown command {command!r}, use one of {sorted(ACTUATORS)}")
+        self.commands.append((position, command))
+
+    def _apply_commands(self):
+        while self.commands:
+            position, command = self.commands.popleft()
+            target = slice(None) if position is None else position
+            self.running_until[command][target] = self.time + ACTUATION_SECONDS[command]
+            self.applied += 1
+
+    def running(self, command):
+        """Boolean array of the plants whose actuator of command is running."""
+        return self.running_until[command] > self.time
+
+    def step(self, dt):
+        """Advance every plant by dt seconds."""
+        self._apply_commands()
+        start = self.time
+        self.time += dt
+        # Seconds of this tick each actuator ran for
+        pumped = np.clip(self.running_until[PUMP] - start, 0.0, dt)
+        heating = self.running_until[HEATER] > start
+        cooling = self.running_until[COOLER] > start
+        humidifying = self.running_until[HUMIDIFIER] > start
+
+        warmth = self.temperatures - AMBIENT
+        self.water_levels -= self.depletion * dt * np.maximum(1.0 + DEPLETION_PER_DEGREE * warmth, 0.0)
+        self.water_levels += PUMP_RATE * pumped
+        np.clip(self.water_levels, 0.0, WATER_LEVEL_MAX, out=self.water_levels)
+        # The pump's float switch
+        full = self.water_levels >= PUMP_TARGET
+        self.running_until[PUMP][full] = np.minimum(self.running_until[PUMP][full], self.time)
+
+        equilibrium = self.ambient + HEATER_POWER * (heating.astype(np.float64) - cooling)
+        self._relax(self.temperatures, equilibrium, TEMPERATURE_TAU, TEMPERATURE_NOISE, dt)
+        equilibrium = np.where(humidifying, HUMIDITY_SETPOINT, self.humidity_levels - HUMIDITY_PER_DEGREE * warmth)
+        self._relax(self.humidities, equilibrium, HUMIDITY_TAU, HUMIDITY_NOISE, dt)
+
+    def _relax(self, values, equilibrium, tau, noise, dt):
+        # Exact Ornstein-Uhlenbeck update over dt, in place
+        decay = math.exp(-dt / tau)
+        values *= decay
+        values += (1.0 - decay) * equilibrium
+        values += noise * math.sqrt(1.0 - decay * decay) * self.rng.standard_normal(self.count)
+
+    def readings(self, index=slice(None)):
+        """Temperatures, humidities and water levels of the plants at index, as new arrays."""
+        return self.temperatures[index].copy(), self.humidities[index].copy(), self.water_levels[index].copy()
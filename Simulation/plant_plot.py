@@ -0,0 +1,215 @@
+from datetime import datetime
+import matplotlib.dates as mdates
+import numpy as np
+from downsample import MinMaxDownsampler, lttb
+
+
+# Plotted metrics of a plant window, top to bottom, with their axis labels
+PLOTS = (
+    ('temperatures', 'Temperature (°C)'),
+    ('humidities', 'Humidity (%)'),
+    ('water_levels', 'Water Level (%)'),
+)
+
+# Share of the current span added past the newest sample when the time axis is moved
+TIME_HEADROOM = 0.25
+# Share of the value range added above and below when a value axis is rescaled
+VALUE_MARGIN = 0.1
+
+NANOSECONDS_PER_DAY = 86_400 * 10 ** 9
+
+# Lines with more samples than this many per pixel of axes width are downsampled
+SAMPLES_PER_PIXEL = 2
+
+
+class PlantPlot:
+    """The three plots of one plant window, updated incrementally.
+
+    The axes, labels and layout are set up once. Each plot keeps one Line2D
+    artist whose data is replaced with set_data; the line is animated, so it
+    is left out of full redraws and drawn on top of a cached background
+    instead (blitting). A full redraw only happens when a sample falls outside
+    the current axis limits, and nothing is drawn at all when the plant has
+    no new sample.
+
+    With a RollingStats, each plot also shows the plant's rolling statistics
+    as a line of text, read from it as they are and drawn like the lines.
+    """
+
+    def __init__(self, plant_id, store, slot, fig, axs, canvas, analytics=None):
+        self.store = store
+        self.analytics = analytics
+        self.slot = slot
+        self.fig = fig
+        self.axs = axs
+        self.canvas = canvas
+        self.drawn_count = 0
+        self.background = None
+        # Bands of a history view; live updates pause while one is shown
+        self.bands = None
+        # One min/max downsampler per line while lines are longer than the canvas is wide
+        self.downsamplers = None
+        self.bucket_width = None
+
+        fig.suptitle(f"{plant_id} Data", fontsize='large')
+        self.lines = []
+        for ax, (_, ylabel) in zip(axs, PLOTS):
+            ax.set_ylabel(ylabel)
+            line, = ax.plot([], [], marker='o', linestyle='-', animated=True)
+            self.lines.append(line)
+        self.readouts = []
+        if analytics is not None:
+            for ax in axs:
+                self.readouts.append(ax.text(0.01, 0.95, '', transform=ax.transAxes, va='top', fontsize='small',
+                                             animated=True))
+        axs[-1].set_xlabel('Time')
+        axs[-1].xaxis_date()
+        axs[-1].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S', tz=datetime.now().astimezone().tzinfo))
+        # Adjust subplot spacing and format the x-axis labels once
+        fig.subplots_adjust(hspace=0.4, bottom=0.15)
+        fig.autofmt_xdate()
+
+        # A full redraw (resize, rescale) renders everything but the lines, keep it as background
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_lines()
+
+    def _draw_lines(self):
+        for ax, line in zip(self.axs, self.lines):
+            ax.draw_artist(line)
+        for ax, readout in zip(self.axs, self.readouts):
+            ax.draw_artist(readout)
+
+    def _update_readouts(self):
+        stats = self.analytics.stats(self.slot)
+        for i, readout in enumerate(self.readouts):
+            readout.set_text(f"mean {stats['mean'][i]:.2f} ± {stats['std'][i]:.2f}   "
+                             f"ewma {stats['ewma'][i]:.2f}   min {stats['min'][i]:.2f}   "
+                             f"max {stats['max'][i]:.2f}   z {stats['z'][i]:+.1f}")
+            readout.set_color('red' if stats['anomaly'][i] else 'black')
+
+    def _rescale(self, x, columns, fit=False):
+        """Move axis limits that no longer hold the data, return True if any moved.
+
+        With fit the limits are set from the data whether they hold it or not.
+        """
+        moved = False
+        left, right = self.axs[-1].get_xlim()
+        if fit or x[0] < left or x[-1] > right:
+            span = max(x[-1] - x[0], 1 / 86_400)
+            self.axs[-1].set_xlim(x[0], x[-1] + span * TIME_HEADROOM)
+            moved = True
+        for ax, values in zip(self.axs, columns):
+            bottom, top = ax.get_ylim()
+            low, high = float(np.nanmin(values)), float(np.nanmax(values))
+            if fit or low < bottom or high > top:
+                margin = max(high - low, abs(high) * 1e-3, 1e-3) * VALUE_MARGIN
+                ax.set_ylim(low - margin, high + margin)
+                moved = True
+        return moved
+
+    def update(self):
+        """Redraw the plots if a new sample arrived, return True if anything was drawn."""
+        count = self.store.count(self.slot)
+        if count == self.drawn_count or self.bands is not None:
+            return False
+        history = self.store.snapshot(self.slot)
+        if not len(history['timestamps']):
+            return False
+        fit = not self.drawn_count
+        new_samples = count - self.drawn_count
+        self.drawn_count = count
+
+        # Matplotlib date numbers are days since the epoch
+        x = history['timestamps'].view(np.int64) / NANOSECONDS_PER_DAY
+        points = self._points(x, history, new_samples)
+        for line, (line_x, line_y) in zip(self.lines, points):
+            line.set_data(line_x, line_y)
+        if self.readouts:
+            self._update_readouts()
+
+        if self._rescale(x, [line_y for _, line_y in points], fit=fit) or self.background is None:
+            if self.downsamplers is not None:
+                # Buckets follow the pixels, which moved with the limits
+                for line, (line_x, line_y) in zip(self.lines, self._points(x, history, None)):
+                    line.set_data(line_x, line_y)
+            # Limits changed, render the axes again; the draw event blits the lines
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self._draw_lines()
+            for ax in self.axs:
+                self.canvas.blit(ax.bbox)
+        return True
+
+    def _points(self, x, history, new_samples):
+        """Return the x and y to draw for every line.
+
+        Lines with more samples than the axes are wide are reduced to the min
+        and max of each pixel column. Only the new_samples latest samples are
+        folded into the existing buckets; None recomputes them all.
+        """
+        width = max(int(self.axs[-1].bbox.width), 1)
+        if len(x) <= width * SAMPLES_PER_PIXEL:
+            if self.downsamplers is not None:
+                self.downsamplers = None
+                for line in self.lines:
+                    line.set_marker('o')
+            return [(x, history[name]) for name, _ in PLOTS]
+
+        left, right = self.axs[-1].get_xlim()
+        bucket_width = (right - left) / width
+        if (self.downsamplers is None or new_samples is None or new_samples >= len(x)
+                or bucket_width != self.bucket_width):
+            self.downsamplers = [MinMaxDownsampler(bucket_width, left) for _ in PLOTS]
+            self.bucket_width = bucket_width
+            new_samples = len(x)
+            # Markers would only merge into a blob
+            for line in self.lines:
+                line.set_marker('')
+        points = []
+        for downsampler, (name, _) in zip(self.downsamplers, PLOTS):
+            downsampler.extend(x[-new_samples:], history[name][-new_samples:])
+            downsampler.trim(x[0])
+            points.append(downsampler.points())
+        return points
+
+    def show_history(self, history):
+        """Show a HistoryStore.query result instead of the live samples.
+
+        The mean is drawn as the line and the min/max range as a band around
+        it; live updates pause until show_live is called.
+        """
+        self._remove_bands()
+        x = history['ts'] / NANOSECONDS_PER_DAY
+        width = max(int(self.axs[-1].bbox.width), 1)
+        self.bands = []
+        for i, (ax, line) in enumerate(zip(self.axs, self.lines)):
+            if history['resolution'] == 0 and len(x) > width:
+                # Raw samples, keep the shape of the line at one point per pixel
+                line.set_data(*lttb(x, history['mean'][:, i], width))
+            else:
+                line.set_data(x, history['mean'][:, i])
+            line.set_marker('o' if history['resolution'] == 0 and len(x) <= width else '')
+            self.bands.append(ax.fill_between(x, history['min'][:, i], history['max'][:, i], alpha=0.3))
+        if len(x):
+            self._rescale(x, [np.concatenate([history['min'][:, i], history['max'][:, i]])
+                              for i in range(len(self.axs))], fit=True)
+        self.canvas.draw()
+
+    def show_live(self):
+        """Go back to the live samples of the store."""
+        self._remove_bands()
+        for line in self.lines:
+            line.set_marker('o')
+        self.drawn_count = 0
+        self.downsamplers = None
+        if not self.update():
+            self.canvas.draw()
+
+    def _remove_bands(self):
+        for band in self.bands or ():
+            band.remove()
+        self.bands = None
@@ -0,0 +1,183 @@
+"""Publishing to several brokers without one holding up the others.
+
+Every broker is a Sink with its own bounded queue and a small pool of
+connections, each drained by a sender thread. Publisher.publish encodes a
+payload once and offers the same bytes to every sink, so a slow broker only
+fills its own queue; what happens then is the sink's policy:
+
+* 'block' waits for room, slowing the caller down to the broker's pace;
+* 'drop-new' drops the message being published;
+* 'drop-oldest' drops the oldest queued message to make room, so what gets
+  through is as fresh as possible.
+
+A connection has at most max_inflight messages handed to paho and not
+done yet: not yet written to the socket at QoS 0, not yet acknowledged at
+QoS 1 and 2. paho's own outbound queue therefore stays bounded too.
+"""
+import queue
+import threading
+import time
+import paho.mqtt.client as mqtt
+
+
+POLICIES = ('block', 'drop-new', 'drop-oldest')
+
+# Per sink counters, see Sink.stats
+STATS = ('offered', 'published', 'queued', 'inflight', 'dropped', 'failed')
+
+
+class Connection:
+    """One client of a sink and its in-flight accounting."""
+
+    def __init__(self, client, qos):
+        self.client = client
+        self.qos = qos
+        self.inflight = 0
+        self.published = 0
+        self.failed = 0
+        self.condition = threading.Condition()
+        client.on_publish = self._on_publish
+        client.on_disconnect = self._on_disconnect
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        with self.condition:
+            self.inflight = max(self.inflight - 1, 0)
+            self.published += 1
+            self.condition.notify()
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        if self.qos == 0:
+            # Unsent QoS 0 messages are gone, QoS 1 and 2 ones are sent again on reconnect
+            with self.condition:
+                self.failed += self.inflight
+                self.inflight = 0
+                self.condition.notify()
+
+
+class Sink:
+    """A broker published to through connections pooled behind one bounded queue.
+
+    connect() returns a new connected client with its network loop started,
+    it is called once per connection. paho holds back QoS 1 and 2 messages
+    beyond its own in-flight limit, 20 unless set before connecting.
+    """
+
+    def __init__(self, name, connect, connections=1, queue_size=1000, policy='block', qos=0, max_inflight=20):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown policy {policy!r}, use one of {POLICIES}")
+        self.name = name
+        self.policy = policy
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.queue = queue.Queue(queue_size)
+        self.offered = 0
+        self.dropped = 0
+        self.connections = []
+        for _ in range(connections):
+            self.connections.append(Connection(connect(), qos))
+        self.threads = [threading.Thread(target=self._send, args=(connection,), name=f'{name}-sender-{i}',
+                                         daemon=True)
+                        for i, connection in enumerate(self.connections)]
+        for thread in self.threads:
+            thread.start()
+
+    def offer(self, topic, payload):
+        """Queue a message following the policy, return False if it was dropped."""
+        self.offered += 1
+        if self.policy == 'block':
+            self.queue.put((topic, payload))
+            return True
+        while True:
+            try:
+                self.queue.put_nowait((topic, payload))
+                return True
+            except queue.Full:
+                if self.policy == 'drop-new':
+                    self.dropped += 1
+                    return False
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+
+    def _send(self, connection):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            with connection.condition:
+                while connection.inflight >= self.max_inflight:
+                    connection.condition.wait()
+                connection.inflight += 1
+            info = connection.client.publish(message[0], message[1], qos=self.qos)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                with connection.condition:
+                    connection.inflight -= 1
+                    connection.failed += 1
+
+    def stats(self):
+        """Messages offered, published (written at QoS 0, acknowledged above), queued, in flight,
+        dropped by the policy and failed to publish, as a dict."""
+        return {
+            'offered': self.offered,
+            'published': sum(connection.published for connection in self.connections),
+            'queued': self.queue.qsize(),
+            'inflight': sum(connection.inflight for connection in self.connections),
+            'dropped': self.dropped,
+            'failed': sum(connection.failed for connection in self.connections),
+        }
+
+    def close(self, timeout=5.0):
+        """Send what is queued, for at most timeout seconds in all, then disconnect.
+
+        Messages still queued when the time is up are dropped to make room
+        for the senders' stop markers, so a full queue in front of a dead
+        broker cannot hold close up.
+        """
+        deadline = time.monotonic() + timeout
+        for _ in self.threads:
+            while True:
+                try:
+                    self.queue.put(None, timeout=max(deadline - time.monotonic(), 0))
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+        for thread in self.threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        for connection in self.connections:
+            with connection.condition:
+                connection.condition.wait_for(lambda: not connection.inflight, max(deadline - time.monotonic(), 0))
+            connection.client.loop_stop()
+            connection.client.disconnect()
+
+
+class Publisher:
+    """Publishes every message to all its sinks, each at its own pace."""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def publish(self, topic, payload):
+        """Offer a message to every sink, encoded once; return how many sinks took it."""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        return sum(sink.offer(topic, payload) for sink in self.sinks)
+
+    def stats(self):
+        return {sink.name: sink.stats() for sink in self.sinks}
+
+    def register(self, registry, prefix='simulator'):
+        """Export the counters of every sink as gauges of a metrics Registry, labelled by sink."""
+        for name in STATS:
+            family = registry.gauge(f'{prefix}_sink_{name}', f"Messages {name} per sink", labels=('sink',))
+            for sink in self.sinks:
+                family.labels(sink.name).fn = lambda sink=sink, name=name: sink.stats()[name]
+
+    def close(self, timeout=5.0):
+        for sink in self.sinks:
+            sink.close(timeout)
@@ -0,0 +1,413 @@
+"""Record the MQTT traffic of the plants and replay it offline.
+
+The recorder captures every message on sensor/data, the per-plant topics
+below it, sensor/aggregate and sensor/command into an append-only log, with the time each one was received:
+
+* <path>.log holds the messages back to back, each one its topic followed
+  by its raw payload, after a magic header;
+* <path>.idx holds one fixed-width INDEX_DTYPE record per message: receive
+  time, position and lengths in the log, kind, and the range of plant
+  indices it carries, computed once at record time.
+
+The index is sorted by receive time, so seeking to a time is a binary search
+on a memory map, and seeking to a plant one array comparison over it; the
+log is only read for the messages selected. A crash loses at most the
+messages still buffered, reopening drops index records the log does not
+cover.
+
+The replayer feeds a selection back, at the recorded pace, N times faster
+or as fast as possible, into the monitor's ingest (what customCallback
+does), into lamda_func.lambda_handler or onto a broker:
+
+    python recording.py record capture --source mqtt --duration 60
+    python recording.py info capture
+    python recording.py replay capture --to monitor --speed 0
+    python recording.py replay capture --to lambda --from 30 --until 90 --plant 7
+    python recording.py replay capture --to broker --broker-port 1883 --speed 10
+"""
+import argparse
+import base64
+import json
+import mmap
+import os
+import sys
+import threading
+import time
+import numpy as np
+from payloads import (plant_index, content_type, CONTENT_TYPE_BINARY, BINARY_DTYPE, BINARY_HEADER, DATA_TOPIC,
+                      AGGREGATE_TOPIC)
+from ingest import Ingestor, single_plant
+
+
+COMMAND_TOPIC = "sensor/command"
+
+LOG_MAGIC = b'PLNTREC1'
+INDEX_MAGIC = b'PLNTIDX1'
+
+# Message kinds of the index
+DATA = 0
+COMMAND = 1
+AGGREGATE = 2
+KINDS = {'data': DATA, 'command': COMMAND, 'aggregate': AGGREGATE}
+# Topic filters recorded
+TOPICS = (DATA_TOPIC + '/#', AGGREGATE_TOPIC, COMMAND_TOPIC)
+
+# One recorded message. plant_low and plant_high bound the plant indices it
+# carries, 0 for both when they are unknown: such a message matches any plant.
+INDEX_DTYPE = np.dtype([('received', '<i8'), ('offset', '<i8'), ('topic_length', '<u2'), ('length', '<u4'),
+                        ('kind', 'u1'), ('plant_low', '<u4'), ('plant_high', '<u4')])
+
+NANOSECONDS = 10 ** 9
+
+
+def plant_range(kind, raw):
+    """Lowest and highest plant index of a message, (0, 0) if it cannot be told."""
+    try:
+        if kind != COMMAND and content_type(raw) == CONTENT_TYPE_BINARY:
+            count = BINARY_HEADER.unpack_from(raw)[2]
+            plants = np.frombuffer(raw, dtype=BINARY_DTYPE, count=count, offset=BINARY_HEADER.size)['plant']
+            return (int(plants.min()), int(plants.max())) if count else (0, 0)
+        if kind != COMMAND:
+            index = single_plant(raw)
+            if index is not None:
+                return index, index
+        plant_ids = json.loads(raw).get('plant_id')
+        if plant_ids is None:
+            return 0, 0
+        indices = [plant_index(plant_id) for plant_id in
+                   (plant_ids if isinstance(plant_ids, list) else [plant_ids])]
+        return min(indices), max(indices)
+    except (ValueError, TypeError, AttributeError):
+        return 0, 0
+
+
+class Recorder:
+    """Appends messages to a recording, creating it if needed.
+
+    record() may be called from several threads, e.g. the callbacks of two
+    subscriptions; the messages are written in the order it is called.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.log = open(path + '.log', 'ab')
+        self.index = open(path + '.idx', 'ab')
+        if self.log.tell() == 0:
+            self.log.write(LOG_MAGIC)
+        if self.index.tell() == 0:
+            self.index.write(INDEX_MAGIC)
+        self.offset = self.log.tell()
+        # Receive time of the last message, the index stays sorted when appending to a recording
+        size = self.index.tell() - len(INDEX_MAGIC)
+        self.last = 0
+        if size >= INDEX_DTYPE.itemsize:
+            last = np.fromfile(path + '.idx', dtype=INDEX_DTYPE, count=1,
+                               offset=len(INDEX_MAGIC) + (size // INDEX_DTYPE.itemsize - 1) * INDEX_DTYPE.itemsize)
+            self.last = int(last['received'][0])
+        self.count = 0
+
+    def record(self, topic, payload, received=None):
+        """Append one message; received defaults to now, in nanoseconds since the epoch."""
+        topic = topic.encode() if isinstance(topic, str) else topic
+        if topic.startswith(COMMAND_TOPIC.encode()):
+            kind = COMMAND
+        else:
+            kind = AGGREGATE if topic.startswith(AGGREGATE_TOPIC.encode()) else DATA
+        low, high = plant_range(kind, payload)
+        with self.lock:
+            received = time.time_ns() if received is None else received
+            # Keep the index sorted, so seeking by time stays a binary search;
+            # only clock steps backwards are affected
+            self.last = max(self.last, received)
+            entry = np.array([(self.last, self.offset, len(topic), len(payload), kind, low, high)],
+                             dtype=INDEX_DTYPE)
+            self.log.write(topic)
+            self.log.write(payload)
+            self.index.write(entry.tobytes())
+            self.offset += len(topic) + len(payload)
+            self.count += 1
+
+    def flush(self):
+        with self.lock:
+            # The log first, so the index never points past its end
+            self.log.flush()
+            self.index.flush()
+
+    def close(self):
+        self.flush()
+        self.log.close()
+        self.index.close()
+
+
+class Recording:
+    """Read access to a recording, through memory maps of its index and log."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.log', 'rb') as f:
+            if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+                raise ValueError(f"{path}.log is not a recording")
+            self.log = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size = os.path.getsize(path + '.idx') - len(INDEX_MAGIC)
+        count = max(size, 0) // INDEX_DTYPE.itemsize
+        if count:
+            index = np.memmap(path + '.idx', dtype=INDEX_DTYPE, mode='r', offset=len(INDEX_MAGIC), shape=(count,))
+        else:
+            index = np.zeros(0, dtype=INDEX_DTYPE)
+        # Records written after the last flush of the log are dropped
+        complete = index['offset'] + index['topic_length'] + index['length'] <= len(self.log)
+        self.index = index if complete.all() else index[:np.argmin(complete)]
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def start(self):
+        return int(self.index['received'][0]) if len(self.index) else 0
+
+    @property
+    def end(self):
+        return int(self.index['received'][-1]) if len(self.index) else 0
+
+    def select(self, start=None, end=None, plant=None, kinds=(DATA, COMMAND, AGGREGATE)):
+        """Return the positions of the messages received between start and end (epoch ns, end
+        excluded) that are of one of kinds and may carry plant."""
+        received = self.index['received']
+        first = 0 if start is None else int(np.searchsorted(received, start, 'left'))
+        last = len(received) if end is None else int(np.searchsorted(received, end, 'left'))
+        rows = self.index[first:last]
+        mask = np.isin(rows['kind'], list(kinds))
+        if plant is not None:
+            mask &= ((rows['plant_low'] <= plant) & (rows['plant_high'] >= plant)) | (rows['plant_low'] == 0)
+        return first + np.flatnonzero(mask)
+
+    def message(self, row):
+        """Return the receive time, topic and payload of one message."""
+        entry = self.index[row]
+        offset, topic_length = int(entry['offset']), int(entry['topic_length'])
+        payload = offset + topic_length
+        return (int(entry['received']), self.log[offset:payload].decode(),
+                self.log[payload:payload + int(entry['length'])])
+
+    def close(self):
+        self.index = None
+        self.log.close()
+
+
+def replay(recording, rows, deliver, speed=1.0):
+    """Deliver the messages of rows as deliver(topic, payload), at speed times their recorded pace.
+
+    speed 0 delivers them as fast as possible. Returns the delivery lateness
+    of every message in seconds, 0 for all of them at speed 0.
+    """
+    lateness = np.zeros(len(rows))
+    if not len(rows):
+        return lateness
+    first = int(recording.index['received'][rows[0]])
+    started = time.perf_counter()
+    for i, row in enumerate(rows):
+        received, topic, payload = recording.message(row)
+        if speed:
+            due = started + (received - first) / NANOSECONDS / speed
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            lateness[i] = time.perf_counter() - due
+        deliver(topic, payload)
+    return lateness
+
+
+class CountingIotData:
+    """Stands in for the boto3 iot-data client of lamda_func, counting the commands instead."""
+
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, topic, qos, payload):
+        self.published += 1
+        return {}
+
+
+def monitor_sink(plants, depth):
+    """The monitor's ingest into a fresh store, as customCallback feeds it; returns deliver and the
+    function counting the readings."""
+    from store import RingStore
+    from analytics import RollingStats
+    ingest = Ingestor(RingStore(plants, depth), RollingStats(plants))
+    readings = [0]
+
+    def deliver(topic, payload):
+        readings[0] += ingest(payload)
+    return deliver, lambda: readings[0]
+
+
+def lambda_sink():
+    """lamda_func.lambda_handler as the IoT rule invokes it, with its commands counted, not sent."""
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lamda"))
+    import lamda_func
+    lamda_func.iot_client = CountingIotData()
+    # Counting takes no round trip, publishing threads would only add overhead
+    lamda_func.PUBLISH_WORKERS = 1
+
+    def deliver(topic, payload):
+        # The IoT rule hands JSON payloads over as parsed events and binary ones base64 encoded
+        if content_type(payload) == CONTENT_TYPE_BINARY:
+            event = {'data': base64.b64encode(payload).decode()}
+        else:
+            event = json.loads(payload)
+        lamda_func.lambda_handler(event, None)
+    return deliver, lambda: lamda_func.iot_client.published
+
+
+def broker_sink(host, port):
+    """Publishes every message on its recorded topic to an MQTT broker; also returns the function
+    disconnecting once the last message is out."""
+    import paho.mqtt.client as mqtt
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.connect(host, port, 60)
+    client.loop_start()
+    # Messages published and the delivery of the last one
+    published = [0, None]
+
+    def deliver(topic, payload):
+        published[0] += 1
+        published[1] = client.publish(topic, payload, qos=1)
+
+    def close():
+        if published[1] is not None:
+            published[1].wait_for_publish(5)
+        client.loop_stop()
+        client.disconnect()
+    return deliver, lambda: published[0], close
+
+
+def subscribe(source, on_message):
+    """Subscribe to the data, aggregate and command topics; returns a function disconnecting."""
+    if source[0] == 'aws':
+        from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+        from personal_arguments import DEV_CRT, DEV_KEY, AWS_ENDPOINT, CA_CERT, CLIENT_ID
+        client = AWSIoTMQTTClient(f'{CLIENT_ID}-recorder')
+        client.configureEndpoint(AWS_ENDPOINT, 8883)
+        client.configureCredentials(CA_CERT, DEV_KEY, DEV_CRT)
+        client.connect()
+        for topic in TOPICS:
+            client.subscribe(topic, 1, lambda c, userdata, message: on_message(message.topic, message.payload))
+        return client.disconnect
+    import paho.mqtt.client as mqtt
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_connect = lambda c, userdata, flags, rc, properties: c.subscribe([(topic, 1) for topic in TOPICS])
+    client.on_message = lambda c, userdata, message: on_message(message.topic, message.payload)
+    client.connect(source[1], source[2], 60)
+    client.loop_start()
+
+    def disconnect():
+        client.loop_stop()
+        client.disconnect()
+    return disconnect
+
+
+def record(args):
+    recorder = Recorder(args.path)
+    source = ('aws',) if args.source == 'aws' else ('mqtt', args.broker_host, args.broker_port)
+    disconnect = subscribe(source, recorder.record)
+    print(f"Recording {', '.join(TOPICS)} to {args.path}, Ctrl+C to stop")
+    deadline = time.monotonic() + args.duration if args.duration else None
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            time.sleep(1)
+            recorder.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        disconnect()
+        recorder.close()
+    print(f"Recorded {recorder.count} messages")
+
+
+def info(args):
+    recording = Recording(args.path)
+    index = recording.index
+    seconds = (recording.end - recording.start) / NANOSECONDS
+    print(f"{len(recording)} messages over {seconds:.1f} s, {len(recording.log) / 1e6:.1f} MB of payloads")
+    for name, kind in KINDS.items():
+        rows = index[index['kind'] == kind]
+        known = rows[rows['plant_low'] > 0]
+        plants = f", plants {known['plant_low'].min()} to {known['plant_high'].max()}" if len(known) else ""
+        print(f"  {name}: {len(rows)} messages, {int(rows['length'].sum())} bytes{plants}")
+    recording.close()
+
+
+def replay_command(args):
+    recording = Recording(args.path)
+    start = recording.start + int(args.start * NANOSECONDS) if args.start is not None else None
+    end = recording.start + int(args.until * NANOSECONDS) if args.until is not None else None
+    kinds = [KINDS[name] for name in args.kinds] if args.kinds else (
+        tuple(KINDS.values()) if args.to == 'broker' else (DATA,))
+    started = time.perf_counter()
+    rows = recording.select(start, end, args.plant, kinds)
+    seek = time.perf_counter() - started
+    close = None
+    if args.to == 'monitor':
+        deliver, count = monitor_sink(args.plants, args.history)
+        counted = 'readings'
+    elif args.to == 'lambda':
+        deliver, count = lambda_sink()
+        counted = 'commands'
+    else:
+        deliver, count, close = broker_sink(args.broker_host, args.broker_port)
+        counted = 'published'
+    started = time.perf_counter()
+    lateness = replay(recording, rows, deliver, args.speed)
+    elapsed = time.perf_counter() - started
+    if close is not None:
+        close()
+    print(f"Selected {len(rows)} messages in {seek * 1000:.2f} ms")
+    print(f"Replayed them in {elapsed:.2f} s, {len(rows) / max(elapsed, 1e-9):.0f} messages/s, "
+          f"{count()} {counted}")
+    if args.speed and len(rows):
+        print(f"Lateness p50 {np.percentile(lateness, 50) * 1000:.2f} ms, "
+              f"p99 {np.percentile(lateness, 99) * 1000:.2f} ms, max {lateness.max() * 1000:.2f} ms")
+    recording.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record the plants' MQTT traffic and replay it offline.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    recorder = commands.add_parser('record', help="capture the data, aggregate and command topics")
+    recorder.add_argument("path", help="recording to append to, without extension")
+    recorder.add_argument("--source", choices=("aws", "mqtt"), default="aws",
+                          help="AWS IoT Core or a plain MQTT broker such as local_broker.py")
+    recorder.add_argument("--broker-host", default="127.0.0.1", help="MQTT broker of --source mqtt")
+    recorder.add_argument("--broker-port", type=int, default=1883, help="MQTT broker port of --source mqtt")
+    recorder.add_argument("--duration", type=float, default=0, help="seconds to record (0 until Ctrl+C)")
+    recorder.set_defaults(run=record)
+
+    describer = commands.add_parser('info', help="summarize a recording")
+    describer.add_argument("path", help="recording, without extension")
+    describer.set_defaults(run=info)
+
+    replayer = commands.add_parser('replay', help="feed a recording to the monitor, the lambda or a broker")
+    replayer.add_argument("path", help="recording, without extension")
+    replayer.add_argument("--to", choices=("monitor", "lambda", "broker"), default="monitor",
+                          help="the monitor's ingest, lambda_handler or an MQTT broker")
+    replayer.add_argument("--speed", type=float, default=1.0,
+                          help="multiple of the recorded pace, 0 for as fast as possible")
+    replayer.add_argument("--from", dest="start", type=float, help="seconds into the recording to start at")
+    replayer.add_argument("--until", type=float, help="seconds into the recording to stop at")
+    replayer.add_argument("--plant", type=int, help="only the messages carrying this plant index")
+    replayer.add_argument("--kinds", nargs="+", choices=tuple(KINDS),
+                          help="message kinds to replay (default: data, and all of them to a broker)")
+    replayer.add_argument("--plants", type=int, default=100, help="plants of the monitor's store")
+    replayer.add_argument("--history", type=int, default=50, help="samples per plant of the monitor's store")
+    replayer.add_argument("--broker-host", default="127.0.0.1", help="MQTT broker of --to broker")
+    replayer.add_argument("--broker-port", type=int, default=1883, help="MQTT broker port of --to broker")
+    replayer.set_defaults(run=replay_command)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+from multiprocessing import shared_memory
+import numpy as np
+from store import RingStore
+from analytics import RollingStats, WINDOW
+
+
+class SharedArrays:
+    """Mixin putting the arrays a store allocates in named shared memory blocks.
+
+    The process passing create=True allocates one block per array, named
+    '<name>_<array>'; other processes map the same blocks by passing the
+    same name and sizes with create=False. Reads and writes are the ones of
+    the store, so each slot must still have a single writer: the ingest
+    workers own disjoint partitions of the plants.
+    """
+
+    def _share(self, name, create):
+        self.name = name
+        self.owner = create
+        self.blocks = []
+        self.arrays = []
+
+    def _allocate(self, name, shape, dtype):
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        # The worker processes share the creator's resource tracker, which
+        # frees the blocks if the creator dies without unlinking them
+        block = shared_memory.SharedMemory(name=f'{self.name}_{name}', create=self.owner, size=size)
+        self.blocks.append(block)
+        self.arrays.append(name)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        if self.owner:
+            array[...] = 0
+        return array
+
+    def close(self):
+        """Unmap the store; the creator also frees the shared memory."""
+        # The arrays must be gone before their buffers can be released
+        for name in self.arrays:
+            setattr(self, name, None)
+        for block in self.blocks:
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.blocks = []
+
+
+class SharedRingStore(SharedArrays, RingStore):
+    """RingStore whose columns live in shared memory."""
+
+    def __init__(self, name, capacity, depth=50, create=True):
+        self._share(name, create)
+        super().__init__(capacity, depth)
+
+
+class SharedRollingStats(SharedArrays, RollingStats):
+    """RollingStats whose arrays live in shared memory."""
+
+    def __init__(self, name, capacity, window=WINDOW, create=True):
+        self._share(name, create)
+        super().__init__(capacity, window)
@@ -0,0 +1,141 @@
+import time
+import numpy as np
+
+
+# Metrics kept for every plant, next to the timestamps
+METRICS = ('temperatures', 'humidities', 'water_levels')
+
+
+class RingStore:
+    """Preallocated columnar history of the latest readings of every plant.
+
+    Each column is one 2-D array indexed by plant slot and ring position, so
+    memory is fixed at creation time whatever the history depth. Every row is
+    twice the depth long and each sample is written at position p and p +
+    depth: the latest samples of a plant are then always one contiguous slice,
+    which readers get as a zero-copy view.
+
+    There must be a single writer. Readers use a per-slot sequence counter
+    (a seqlock): the writer makes it odd while a sample is written and even
+    again afterwards, and a reader retries until it sees the same even value
+    before and after taking its views.
+    """
+
+    def __init__(self, capacity, depth=50):
+        self.capacity = capacity
+        self.depth = depth
+        self.timestamps = self._allocate('timestamps', (capacity, 2 * depth), np.int64)
+        self.temperatures = self._allocate('temperatures', (capacity, 2 * depth), np.float32)
+        self.humidities = self._allocate('humidities', (capacity, 2 * depth), np.float32)
+        self.water_levels = self._allocate('water_levels', (capacity, 2 * depth), np.float32)
+        # Number of samples ever written per slot, the ring position is counts % depth
+        self.counts = self._allocate('counts', (capacity,), np.int64)
+        self.seqs = self._allocate('seqs', (capacity,), np.int64)
+        # Readings for slots outside the store
+        self.dropped = 0
+
+    def _allocate(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def append(self, slot, timestamp, temperature, humidity, water_level):
+        """Append one reading of the plant in the given slot."""
+        if not 0 <= slot < self.capacity:
+            self.dropped += 1
+            return
+        count = self.counts[slot]
+        positions = [count % self.depth, count % self.depth + self.depth]
+        self.seqs[slot] += 1
+        self.timestamps[slot, positions] = timestamp
+        self.temperatures[slot, positions] = temperature
+        self.humidities[slot, positions] = humidity
+        self.water_levels[slot, positions] = water_level
+        self.counts[slot] = count + 1
+        self.seqs[slot] += 1
+
+    def append_many(self, slots, timestamps, temperatures, humidities, water_levels):
+        """Append one reading for each of many plants with vectorized writes."""
+        slots = np.asarray(slots)
+        valid = (slots >= 0) & (slots < self.capacity)
+        if not valid.all():
+            self.dropped += int((~valid).sum())
+            slots = slots[valid]
+            timestamps, temperatures, humidities, water_levels = (
+                np.asarray(column)[valid] for column in (timestamps, temperatures, humidities, water_levels))
+        if len(np.unique(slots)) != len(slots):
+            # The same plant twice in one batch, keep the order of its samples
+            for row in zip(slots, timestamps, temperatures, humidities, water_levels):
+                self.append(*row)
+            return
+        positions = self.counts[slots] % self.depth
+        self.seqs[slots] += 1
+        for column, values in ((self.timestamps, timestamps), (self.temperatures, temperatures),
+                               (self.humidities, humidities), (self.water_levels, water_levels)):
+            column[slots, positions] = values
+            column[slots, positions + self.depth] = values
+        self.counts[slots] += 1
+        self.seqs[slots] += 1
+
+    def snapshot(self, slot, copy=False):
+        """Return the history of a slot, oldest sample first.
+
+        The result is a dict of zero-copy views: the timestamps as
+        datetime64[ns] and one array per metric. The views are consistent when
+        returned; the next write into the slot replaces their oldest sample,
+        so pass copy=True to keep them unchanged across writes.
+        """
+        while True:
+            seq = self.seqs[slot]
+            if seq % 2:
+                time.sleep(0)
+                continue
+            count = self.counts[slot]
+            size = min(count, self.depth)
+            start = (count - size) % self.depth
+            columns = {'timestamps': self.timestamps[slot, start:start + size].view('datetime64[ns]')}
+            for name in METRICS:
+                columns[name] = getattr(self, name)[slot, start:start + size]
+            if copy:
+                columns = {name: values.copy() for name, values in columns.items()}
+            if self.seqs[slot] == seq:
+                return columns
+
+    def count(self, slot):
+        """Number of samples ever written into a slot."""
+        return int(self.counts[slot])
+
+    def since(self, slot, count):
+        """Return the samples of a slot written after its first count samples.
+
+        Returns the number of samples written so far and copies of the newer
+        ones, laid out like snapshot(); at most depth of them are left, the
+        older ones were overwritten.
+        """
+        while True:
+            seq = self.seqs[slot]
+            if seq % 2:
+                time.sleep(0)
+                continue
+            total = int(self.counts[slot])
+            size = max(0, min(total - count, self.depth))
+            start = (total - size) % self.depth
+            columns = {'timestamps': self.timestamps[slot, start:start + size].view('datetime64[ns]').copy()}
+            for name in METRICS:
+                columns[name] = getattr(self, name)[slot, start:start + size].copy()
+            if self.seqs[slot] == seq:
+                return total, columns
+
+    def latest(self, counts=None):
+        """Return the newest sample of every slot as whole-fleet arrays.
+
+        Slots without any sample are masked out by the returned 'valid' array.
+        counts, a copy of the counts taken earlier, returns the samples that
+        were the newest at that time instead.
+        """
+        counts = self.counts.copy() if counts is None else counts
+        valid = counts > 0
+        positions = (counts - 1) % self.depth
+        rows = np.arange(self.capacity)
+        columns = {'valid': valid, 'timestamps': self.timestamps[rows, positions].view('datetime64[ns]')}
+        for name in METRICS:
+            columns[name] = getattr(self, name)[rows, positions]
+        return columns
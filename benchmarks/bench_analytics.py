@@ -0,0 +1,100 @@
+"""Incremental rolling statistics against recomputing them over the window.
+
+Feeds a reading of every plant per tick into a RingStore holding a window of
+history and into analytics.RollingStats, then compares the cost per tick of
+
+* incremental: RollingStats.update on the batch, constant work per reading;
+* per plant: mean, std, min and max over each plant's RingStore snapshot,
+  as a view recomputing them on redraw would;
+* vectorized: the same over the whole store at once, still O(window) per
+  plant.
+
+The results of the three are checked against each other.
+
+    python benchmarks/bench_analytics.py --plants 1000 10000 --windows 50 500
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Simulation"))
+
+from analytics import RollingStats  # noqa: E402
+from store import RingStore, METRICS  # noqa: E402
+
+
+def readings(rng, plants):
+    return (rng.uniform(23, 24, plants), rng.uniform(60, 61, plants), rng.uniform(33000, 36000, plants))
+
+
+def per_plant(store):
+    # What a view recomputing the statistics of every plant on redraw does
+    stats = []
+    for slot in range(store.capacity):
+        history = store.snapshot(slot)
+        stats.append([(values.mean(), values.std(ddof=1), values.min(), values.max())
+                      for values in (history[name].astype(np.float64) for name in METRICS)])
+    return np.array(stats)
+
+
+def vectorized(store):
+    # The whole window of every plant at once, in ring order: order does not matter here
+    columns = np.stack([getattr(store, name)[:, :store.depth].astype(np.float64) for name in METRICS], axis=1)
+    return np.stack([columns.mean(axis=2), columns.std(axis=2, ddof=1), columns.min(axis=2),
+                     columns.max(axis=2)], axis=2)
+
+
+def incremental(stats):
+    return np.stack([stats.means, np.sqrt(stats.m2 / (stats.window - 1)), stats.mins, stats.maxs], axis=2)
+
+
+def run(plants, window, ticks):
+    rng = np.random.default_rng(1)
+    store = RingStore(plants, window)
+    stats = RollingStats(plants, window)
+    slots = np.arange(plants)
+    timings = {'incremental': 0.0, 'vectorized': 0.0}
+    for tick in range(window + ticks):
+        temperatures, humidities, water_levels = readings(rng, plants)
+        store.append_many(slots, np.full(plants, tick), temperatures, humidities, water_levels)
+        start = time.perf_counter()
+        stats.update(slots, temperatures, humidities, water_levels)
+        elapsed = time.perf_counter() - start
+        if tick < window:
+            continue
+        timings['incremental'] += elapsed
+        start = time.perf_counter()
+        vectorized_result = vectorized(store)
+        timings['vectorized'] += time.perf_counter() - start
+    timings = {name: seconds / ticks for name, seconds in timings.items()}
+    # The per plant loop is slow, time it on the last tick only
+    start = time.perf_counter()
+    per_plant_result = per_plant(store)
+    timings['per plant'] = time.perf_counter() - start
+    for result in (vectorized_result, per_plant_result):
+        if not np.allclose(incremental(stats), result, rtol=1e-5, atol=1e-3):
+            raise AssertionError("incremental statistics differ from the recomputed ones")
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plants", type=int, nargs="+", default=[1000, 10000], help="plant counts to run")
+    parser.add_argument("--windows", type=int, nargs="+", default=[50, 500], help="window lengths to run")
+    parser.add_argument("--ticks", type=int, default=20, help="timed ticks after the window is full")
+    args = parser.parse_args()
+
+    print(f"{'plants':>8} {'window':>7} {'incremental ms':>15} {'vectorized ms':>14} {'per plant ms':>13}")
+    for plants in args.plants:
+        for window in args.windows:
+            result = run(plants, window, args.ticks)
+            print(f"{plants:>8} {window:>7} {result['incremental'] * 1000:>15.2f} "
+                  f"{result['vectorized'] * 1000:>14.2f} {result['per plant'] * 1000:>13.1f}")
+    print("milliseconds per tick of one reading of every plant")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Compare per-plant and batched sensor messages.
+
+Reports, for each batch size, the number of messages and the bytes on the
+wire per tick (MQTT PUBLISH framing plus an estimate of the TLS record
+overhead) and the encode cost. With --host the messages are also published
+to a real broker to measure the achieved msgs/s and readings/s.
+
+    python benchmarks/bench_batching.py --plants 1000 --batch-sizes 0 100 1000
+    python benchmarks/bench_batching.py --host localhost --port 1883
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Simulation"))
+
+from payloads import encode_reading, encode_batch, chunks  # noqa: E402
+
+MQTT_TOPIC = "sensor/data"
+# TLS 1.2 AES-GCM: 5 bytes record header, 8 bytes explicit nonce, 16 bytes tag
+TLS_RECORD_OVERHEAD = 29
+
+
+def mqtt_publish_size(topic, payload):
+    """Size in bytes of a QoS 0 MQTT PUBLISH packet."""
+    remaining = 2 + len(topic) + len(payload)
+    length_bytes = 1
+    while remaining >= 128 ** length_bytes:
+        length_bytes += 1
+    return 1 + length_bytes + remaining
+
+
+def make_tick(plant_ids, batch_size):
+    """Build the encoded messages of one simulator tick."""
+    timestamp = time.ctime()
+    if batch_size > 0:
+        return [
+            encode_batch(chunk,
+                         [random.uniform(23, 24) for _ in chunk],
+                         [random.uniform(60, 61) for _ in chunk],
+                         [random.uniform(33000, 36000) for _ in chunk],
+                         timestamp).encode()
+            for chunk in chunks(plant_ids, batch_size)
+        ]
+    return [
+        encode_reading(plant_id, random.uniform(23, 24), random.uniform(60, 61),
+                       random.uniform(33000, 36000), timestamp).encode()
+        for plant_id in plant_ids
+    ]
+
+
+def measure_encoding(plant_ids, batch_size, ticks):
+    start = time.perf_counter()
+    for _ in range(ticks):
+        messages = make_tick(plant_ids, batch_size)
+    elapsed = (time.perf_counter() - start) / ticks
+    wire = sum(mqtt_publish_size(MQTT_TOPIC, m) + TLS_RECORD_OVERHEAD for m in messages)
+    return len(messages), wire, elapsed
+
+
+def measure_broker(host, port, plant_ids, batch_size, ticks):
+    """Publish ticks to a broker with QoS 1 and wait for every ack."""
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.max_inflight_messages_set(1000)
+    client.max_queued_messages_set(0)
+    client.connect(host, port, 60)
+    client.loop_start()
+    try:
+        ticks_messages = [make_tick(plant_ids, batch_size) for _ in range(ticks)]
+        start = time.perf_counter()
+        infos = [client.publish(MQTT_TOPIC, m, qos=1) for messages in ticks_messages for m in messages]
+        for info in infos:
+            info.wait_for_publish()
+        elapsed = time.perf_counter() - start
+    finally:
+        client.loop_stop()
+        client.disconnect()
+    return len(infos) / elapsed, len(plant_ids) * ticks / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plants", type=int, default=1000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[0, 10, 100, 1000])
+    parser.add_argument("--ticks", type=int, default=20)
+    parser.add_argument("--host", help="broker to publish to, encoding only if omitted")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    plant_ids = [f'plant_{i + 1}' for i in range(args.plants)]
+    print(f"{args.plants} plants, {args.ticks} ticks per measurement")
+    header = f"{'mode':>12} {'msgs/tick':>10} {'bytes/tick':>11} {'bytes/reading':>14} {'encode ms':>10}"
+    if args.host:
+        header += f" {'msgs/s':>10} {'readings/s':>11}"
+    print(header)
+    for batch_size in args.batch_sizes:
+        messages, wire, elapsed = measure_encoding(plant_ids, batch_size, args.ticks)
+        mode = f"batch {batch_size}" if batch_size > 0 else "per-plant"
+        line = f"{mode:>12} {messages:>10} {wire:>11} {wire / args.plants:>14.1f} {elapsed * 1e3:>10.2f}"
+        if args.host:
+            msgs_per_s, readings_per_s = measure_broker(args.host, args.port, plant_ids, batch_size, args.ticks)
+            line += f" {msgs_per_s:>10.0f} {readings_per_s:>11.0f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
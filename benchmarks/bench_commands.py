@@ -0,0 +1,139 @@
+"""Measure how commands received by the simulator affect its MQTT client.
+
+A burst of command messages, one per plant plus repeats that should be
+merged, is sent within one second through a local broker to a client using
+the simulator's on_message. Meanwhile that client keeps publishing QoS 1
+probes, whose ack time shows whether its network loop is held up. Commands
+are run either inline in the callback, as the simulator used to, or on the
+CommandExecutor worker pool. Actuation latency is measured from the first
+send of a command to the moment it first runs, so time spent waiting in the
+socket behind a blocked callback counts too.
+
+    python benchmarks/bench_commands.py --plants 100 --actuation 0.05
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Simulation"))
+
+import Sending_data  # noqa: E402
+from commands import CommandExecutor  # noqa: E402
+from local_broker import LocalBroker  # noqa: E402
+
+
+class InlineExecutor:
+    """Runs every command inside submit, on the network thread."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.received = self.executed = 0
+
+    def submit(self, plant_id, commands, received=None):
+        for command in commands:
+            self.received += 1
+            self.handler(plant_id, command)
+            self.executed += 1
+
+    def stats(self):
+        return {'received': self.received, 'merged': 0, 'executed': self.executed}
+
+    def stop(self):
+        pass
+
+
+def run(mode, port, args):
+    actuated = {}
+    sent = {}
+
+    def actuate(plant_id, command):
+        actuated.setdefault((plant_id, command), time.monotonic() - sent[plant_id])
+        time.sleep(args.actuation)
+
+    executor = InlineExecutor(actuate) if mode == 'inline' else CommandExecutor(actuate, args.workers)
+    callback_times = []
+
+    def on_message(client, userdata, msg):
+        start = time.perf_counter()
+        Sending_data.on_message(client, userdata, msg)
+        callback_times.append(time.perf_counter() - start)
+
+    device = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, userdata=executor)
+    device.on_message = on_message
+    device.connect('127.0.0.1', port, 60)
+    device.subscribe(Sending_data.MQTT_TOPIC_COMMAND)
+    device.loop_start()
+    commander = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    commander.connect('127.0.0.1', port, 60)
+    commander.loop_start()
+    time.sleep(0.5)
+
+    # Probe the device's own publishes while the commands arrive
+    probe_times = []
+    done = threading.Event()
+
+    def probe():
+        while not done.is_set():
+            start = time.perf_counter()
+            device.publish(Sending_data.MQTT_TOPIC, b'probe', qos=1).wait_for_publish(timeout=60)
+            probe_times.append(time.perf_counter() - start)
+            time.sleep(0.05)
+
+    prober = threading.Thread(target=probe)
+    prober.start()
+
+    plant_ids = [f'plant_{i + 1}' for i in range(args.plants)]
+    expected = {(plant_id, command) for plant_id in plant_ids for command in (1, 22)}
+    start = time.monotonic()
+    for repeat in range(args.repeats):
+        for plant_id in plant_ids:
+            sent.setdefault(plant_id, time.monotonic())
+            commander.publish(Sending_data.MQTT_TOPIC_COMMAND,
+                              json.dumps({"commands": [1, "22"], "plant_id": plant_id}), qos=1)
+        time.sleep(1 / args.repeats)
+    while actuated.keys() != expected and time.monotonic() - start < args.timeout:
+        time.sleep(0.01)
+    elapsed = time.monotonic() - start
+    done.set()
+    prober.join()
+
+    for client in (device, commander):
+        client.loop_stop()
+        client.disconnect()
+    executor.stop()
+    stats = executor.stats()
+    p50, p99 = np.percentile(list(actuated.values()), [50, 99])
+    print(f"{mode:>8} {np.max(callback_times) * 1e3:>12.1f} {np.percentile(probe_times, 99) * 1e3:>12.1f} "
+          f"{p50 * 1e3:>8.1f} {p99 * 1e3:>8.1f} {stats['received']:>9} {stats['merged']:>7} "
+          f"{len(actuated):>9} {elapsed:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plants", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=3, help="times every plant gets its commands in the burst")
+    parser.add_argument("--actuation", type=float, default=0.05, help="seconds a command takes to run")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--modes", nargs="+", choices=("inline", "executor"), default=["inline", "executor"])
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    broker = LocalBroker(port=0).start()
+    print(f"{args.plants} plants x {args.repeats} command messages in 1 s, {args.actuation * 1e3:.0f} ms per command")
+    print(f"{'mode':>8} {'callback ms':>12} {'probe p99 ms':>12} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'commands':>9} {'merged':>7} {'actuated':>9} {'total s':>8}")
+    try:
+        for mode in args.modes:
+            run(mode, broker.port, args)
+    finally:
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
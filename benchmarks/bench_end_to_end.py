@@ -0,0 +1,250 @@
+"""End-to-end latency, loss and throughput through a local MQTT broker.
+
+Runs the real code of the three components against an in-process broker
+stand-in (or an external broker with --host, e.g. mosquitto):
+
+* ingest: simulator messages (Sending_data.make_message) to the monitor
+  ingest path (decode_columns and RingStore.append_many);
+* commands: lamda_func.publish_command to the simulator's on_message and
+  CommandExecutor, with the lambda's IoT client routed to the broker;
+* loop: simulator readings through lambda_handler, standing in for the IoT
+  rule, back to the simulator as commands. The loop uses a rule firing on
+  every reading, so each reading should come back as one command.
+
+Readings carry their send time (ts) and JSON messages a sequence number;
+binary messages are told apart by their send time. Latency is measured per
+reading from its send time to the end of its ingest or to the arrival of
+its command. Every combination of --plants and --rates is run.
+
+    python benchmarks/bench_end_to_end.py --plants 100 1000 --rates 50 500
+    python benchmarks/bench_end_to_end.py --stages ingest --format binary --batch-size 100
+"""
+import argparse
+import base64
+import collections
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "Simulation"))
+sys.path.insert(0, os.path.join(ROOT, "lamda"))
+
+import Sending_data  # noqa: E402
+import lamda_func  # noqa: E402
+from commands import CommandExecutor  # noqa: E402
+from local_broker import LocalBroker  # noqa: E402
+from payloads import decode_columns, chunks, content_type, CONTENT_TYPE_JSON  # noqa: E402
+from rules import Rule, RuleEngine  # noqa: E402
+from store import RingStore  # noqa: E402
+
+STAGES = ('ingest', 'commands', 'loop')
+
+
+class BrokerIotData:
+    """Publishes like the boto3 iot-data client, to an MQTT broker instead."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def publish(self, topic, qos, payload):
+        self.client.publish(topic, payload, qos=qos)
+        return {}
+
+
+class Result:
+    """Sent and received counts and per-item latencies of one run."""
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.keys = set()
+        self.duplicates = 0
+        self.latencies = []
+
+    def receive(self, key, latencies):
+        if key in self.keys:
+            self.duplicates += 1
+        self.keys.add(key)
+        self.received += len(latencies)
+        self.latencies.extend(latencies)
+
+
+def connect(port, host, on_message=None, subscribe=None, userdata=None):
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, userdata=userdata)
+    client.max_inflight_messages_set(1000)
+    client.on_message = on_message
+    client.connect(host, port, 60)
+    if subscribe:
+        client.subscribe(subscribe, qos=1)
+    client.loop_start()
+    return client
+
+
+def publish_readings(client, plant_ids, rate, args, result, on_send=None):
+    """Publish simulator messages at rate readings/s for args.duration seconds."""
+    groups = list(chunks(plant_ids, args.batch_size if args.batch_size > 0 else 1))
+    interval = len(groups[0]) / rate
+    start = next_send = time.monotonic()
+    seq = itertools.count()
+    for group in itertools.cycle(groups):
+        now = time.monotonic()
+        if now - start >= args.duration:
+            return
+        if next_send > now:
+            time.sleep(next_send - now)
+        next_send += interval
+        payload = Sending_data.make_message(group, args.batch_size, args.format, next(seq))
+        if on_send is not None:
+            on_send(group)
+        client.publish(Sending_data.MQTT_TOPIC, payload)
+        result.sent += len(group)
+
+
+def message_key(raw, ts):
+    """Sequence number of a JSON message, send time of a binary one."""
+    if content_type(raw) == CONTENT_TYPE_JSON:
+        return json.loads(raw)['seq']
+    return int(ts[0])
+
+
+def run_ingest(host, port, plant_ids, rate, args):
+    result = Result()
+    store = RingStore(capacity=len(plant_ids), depth=50)
+
+    def on_message(client, userdata, message):
+        plants, temperatures, humidities, water_levels, timestamps = decode_columns(message.payload)
+        store.append_many(plants - 1, timestamps, temperatures, humidities, water_levels)
+        now = time.time_ns()
+        result.receive(message_key(message.payload, timestamps), ((now - timestamps) / 1e9).tolist())
+
+    monitor = connect(port, host, on_message, Sending_data.MQTT_TOPIC)
+    simulator = connect(port, host)
+    time.sleep(0.2)
+    publish_readings(simulator, plant_ids, rate, args, result)
+    return result, (monitor, simulator)
+
+
+def run_commands(host, port, plant_ids, rate, args):
+    result = Result()
+
+    def on_message(client, userdata, message):
+        command = json.loads(message.payload)
+        result.receive(command['seq'], [(time.time_ns() - command['ts']) / 1e9])
+        Sending_data.on_message(client, userdata, message)
+
+    executor = CommandExecutor(lambda plant_id, command: None)
+    simulator = connect(port, host, on_message, Sending_data.MQTT_TOPIC_COMMAND, executor)
+    lamda_func.iot_client = BrokerIotData(connect(port, host))
+    time.sleep(0.2)
+    start = next_send = time.monotonic()
+    for plant_id in itertools.cycle(plant_ids):
+        now = time.monotonic()
+        if now - start >= args.duration:
+            break
+        if next_send > now:
+            time.sleep(next_send - now)
+        next_send += 1 / rate
+        lamda_func.publish_command(["22"], plant_id)
+        result.sent += 1
+    result.executor = executor
+    return result, (simulator, lamda_func.iot_client.client)
+
+
+def run_loop(host, port, plant_ids, rate, args):
+    result = Result()
+    # Send times of the readings of every plant still waiting for their command
+    waiting = collections.defaultdict(collections.deque)
+    lock = threading.Lock()
+
+    def on_send(group):
+        now = time.time_ns()
+        with lock:
+            for plant_id in group:
+                waiting[plant_id].append(now)
+
+    def iot_rule(client, userdata, message):
+        # The IoT rule hands JSON payloads over as parsed events and binary ones base64 encoded
+        if content_type(message.payload) == CONTENT_TYPE_JSON:
+            event = json.loads(message.payload)
+        else:
+            event = {'data': base64.b64encode(message.payload).decode()}
+        lamda_func.lambda_handler(event, None)
+
+    def on_command(client, userdata, message):
+        command = json.loads(message.payload)
+        with lock:
+            sent = waiting[command['plant_id']].popleft()
+        result.receive(command['seq'], [(time.time_ns() - sent) / 1e9])
+
+    lamda_func.rule_engine = RuleEngine([Rule('every_reading', 'water_level', 1, high=0)])
+    lamda_func.iot_client = BrokerIotData(connect(port, host))
+    rule = connect(port, host, iot_rule, Sending_data.MQTT_TOPIC)
+    commands = connect(port, host, on_command, Sending_data.MQTT_TOPIC_COMMAND)
+    simulator = connect(port, host)
+    time.sleep(0.2)
+    publish_readings(simulator, plant_ids, rate, args, result, on_send)
+    return result, (rule, commands, simulator, lamda_func.iot_client.client)
+
+
+def run(stage, host, port, plants, rate, args):
+    plant_ids = [f'plant_{i + 1}' for i in range(plants)]
+    runner = {'ingest': run_ingest, 'commands': run_commands, 'loop': run_loop}[stage]
+    result, clients = runner(host, port, plant_ids, rate, args)
+    # Wait for the messages still on their way
+    deadline = time.monotonic() + args.drain
+    while result.received < result.sent and time.monotonic() < deadline:
+        time.sleep(0.05)
+    for client in clients:
+        client.loop_stop()
+        client.disconnect()
+    if hasattr(result, 'executor'):
+        result.executor.stop()
+
+    p50, p99 = np.percentile(result.latencies, [50, 99]) if result.latencies else (np.nan, np.nan)
+    loss = 1 - result.received / result.sent if result.sent else 0.0
+    print(f"{stage:>8} {plants:>7} {rate:>8.0f} {result.sent:>8} {result.received:>9} {100 * loss:>7.2f} "
+          f"{result.duplicates:>5} {p50 * 1e3:>8.2f} {p99 * 1e3:>8.2f} {result.received / args.duration:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--plants", type=int, nargs="+", default=[100], help="fleet sizes")
+    parser.add_argument("--rates", type=float, nargs="+",
+                        help="readings (or commands) per second, default every plant every 2 s")
+    parser.add_argument("--batch-size", type=int, default=0, help="plants per simulator message, 0 for one each")
+    parser.add_argument("--format", choices=("json", "binary"), default="json")
+    parser.add_argument("--duration", type=float, default=5, help="seconds of sending per run")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to wait for late messages")
+    parser.add_argument("--host", help="external broker, an in-process one is started if omitted")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    broker = None
+    host, port = args.host, args.port
+    if host is None:
+        broker = LocalBroker(port=0).start()
+        host, port = broker.host, broker.port
+    print(f"Broker {host}:{port}, {args.format} messages, batch size {args.batch_size}, {args.duration:.0f} s per run")
+    print(f"{'stage':>8} {'plants':>7} {'rate/s':>8} {'sent':>8} {'received':>9} {'loss %':>7} "
+          f"{'dups':>5} {'p50 ms':>8} {'p99 ms':>8} {'recv/s':>9}")
+    try:
+        for stage in args.stages:
+            for plants in args.plants:
+                for rate in args.rates or [plants / 2]:
+                    run(stage, host, port, plants, rate, args)
+    finally:
+        if broker is not None:
+            broker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Ingest throughput of the monitor with 1..N decoding worker processes.
+
+Pre-generates the messages of --messages ticks of --plants plants in the
+chosen wire format and feeds them to the ingest tier (ingest.IngestTier)
+from memory, so the broker and the network are left out. Every worker gets
+every message, as it would from the broker, and keeps the readings of its
+own plants. Reported is the time until all workers are done, as readings
+per second, and the speed-up over the single process path of
+local_monitor.py (ingest.Ingestor in the GUI process). The speed-up is bounded by the number of cores.
+
+Before the timed runs, binary batches of odd plants only and a malformed
+message go to two workers writing the history: worker 0 must skip them all,
+worker 1 store and keep the history of every reading, and both drop the
+malformed message.
+
+    python benchmarks/bench_ingest.py --format binary --workers 1 2 4 8
+    python benchmarks/bench_ingest.py --format json --plants 1000 --history
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Simulation"))
+
+import Sending_data  # noqa: E402
+from ingest import IngestTier, Ingestor  # noqa: E402
+from payloads import chunks  # noqa: E402
+from store import RingStore  # noqa: E402
+from analytics import RollingStats  # noqa: E402
+from history import HistoryStore  # noqa: E402
+
+
+def make_payloads(plants, ticks, wire_format, batch_size):
+    plant_ids = [f'plant_{i + 1}' for i in range(plants)]
+    groups = [[plant_id] for plant_id in plant_ids] if wire_format == 'json' else list(chunks(plant_ids, batch_size))
+    seq = itertools.count()
+    payloads = []
+    for _ in range(ticks):
+        for group in groups:
+            message = Sending_data.make_message(group, 0 if wire_format == 'json' else batch_size,
+                                                'binary' if wire_format == 'binary' else 'json', next(seq))
+            payloads.append(message.encode() if isinstance(message, str) else message)
+    return payloads
+
+
+def run_single(payloads, plants, history_dir):
+    # The in-process path of local_monitor.py
+    history = HistoryStore(history_dir) if history_dir else None
+    ingest = Ingestor(RingStore(plants, 50), RollingStats(plants), history)
+    readings = 0
+    start = time.perf_counter()
+    for raw in payloads:
+        readings += ingest(raw)
+    if history is not None:
+        history.close()
+    return readings, time.perf_counter() - start
+
+
+def run_tier(payloads, plants, workers, history_dir):
+    start_event = multiprocessing.Event()
+    tier = IngestTier(workers, plants, 50, ('replay', payloads, start_event), history_dir)
+    try:
+        start = time.perf_counter()
+        start_event.set()
+        while tier.totals()['messages'] < workers * len(payloads):
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        return tier.totals()['readings'], elapsed
+    finally:
+        tier.close()
+
+
+def check_partition(history_dir, plants=10, ticks=5):
+    odd = [f'plant_{i}' for i in range(1, plants + 1, 2)]
+    start = time.time_ns()
+    payloads = [Sending_data.make_message(odd, len(odd), 'binary') for _ in range(ticks)]
+    payloads.append(payloads[0][:-3])
+    start_event = multiprocessing.Event()
+    tier = IngestTier(2, plants, 50, ('replay', payloads, start_event), history_dir)
+    try:
+        start_event.set()
+        deadline = time.monotonic() + 10
+        while tier.totals()['messages'] < 2 * len(payloads) and time.monotonic() < deadline:
+            time.sleep(0.001)
+        totals = tier.totals()
+    finally:
+        tier.close()
+    expected = {'messages': 2 * len(payloads), 'readings': len(odd) * ticks, 'skipped': ticks, 'failed': 2}
+    if totals != expected:
+        sys.exit(f"odd plants over 2 workers counted {totals}, expected {expected}")
+    history = HistoryStore(os.path.join(history_dir, 'shard-1'))
+    stored = len(history.query(1, start, time.time_ns())['ts'])
+    history.close()
+    if stored != ticks:
+        sys.exit(f"worker 1 kept {stored} readings of plant_1 in the history, expected {ticks}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plants", type=int, default=1000, help="number of plants")
+    parser.add_argument("--messages", type=int, default=20, help="ticks of readings of every plant")
+    parser.add_argument("--format", choices=("json", "batch", "binary"), default="binary",
+                        help="per-plant JSON, columnar JSON batches or binary batches")
+    parser.add_argument("--batch-size", type=int, default=100, help="plants per batch message")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="worker counts to run")
+    parser.add_argument("--history", action="store_true", help="also write the persistent history")
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.plants, args.messages, args.format, args.batch_size)
+    print(f"{len(payloads)} {args.format} messages, {args.plants} plants, {os.cpu_count()} cores")
+    print(f"{'workers':>10} {'readings':>10} {'seconds':>9} {'readings/s':>12} {'speed-up':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        check_partition(os.path.join(tmp, 'partition'))
+        history_dir = os.path.join(tmp, 'single') if args.history else None
+        readings, elapsed = run_single(payloads, args.plants, history_dir)
+        baseline = readings / elapsed
+        print(f"{'in-process':>10} {readings:>10} {elapsed:>9.3f} {baseline:>12.0f} {1:>9.2f}")
+        for workers in args.workers:
+            history_dir = os.path.join(tmp, f'tier-{workers}') if args.history else None
+            readings, elapsed = run_tier(payloads, args.plants, workers, history_dir)
+            print(f"{workers:>10} {readings:>10} {elapsed:>9.3f} {readings / elapsed:>12.0f} "
+                  f"{readings / elapsed / baseline:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Check and time the batched rule evaluation of the lambda handler.
+
+Random readings, about half of them out of range, are evaluated with the
+original scalar range checks one reading at a time and with a rule engine
+without hysteresis or re-issue interval, which must give the same commands;
+the script fails if they disagree. It then times a batch message through
+both paths, and counts the commands sent to a plant hovering around a
+threshold with and without the default hysteresis and debouncing.
+
+    python benchmarks/bench_lambda_batch.py --readings 1000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lamda"))
+
+import lamda_func  # noqa: E402
+from rules import Rule, RuleEngine  # noqa: E402
+
+
+def legacy_check_reading(reading):
+    # The range checks of lambda_handler before the rule engine
+    messages_to_publish = []
+    if not lamda_func.WATER_LEVEL_RANGE[0] <= reading['water_level'] <= lamda_func.WATER_LEVEL_RANGE[1]:
+        messages_to_publish.append(1)
+    if reading['temp'] < lamda_func.TEMP_RANGE[0]:
+        messages_to_publish.append("21")
+    elif reading['temp'] > lamda_func.TEMP_RANGE[1]:
+        messages_to_publish.append("22")
+    if not lamda_func.HUMIDITY_RANGE[0] <= reading['humidity'] <= lamda_func.HUMIDITY_RANGE[1]:
+        messages_to_publish.append("3")
+    return messages_to_publish
+
+
+def split_batch(event):
+    # How the lambda split a batch message into single readings for the scalar checks
+    temps = event.get('temp', event.get('temperature'))
+    plant_ids = event['plant_id']
+    if not isinstance(plant_ids, list):
+        plant_ids = [plant_ids] * len(temps)
+    return [
+        {'plant_id': plant_id, 'water_level': water_level, 'temp': temp, 'humidity': humidity}
+        for plant_id, water_level, temp, humidity in zip(
+            plant_ids, event['water_level'], temps, event['humidity'])
+    ]
+
+
+def stateless_engine():
+    # The default rules without hysteresis and re-issue interval
+    return RuleEngine([Rule(rule.name, rule.metric, rule.command, rule.low, rule.high)
+                       for rule in lamda_func.RULES])
+
+
+def make_readings(count):
+    return [{
+        'plant_id': f'plant_{i + 1}',
+        'water_level': random.uniform(32000, 37000),
+        'temp': random.uniform(22.5, 24.5),
+        'humidity': random.uniform(59.5, 61.5),
+    } for i in range(count)]
+
+
+def evaluate(engine, event, now):
+    plant_ids, water_levels, temps, humidities = lamda_func.decode_columns(event)
+    return engine.evaluate(plant_ids, {'water_level': water_levels, 'temp': temps, 'humidity': humidities}, now)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readings", type=int, default=1000, help="readings per batch, one per plant")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--ticks", type=int, default=300, help="2 s ticks of the hovering plant")
+    args = parser.parse_args()
+
+    readings = make_readings(args.readings)
+    event = {
+        'plant_id': [r['plant_id'] for r in readings],
+        'temperature': [r['temp'] for r in readings],
+        'humidity': [r['humidity'] for r in readings],
+        'water_level': [r['water_level'] for r in readings],
+    }
+    batched = evaluate(stateless_engine(), event, time.time())
+    for reading in readings:
+        expected = legacy_check_reading(reading)
+        if batched.get(reading['plant_id'], []) != expected:
+            sys.exit(f"Mismatch for {reading}: {batched.get(reading['plant_id'])} != {expected}")
+    print(f"Rule engine and scalar checks agree on {args.readings} readings")
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        scalar_publishes = sum(len(legacy_check_reading(r)) for r in split_batch(event))
+    scalar_s = (time.perf_counter() - start) / args.repeat
+    engine = stateless_engine()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        batch_publishes = len(evaluate(engine, event, time.time()))
+    batch_s = (time.perf_counter() - start) / args.repeat
+
+    print(f"{'mode':>8} {'ms/batch':>9} {'publishes':>10}")
+    print(f"{'scalar':>8} {scalar_s * 1e3:>9.2f} {scalar_publishes:>10}")
+    print(f"{'batched':>8} {batch_s * 1e3:>9.2f} {batch_publishes:>10}")
+
+    # A plant whose temperature hovers just around the high threshold
+    high = lamda_func.TEMP_RANGE[1]
+    temps = high + 0.15 * np.sin(np.arange(args.ticks) / 5) + np.random.normal(0, 0.05, args.ticks)
+    for label, engine in (("stateless", stateless_engine()), ("default", RuleEngine(lamda_func.RULES))):
+        sent = 0
+        for tick, temp in enumerate(temps):
+            reading = {'plant_id': ['plant_1'], 'temperature': [temp], 'humidity': [60.5], 'water_level': [34000]}
+            sent += len(evaluate(engine, reading, tick * 2.0))
+        print(f"{label:>9} rules: {sent} commands over {args.ticks} readings hovering around {high}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Cold start and warm invocation cost of the lambda handler, against a stubbed IoT client.
+
+Cold start: in --cold-runs fresh interpreters, the time to import NumPy,
+which every invocation needs and lamda_func imports eagerly, to import the
+rest of lamda_func, to run a first invocation whose readings are all in range, and
+to create the boto3 IoT Data client, which lamda_func used to do at import
+and now does on the first command. No request is sent, creating the
+client does not touch the network.
+
+Warm: one batch event of --plants readings, all out of range so every
+plant gets a command message, handled --invocations times with the IoT
+client replaced by a stub answering each publish after --latency ms, as
+a round trip to AWS IoT Core would. The rule state is reset before each
+invocation so the commands are due every time. With one publish worker
+the messages go out one after another, as they used to.
+
+    python benchmarks/bench_lambda_coldstart.py --plants 20 --latency 20 --workers 1 4 8 16
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+LAMDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lamda")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, LAMDA_DIR)
+
+import lamda_func  # noqa: E402
+from rules import RuleEngine  # noqa: E402
+
+# Run in a fresh interpreter, prints the cold start timings as JSON
+COLD_START = """
+import json, sys, time
+started = time.perf_counter()
+import numpy
+numpy_imported = time.perf_counter()
+import lamda_func
+imported = time.perf_counter()
+boto3_at_import = 'boto3' in sys.modules
+lamda_func.lambda_handler({'plant_id': 'plant_1', 'temp': 23.5, 'humidity': 60.5, 'water_level': 34000}, None)
+invoked = time.perf_counter()
+lamda_func.get_iot_client()
+client = time.perf_counter()
+print(json.dumps({'numpy': numpy_imported - started, 'import': imported - numpy_imported,
+                  'invocation': invoked - imported, 'client': client - invoked, 'boto3_at_import': boto3_at_import}))
+"""
+
+
+class StubIotClient:
+    """Stands in for the boto3 IoT Data client, each publish takes latency seconds."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.published = 0
+        self.lock = threading.Lock()
+
+    def publish(self, topic, qos, payload):
+        time.sleep(self.latency)
+        with self.lock:
+            self.published += 1
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+
+def cold_start(runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', COLD_START], cwd=LAMDA_DIR, capture_output=True, text=True,
+                                check=True).stdout
+        results.append(json.loads(output))
+    return {key: np.median([result[key] for result in results]) for key in results[0]}
+
+
+def warm(plants, workers, invocations):
+    event = {
+        'plant_id': [f'plant_{i + 1}' for i in range(plants)],
+        'temperature': [23.5] * plants,
+        'humidity': [60.5] * plants,
+        'water_level': [1000.0] * plants,
+    }
+    if lamda_func.publish_pool is not None:
+        lamda_func.publish_pool.shutdown()
+        lamda_func.publish_pool = None
+    lamda_func.PUBLISH_WORKERS = workers
+    latencies = []
+    for _ in range(invocations):
+        lamda_func.rule_engine = RuleEngine(lamda_func.RULES, lamda_func.PLANT_RULES)
+        started = time.perf_counter()
+        lamda_func.lambda_handler(json.loads(json.dumps(event)), None)
+        latencies.append(time.perf_counter() - started)
+    return np.percentile(latencies, [50, 99])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cold-runs", type=int, default=5, help="fresh interpreters timed, the median is kept")
+    parser.add_argument("--plants", type=int, default=20, help="plants with a command per invocation")
+    parser.add_argument("--latency", type=float, default=20, help="ms per publish of the stubbed client")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8, 16], help="publish workers to compare")
+    parser.add_argument("--invocations", type=int, default=20, help="warm invocations per worker count")
+    args = parser.parse_args()
+
+    cold = cold_start(args.cold_runs)
+    print(f"Cold start, median of {args.cold_runs} runs")
+    print(f"  {'import numpy':<30} {cold['numpy'] * 1e3:8.1f} ms, needed by every invocation")
+    print(f"  {'import lamda_func':<30} {cold['import'] * 1e3:8.1f} ms, boto3 imported: "
+          f"{'yes' if cold['boto3_at_import'] else 'no'}")
+    print(f"  {'first invocation, no command':<30} {cold['invocation'] * 1e3:8.1f} ms")
+    print(f"  {'boto3 import and client':<30} {cold['client'] * 1e3:8.1f} ms, paid at import before, "
+          f"now on the first command")
+
+    stub = lamda_func.iot_client = StubIotClient(args.latency / 1e3)
+    print(f"\nWarm, {args.plants} command messages per invocation, {args.latency:g} ms per publish")
+    print(f"{'workers':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for workers in args.workers:
+        p50, p99 = warm(args.plants, workers, args.invocations)
+        print(f"{workers:>8} {p50 * 1e3:>8.1f} {p99 * 1e3:>8.1f}")
+    expected = args.plants * args.invocations * len(args.workers)
+    if stub.published != expected:
+        sys.exit(f"published {stub.published} command messages, expected {expected}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Many viewers on one headless monitor server.
+
+Runs monitor_server.MonitorServer in its own process on a RingStore that a
+feeder thread fills with a reading of every plant --rate times a second,
+then connects --viewers WebSocket viewers to it. Every viewer asks for the
+fleet and a few of the --popular plants; --slow of them read slowly through a small socket
+buffer, like dashboards on a bad link. Reported per run:
+
+* the server's work per frame tick and how many distinct frames it had to
+  encode for the frames it sent (viewers asking for the same share one);
+* frames skipped for slow viewers, whose updates were coalesced instead;
+* staleness, the age of the newest sample of a frame when it arrives, for
+  the fast and the slow viewers: skipping keeps the slow ones current
+  instead of letting them fall behind on a growing queue.
+
+    python benchmarks/bench_monitor_server.py --viewers 10 100 300 --plants 1000
+    python benchmarks/bench_monitor_server.py --viewers 100 --seconds 30 --high-water 1000000000
+"""
+import argparse
+import asyncio
+import base64
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Simulation"))
+
+from monitor_server import MonitorServer, encode_frame, read_frame, TEXT, HIGH_WATER  # noqa: E402
+from store import RingStore  # noqa: E402
+
+
+def serve(plants, depth, rate, frame_interval, high_water, ports, stop_event):
+    # Server process: the store, a feeder standing in for ingest, and the server
+    store = RingStore(plants, depth)
+    plant_ids = [f'plant_{i + 1}' for i in range(plants)]
+    server = MonitorServer(store, plant_ids, port=0, frame_interval=frame_interval,
+                           high_water=high_water).start()
+    ports.put(server.port)
+    slots = np.arange(plants)
+    rng = np.random.default_rng(1)
+    next_tick = time.monotonic()
+    while not stop_event.is_set():
+        store.append_many(slots, np.full(plants, time.time_ns()), rng.uniform(23, 24, plants),
+                          rng.uniform(60, 61, plants), rng.uniform(33000, 36000, plants))
+        next_tick += 1 / rate
+        time.sleep(max(0.0, next_tick - time.monotonic()))
+    server.stop()
+
+
+class ViewerResult:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.staleness = []
+
+
+async def viewer(port, plant_ids, slow, args, result):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if slow:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    await asyncio.get_running_loop().sock_connect(sock, ('127.0.0.1', port))
+    reader, writer = await asyncio.open_connection(sock=sock, limit=16384 if slow else 1 << 20)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write((f'GET /ws HTTP/1.1\r\nHost: 127.0.0.1\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                  f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n').encode())
+    await reader.readuntil(b'\r\n\r\n')
+    request = {'fleet': True, 'subscribe': plant_ids}
+    writer.write(encode_frame(TEXT, json.dumps(request).encode(), os.urandom(4)))
+    deadline = time.monotonic() + args.seconds
+    try:
+        while time.monotonic() < deadline:
+            opcode, payload = await asyncio.wait_for(read_frame(reader), deadline - time.monotonic())
+            if opcode != TEXT:
+                continue
+            result.frames += 1
+            result.bytes += len(payload)
+            frame = json.loads(payload)
+            newest = max([max(entry['ts']) for entry in frame['plants']]
+                         + ([max(frame['fleet']['ts'])] if frame['fleet'] else []))
+            result.staleness.append((time.time_ns() - newest) / 1e6)
+            if slow:
+                await asyncio.sleep(len(payload) / args.slow_rate)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        writer.close()
+
+
+async def run_viewers(port, count, args):
+    random.seed(1)
+    plant_ids = [f'plant_{i + 1}' for i in range(min(args.popular, args.plants))]
+    slow_count = int(count * args.slow)
+    results = [ViewerResult() for _ in range(count)]
+    await asyncio.gather(*(
+        viewer(port, random.sample(plant_ids, args.plants_per_viewer), i < slow_count, args, result)
+        for i, result in enumerate(results)))
+    return results[slow_count:], results[:slow_count]
+
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--viewers", type=int, nargs="+", default=[10, 100], help="viewer counts to run")
+    parser.add_argument("--plants", type=int, default=1000, help="number of plants")
+    parser.add_argument("--rate", type=float, default=1.0, help="readings of every plant per second")
+    parser.add_argument("--plants-per-viewer", type=int, default=1, help="plants each viewer subscribes to")
+    parser.add_argument("--popular", type=int, default=20, help="plants the viewers pick their plants from")
+    parser.add_argument("--slow", type=float, default=0.1, help="share of viewers on a slow link")
+    parser.add_argument("--slow-rate", type=float, default=20000, help="bytes per second a slow viewer reads")
+    parser.add_argument("--frame-interval", type=float, default=0.25, help="seconds between frames")
+    parser.add_argument("--high-water", type=int, default=HIGH_WATER,
+                        help="unsent bytes above which a viewer is skipped, a huge value queues every frame")
+    parser.add_argument("--seconds", type=float, default=5.0, help="duration of each run")
+    args = parser.parse_args()
+
+    print(f"{args.plants} plants at {args.rate:g} readings/s, frames every {args.frame_interval:g} s, "
+          f"{args.slow:.0%} slow viewers at {args.slow_rate / 1000:g} kB/s")
+    print(f"{'viewers':>8} {'frames':>7} {'encoded':>8} {'skipped':>8} {'tick ms':>8} {'max ms':>7} "
+          f"{'MB/s':>6} {'fast p50':>9} {'fast p99':>9} {'slow p50':>9} {'slow p99':>9}")
+    for count in args.viewers:
+        ports, stop_event = multiprocessing.Queue(), multiprocessing.Event()
+        server = multiprocessing.Process(target=serve, daemon=True, args=(
+            args.plants, 50, args.rate, args.frame_interval, args.high_water, ports, stop_event))
+        server.start()
+        port = ports.get()
+        fast, slow = asyncio.run(run_viewers(port, count, args))
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}/stats') as response:
+            stats = json.load(response)
+        stop_event.set()
+        server.join()
+        fast_staleness = [s for result in fast for s in result.staleness]
+        slow_staleness = [s for result in slow for s in result.staleness]
+        mb_per_s = stats['bytes_sent'] / args.seconds / 1e6
+        print(f"{count:>8} {stats['frames_sent']:>7} {stats['frames_encoded']:>8} {stats['frames_skipped']:>8} "
+              f"{stats['mean_tick_ms']:>8.2f} {stats['max_tick_ms']:>7.1f} {mb_per_s:>6.2f} "
+              f"{percentile(fast_staleness, 50):>9.0f} {percentile(fast_staleness, 99):>9.0f} "
+              f"{percentile(slow_staleness, 50):>9.0f} {percentile(slow_staleness, 99):>9.0f}")
+    print("staleness in ms, age of the newest sample of a frame on arrival")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Time the plant model's step and check that commands control the plants.
+
+Step: one PlantModel.step over --plants plants, against drawing the same
+readings one random.uniform call at a time as Sending_data did, both per
+tick. The step must fit in the publish interval, a second by default.
+
+Control: --loop-plants plants are simulated for --hours with the lambda's
+default rules evaluated on every tick and their commands applied to the
+model, and again without applying them. Reported per run is the share of
+readings outside each rule's range and the commands sent.
+
+    python benchmarks/bench_plant_model.py --plants 1000 10000 100000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Simulation"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lamda"))
+
+import Sending_data  # noqa: E402
+import lamda_func  # noqa: E402
+from plant_model import PlantModel  # noqa: E402
+from rules import RuleEngine  # noqa: E402
+
+
+def time_step(plants, repeat):
+    model = PlantModel(plants, seed=1)
+    model.command(None, 1)
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        model.step(1.0)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def time_uniform(plants, repeat):
+    plant_ids = [f'plant_{i + 1}' for i in range(plants)]
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        Sending_data.make_readings(plant_ids)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def control(plants, hours, tick, apply_commands):
+    model = PlantModel(plants, seed=2)
+    engine = RuleEngine(lamda_func.RULES)
+    plant_ids = np.array([f'plant_{i + 1}' for i in range(plants)])
+    positions = {plant_id: i for i, plant_id in enumerate(plant_ids.tolist())}
+    bounds = [(rule.metric, rule.settings()['low'], rule.settings()['high']) for rule in lamda_func.RULES]
+    outside = np.zeros(len(bounds))
+    commands = steps = 0
+    while model.time < hours * 3600:
+        model.step(tick)
+        steps += 1
+        temperatures, humidities, water_levels = model.readings()
+        metrics = {'temp': temperatures, 'humidity': humidities, 'water_level': water_levels}
+        for i, (metric, low, high) in enumerate(bounds):
+            outside[i] += np.count_nonzero((metrics[metric] < low) | (metrics[metric] > high))
+        for plant_id, plant_commands in engine.evaluate(plant_ids, metrics, model.time).items():
+            commands += len(plant_commands)
+            if apply_commands:
+                for command in plant_commands:
+                    model.command(positions[plant_id], int(command))
+    return outside / (steps * plants), commands
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plants", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="plants of the timed steps")
+    parser.add_argument("--repeat", type=int, default=5, help="timed steps per size, the best is kept")
+    parser.add_argument("--loop-plants", type=int, default=1000, help="plants of the control runs")
+    parser.add_argument("--hours", type=float, default=2.0, help="simulated hours of each control run")
+    parser.add_argument("--tick", type=float, default=5.0, help="seconds per step of the control runs")
+    args = parser.parse_args()
+
+    print(f"{'plants':>8} {'step ms':>9} {'uniform ms':>11} {'speedup':>8}")
+    for plants in args.plants:
+        step = time_step(plants, args.repeat)
+        uniform = time_uniform(plants, args.repeat)
+        print(f"{plants:>8} {step * 1e3:>9.2f} {uniform * 1e3:>11.2f} {uniform / step:>7.1f}x")
+
+    print(f"\n{args.loop_plants} plants for {args.hours:g} h, a step every {args.tick:g} s")
+    names = [rule.name for rule in lamda_func.RULES]
+    print(f"{'commands':>9} " + " ".join(f"{name + ' out %':>16}" for name in names) + f" {'sent':>8}")
+    for apply_commands in (False, True):
+        outside, commands = control(args.loop_plants, args.hours, args.tick, apply_commands)
+        print(f"{'applied' if apply_commands else 'ignored':>9} "
+              + " ".join(f"{100 * share:>16.1f}" for share in outside) + f" {commands:>8}")
+
+
+if __name__ == '__main__':
+    main()
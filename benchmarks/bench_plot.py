@@ -0,0 +1,106 @@
+"""Measure the rendering cost of plant windows as more of them are open.
+
+Compares the old full redraw (clear the axes, plot again, canvas.draw())
+with the incremental, blitted PlantPlot. Each frame appends one sample per
+plant and redraws every open window; the numbers are frames/s over all
+windows and ms per window redraw. Rendering uses the Agg canvas, which is
+what the Tk canvas draws into, so no display is needed.
+
+    python benchmarks/bench_plot.py --windows 1 4 12 --frames 30
+"""
+import argparse
+import os
+import sys
+import time
+
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure  # noqa: E402
+from matplotlib.backends.backend_agg import FigureCanvasAgg  # noqa: E402
+import numpy as np  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Simulation"))
+
+from store import RingStore  # noqa: E402
+from plant_plot import PlantPlot, PLOTS  # noqa: E402
+
+
+class BlitCanvas(FigureCanvasAgg):
+    # The Tk canvas copies the blitted box to the screen, Agg has no screen
+    def blit(self, bbox=None):
+        pass
+
+
+def legacy_redraw(plant_id, store, slot, fig, axs, canvas):
+    # The redraw of local_monitor.update_plot before incremental updates
+    history = store.snapshot(slot)
+    fig.suptitle(f"{plant_id} Data", fontsize='large')
+    for i, (ax, (name, ylabel)) in enumerate(zip(axs, PLOTS)):
+        ax.clear()
+        ax.set_ylabel(ylabel)
+        if i < len(axs) - 1:
+            ax.tick_params(axis='x', which='both', bottom=False, top=False, labelbottom=False)
+        else:
+            ax.set_xlabel('Time')
+            ax.tick_params(axis='x', rotation=45)
+        ax.plot(history['timestamps'], history[name], marker='o', linestyle='-')
+    fig.subplots_adjust(hspace=0.4, bottom=0.15)
+    fig.autofmt_xdate()
+    canvas.draw()
+
+
+def feed(store, plants, now_ns):
+    rng = np.random.default_rng()
+    store.append_many(np.arange(plants), np.full(plants, now_ns, dtype=np.int64),
+                      rng.uniform(23, 24, plants), rng.uniform(60, 61, plants),
+                      rng.uniform(33000, 36000, plants))
+
+
+def run(windows, frames, history, incremental, new_samples=True):
+    store = RingStore(capacity=windows, depth=history)
+    start_ns = time.time_ns()
+    for i in range(history):
+        feed(store, windows, start_ns + i * 2 * 10 ** 9)
+
+    views = []
+    for slot in range(windows):
+        fig = Figure(figsize=(6.4, 4.8))
+        canvas = BlitCanvas(fig)
+        axs = fig.subplots(3, 1, sharex=incremental)
+        if incremental:
+            plot = PlantPlot(f'plant_{slot + 1}', store, slot, fig, axs, canvas)
+            canvas.draw()
+            plot.update()
+            views.append(plot.update)
+        else:
+            views.append(lambda slot=slot, fig=fig, axs=axs, canvas=canvas:
+                         legacy_redraw(f'plant_{slot + 1}', store, slot, fig, axs, canvas))
+
+    elapsed = 0.0
+    for frame in range(frames):
+        if new_samples:
+            feed(store, windows, start_ns + (history + frame) * 2 * 10 ** 9)
+        begin = time.perf_counter()
+        for view in views:
+            view()
+        elapsed += time.perf_counter() - begin
+    return frames / elapsed, elapsed / (frames * windows) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--windows", type=int, nargs="+", default=[1, 4, 12])
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--history", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'windows':>8} {'mode':>12} {'frames/s':>9} {'ms/redraw':>10}")
+    for windows in args.windows:
+        for label, incremental, new_samples in (("full", False, True), ("blitted", True, True),
+                                                ("idle", True, False)):
+            fps, ms = run(windows, args.frames, args.history, incremental, new_samples)
+            print(f"{windows:>8} {label:>12} {fps:>9.1f} {ms:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Publishing to a fast and a slow broker, directly or through publisher.Publisher.
+
+The simulator publishes every message to AWS IoT Core and to the public
+dashboard broker. Here the first is a local broker and the second the same
+kind of broker behind a proxy forwarding only --slow-rate bytes per second,
+like a congested public broker. Simulator messages are published at --rate
+messages per second for --seconds, in two ways:
+
+* direct: one paho client per broker, both published to from the loop, as
+  Sending_data did. Nothing holds back the slow client's outbound queue;
+* pooled: a Publisher with a blocking sink for the fast broker and a
+  drop-oldest sink with a bounded queue for the slow one.
+
+Reported per way: the messages that reached a subscriber of each broker
+within a second of the end, their latency on the fast broker, the peak of messages waiting in the slow
+client (paho's outbound packets, plus the sink's queue when pooled) and
+the messages the slow sink dropped.
+
+    python benchmarks/bench_publisher.py --rate 2000 --slow-rate 50000
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Simulation"))
+
+import Sending_data  # noqa: E402
+from local_broker import LocalBroker  # noqa: E402
+from publisher import Publisher, Sink  # noqa: E402
+
+# Kernel send buffer of the connections to the slow broker
+SEND_BUFFER = 16 * 1024
+
+
+class ThrottledProxy:
+    """Forwards TCP connections to a broker, client to broker at most rate bytes per second."""
+
+    def __init__(self, upstream_port, rate):
+        self.upstream_port = upstream_port
+        self.rate = rate
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(asyncio.start_server(self._handle, '127.0.0.1', 0))
+            self.port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+
+    async def _pipe(self, reader, writer, rate=None):
+        try:
+            while True:
+                data = await reader.read(1024 if rate else 65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+                if rate:
+                    await asyncio.sleep(len(data) / rate)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, reader, writer):
+        writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        upstream_reader, upstream_writer = await asyncio.open_connection('127.0.0.1', self.upstream_port)
+        try:
+            await asyncio.gather(self._pipe(reader, upstream_writer, self.rate), self._pipe(upstream_reader, writer))
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        async def shutdown():
+            self.server.close()
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def client(port, on_message=None, send_buffer=None):
+    c = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    c.on_message = on_message
+    c.connect('127.0.0.1', port, 60)
+    if send_buffer:
+        # A kernel buffer the size of a WAN link's, so the backlog shows up in the process
+        c.socket().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+    if on_message is not None:
+        c.subscribe(Sending_data.MQTT_TOPIC)
+    c.loop_start()
+    return c
+
+
+class Received:
+    def __init__(self):
+        self.count = 0
+        self.latencies = []
+
+    def on_message(self, c, userdata, message):
+        self.count += 1
+        self.latencies.append((time.time_ns() - json.loads(message.payload)['ts']) / 1e6)
+
+
+def run(way, fast_port, slow_port, args):
+    fast, slow = Received(), Received()
+    subscribers = [client(fast_port, fast.on_message), client(slow_port, slow.on_message)]
+    time.sleep(0.3)
+    if way == 'direct':
+        clients = [client(fast_port), client(slow_port, send_buffer=SEND_BUFFER)]
+
+        def publish(topic, payload):
+            for c in clients:
+                c.publish(topic, payload)
+
+        def waiting():
+            return len(clients[1]._out_packet)
+    else:
+        publisher = Publisher([
+            Sink('fast', lambda: client(fast_port), policy='block', queue_size=args.queue_size),
+            Sink('slow', lambda: client(slow_port, send_buffer=SEND_BUFFER), policy='drop-oldest',
+                 queue_size=args.queue_size),
+        ])
+        publish = publisher.publish
+        slow_sink = publisher.sinks[1]
+
+        def waiting():
+            return slow_sink.queue.qsize() + len(slow_sink.connections[0].client._out_packet)
+
+    peak = [0]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.05):
+            peak[0] = max(peak[0], waiting())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    plant_ids = [f'plant_{i + 1}' for i in range(100)]
+    interval = 1 / args.rate
+    start = next_send = time.monotonic()
+    sent = 0
+    while time.monotonic() - start < args.seconds:
+        now = time.monotonic()
+        if next_send > now:
+            time.sleep(next_send - now)
+        next_send += interval
+        publish(Sending_data.MQTT_TOPIC, Sending_data.make_message([plant_ids[sent % 100]], 0, seq=sent))
+        sent += 1
+    elapsed = time.monotonic() - start
+    time.sleep(1)
+    done.set()
+    sampler.join()
+    received = fast.count, slow.count
+    dropped = 0
+    if way == 'direct':
+        # Throw the backlog away instead of waiting for it to drain
+        clients[1].socket().shutdown(socket.SHUT_RDWR)
+        for c in clients:
+            c.loop_stop()
+            c.disconnect()
+    else:
+        dropped = slow_sink.stats()['dropped']
+        publisher.close(timeout=0.5)
+    for c in subscribers:
+        c.loop_stop()
+        c.disconnect()
+    return sent / elapsed, received, fast.latencies, peak[0], dropped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=2000, help="messages per second")
+    parser.add_argument("--slow-rate", type=float, default=50000, help="bytes per second the slow broker takes")
+    parser.add_argument("--queue-size", type=int, default=1000, help="queue of each sink")
+    parser.add_argument("--seconds", type=float, default=5, help="duration of each run")
+    args = parser.parse_args()
+
+    fast_broker = LocalBroker(port=0).start()
+    slow_broker = LocalBroker(port=0).start()
+    proxy = ThrottledProxy(slow_broker.port, args.slow_rate)
+    print(f"{args.rate:g} messages/s, slow broker at {args.slow_rate / 1000:g} kB/s")
+    print(f"{'way':>7} {'sent/s':>7} {'fast got':>9} {'fast p50 ms':>12} {'fast p99 ms':>12} {'slow got':>9} "
+          f"{'slow peak':>10} {'dropped':>8}")
+    for way in ('direct', 'pooled'):
+        rate, (fast, slow), latencies, peak, dropped = run(way, fast_broker.port, proxy.port, args)
+        print(f"{way:>7} {rate:>7.0f} {fast:>9} {np.percentile(latencies, 50):>12.1f} "
+              f"{np.percentile(latencies, 99):>12.1f} {slow:>9} {peak:>10} {dropped:>8}")
+    print("slow peak: messages waiting for the slow broker at most")
+    proxy.stop()
+    fast_broker.stop()
+    slow_broker.stop()
+
+
+if __name__ == '__main__':
+    main()
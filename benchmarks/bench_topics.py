@@ -0,0 +1,141 @@
+"""Monitor ingest cost with the flat topic and with per-plant topics.
+
+A publisher sends a reading of each of --plants plants every --interval
+seconds through a local broker, built with the simulator's own functions
+and plant model:
+
+* flat: one message per plant on sensor/data, the monitor subscribes to
+  all of it, as local_monitor does by default;
+* plant: the same messages on sensor/data/<plant_id> and the fleet's
+  aggregate on sensor/aggregate every --aggregate-interval seconds; the
+  monitor subscribes to the aggregate and to --windows plants, as
+  local_monitor --topics plant does with that many windows open.
+
+The monitor runs in its own process, decoding into a RingStore with
+ingest.Ingestor; its CPU time is what is reported, with the messages and
+readings it received.
+
+    python benchmarks/bench_topics.py --plants 1000 --windows 0 2 10
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Simulation"))
+
+import Sending_data  # noqa: E402
+from ingest import Ingestor  # noqa: E402
+from local_broker import LocalBroker  # noqa: E402
+from plant_model import PlantModel  # noqa: E402
+from payloads import DATA_TOPIC, AGGREGATE_TOPIC, plant_topic  # noqa: E402
+from store import RingStore  # noqa: E402
+
+
+def monitor(port, plants, topics, windows, ready, stop_event, results):
+    data_store = RingStore(plants, 50)
+    fleet_store = RingStore(plants, 1)
+    ingest = Ingestor(data_store)
+    aggregate_ingest = Ingestor(fleet_store)
+    counts = {'messages': 0, 'readings': 0}
+
+    def on_message(client, userdata, message):
+        counts['messages'] += 1
+        if message.topic == AGGREGATE_TOPIC:
+            counts['readings'] += aggregate_ingest(message.payload)
+        else:
+            counts['readings'] += ingest(message.payload)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_message = on_message
+    client.connect('127.0.0.1', port, 60)
+    if topics == 'flat':
+        client.subscribe(DATA_TOPIC, 1)
+    else:
+        client.subscribe([(AGGREGATE_TOPIC, 1)] + [(plant_topic(f'plant_{i + 1}'), 1) for i in range(windows)])
+    client.loop_start()
+    time.sleep(0.3)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    ready.set()
+    stop_event.wait()
+    time.sleep(0.5)
+    client.loop_stop()
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime
+    results.put((cpu, counts['messages'], counts['readings']))
+
+
+def publish(client, plant_ids, topics, args):
+    model = PlantModel(len(plant_ids), seed=1)
+    groups = [(plant_ids[i:i + 100], slice(i, i + 100)) for i in range(0, len(plant_ids), 100)]
+    tick = args.interval / len(groups)
+    start = next_send = next_aggregate = time.monotonic()
+    seq = 0
+    while time.monotonic() - start < args.seconds:
+        model.step(args.interval)
+        for group, span in groups:
+            now = time.monotonic()
+            if next_send > now:
+                time.sleep(next_send - now)
+            next_send += tick
+            readings = Sending_data.model_readings(model, span)
+            if topics == 'flat':
+                messages = [(DATA_TOPIC, payload) for _, payload in
+                            Sending_data.plant_messages(group, *readings, seq=seq)]
+            else:
+                messages = list(Sending_data.plant_messages(group, *readings, seq=seq))
+                if now >= next_aggregate:
+                    messages.extend((AGGREGATE_TOPIC, payload) for payload in
+                                    Sending_data.aggregate_messages(plant_ids, *Sending_data.model_readings(model)))
+                    next_aggregate = now + args.aggregate_interval
+            for topic, payload in messages:
+                client.publish(topic, payload)
+            seq += len(messages)
+
+
+def run(port, topics, windows, args):
+    plant_ids = [f'plant_{i + 1}' for i in range(args.plants)]
+    ready, stop_event, results = multiprocessing.Event(), multiprocessing.Event(), multiprocessing.Queue()
+    process = multiprocessing.Process(target=monitor, args=(port, args.plants, topics, windows, ready,
+                                                            stop_event, results))
+    process.start()
+    ready.wait()
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.connect('127.0.0.1', port, 60)
+    client.loop_start()
+    publish(client, plant_ids, topics, args)
+    stop_event.set()
+    result = results.get()
+    process.join()
+    client.loop_stop()
+    client.disconnect()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plants", type=int, default=1000, help="number of plants")
+    parser.add_argument("--windows", type=int, nargs="+", default=[0, 2, 10],
+                        help="plant windows open in the per-plant runs")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between two readings of a plant")
+    parser.add_argument("--aggregate-interval", type=float, default=5.0, help="seconds between two aggregates")
+    parser.add_argument("--seconds", type=float, default=10.0, help="duration of each run")
+    args = parser.parse_args()
+
+    broker = LocalBroker(port=0).start()
+    print(f"{args.plants} plants, a reading each every {args.interval:g} s, for {args.seconds:g} s")
+    print(f"{'topics':>7} {'windows':>8} {'messages':>9} {'readings':>9} {'monitor cpu s':>14} {'cpu %':>6}")
+    runs = [('flat', None)] + [('plant', windows) for windows in args.windows]
+    for topics, windows in runs:
+        cpu, messages, readings = run(broker.port, topics, windows or 0, args)
+        print(f"{topics:>7} {'all' if windows is None else windows:>8} {messages:>9} {readings:>9} {cpu:>14.2f} "
+              f"{100 * cpu / args.seconds:>6.1f}")
+    broker.stop()
+
+
+if __name__ == '__main__':
+    main()
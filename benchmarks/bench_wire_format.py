@@ -0,0 +1,83 @@
+"""Micro-benchmark of the JSON and binary sensor wire formats.
+
+For a single reading and for a batch, reports the payload size and the
+encode and decode cost per reading. Decoding includes turning the time into
+the datetime the monitor stores: the legacy JSON message goes through
+datetime.strptime on the ctime string, the others use the epoch timestamp.
+
+    python benchmarks/bench_wire_format.py --batch 100
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Simulation"))
+
+from payloads import (encode_reading, encode_batch, encode_binary,  # noqa: E402
+                      decode_payload, CTIME_FORMAT)
+
+
+def legacy_encode(plant_id, temperature, humidity, water_level, timestamp):
+    # The message as it was sent before epoch timestamps were added
+    return json.dumps({"plant_id": plant_id, "temperature": temperature, "humidity": humidity,
+                       "water_level": water_level, "time": timestamp})
+
+
+def legacy_decode(raw):
+    payload = json.loads(raw)
+    return [datetime.strptime(payload['time'], CTIME_FORMAT)]
+
+
+def decode_to_datetimes(raw):
+    return [datetime.fromtimestamp(reading['ts'] / 1e9) for reading in decode_payload(raw)]
+
+
+def bench(label, encode, decode, readings, number):
+    payload = encode()
+    if isinstance(payload, str):
+        payload = payload.encode()
+    encode_s = timeit.timeit(encode, number=number) / number / readings
+    decode_s = timeit.timeit(lambda: decode(payload), number=number) / number / readings
+    print(f"{label:>16} {len(payload):>9} {len(payload) / readings:>13.1f} "
+          f"{encode_s * 1e6:>11.2f} {decode_s * 1e6:>11.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch", type=int, default=100, help="readings per batch message")
+    parser.add_argument("--number", type=int, default=2000, help="repetitions per measurement")
+    args = parser.parse_args()
+
+    ids = [f'plant_{i + 1}' for i in range(args.batch)]
+    temperatures = [random.uniform(23, 24) for _ in ids]
+    humidities = [random.uniform(60, 61) for _ in ids]
+    water_levels = [random.uniform(33000, 36000) for _ in ids]
+    ctime, ts = time.ctime(), time.time_ns()
+    batch_number = max(1, args.number // args.batch)
+
+    print(f"{'format':>16} {'bytes':>9} {'bytes/reading':>13} {'encode us':>11} {'decode us':>11}")
+    print(f"{'':>16} {'':>9} {'':>13} {'per reading':>11} {'per reading':>11}")
+    bench("json (legacy)",
+          lambda: legacy_encode(ids[0], temperatures[0], humidities[0], water_levels[0], ctime),
+          legacy_decode, 1, args.number)
+    bench("json",
+          lambda: encode_reading(ids[0], temperatures[0], humidities[0], water_levels[0], ctime, ts),
+          decode_to_datetimes, 1, args.number)
+    bench("binary",
+          lambda: encode_binary(ids[:1], temperatures[:1], humidities[:1], water_levels[:1], ts),
+          decode_to_datetimes, 1, args.number)
+    bench(f"json batch {args.batch}",
+          lambda: encode_batch(ids, temperatures, humidities, water_levels, ctime, ts),
+          decode_to_datetimes, args.batch, batch_number)
+    bench(f"binary batch {args.batch}",
+          lambda: encode_binary(ids, temperatures, humidities, water_levels, ts),
+          decode_to_datetimes, args.batch, batch_number)
+
+
+if __name__ == "__main__":
+    main()
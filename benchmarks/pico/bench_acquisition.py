@@ -0,0 +1,163 @@
+# Compare single sensor reads with the filtered acquisition of acquisition.py.
+#
+# Simulates a day of 5 s samples on a fake clock. The water level falls
+# slowly and its ADC conversions are noisy, with rare spikes; the DHT11
+# reports the temperature and humidity in whole units with a unit of
+# flicker, now and then a bad value, and fails a read with OSError now and
+# then. The old firmware took one conversion and one DHT11 read per sample;
+# the new one reads through Acquisition, with the DHT11 also polled between
+# samples every aws_pico.DHT_INTERVAL_MS. Reported per way: the RMS error of
+# each metric against the true value, the readings ReportFilter lets
+# through, the samples lost to a failed read, the DHT11 reads and ADC
+# conversions done, and the CPU time per sample. Runs under the
+# MicroPython unix port and CPython:
+#
+#     micropython benchmarks/pico/bench_acquisition.py
+#     python benchmarks/pico/bench_acquisition.py --hours 24 --noise 150
+
+import sys
+
+base = sys.argv[0].rsplit('/', 1)[0] if '/' in sys.argv[0] else '.'
+sys.path.insert(0, base + '/stubs')
+sys.path.insert(0, base + '/../../controller')
+
+import math  # noqa: E402
+import random  # noqa: E402
+import time  # noqa: E402
+import aws_pico  # noqa: E402
+from acquisition import Acquisition  # noqa: E402
+from store_forward import ReportFilter, DEADBANDS, HEARTBEAT_MS  # noqa: E402
+
+SAMPLE_MS = aws_pico.SAMPLE_INTERVAL * 1000
+DAY_MS = 24 * 3600 * 1000
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+
+def option(name, default):
+    # argparse is not part of the unix port
+    if name in sys.argv:
+        return int(sys.argv[sys.argv.index(name) + 1])
+    return default
+
+
+def noise(sigma):
+    # About normal, MicroPython's random has no gauss
+    return (random.random() + random.random() + random.random() - 1.5) * 2 * sigma
+
+
+class Plant:
+    # The true values at the fake clock's time
+    def __init__(self):
+        self.now = 0
+
+    def temperature(self):
+        return 23.5 + math.sin(2 * math.pi * self.now / DAY_MS)
+
+    def humidity(self):
+        return 60.5 - 2 * math.sin(2 * math.pi * self.now / DAY_MS)
+
+    def water_level(self):
+        # Drains by 3000 counts and is refilled every 6 hours
+        return 36000 - 3000 * (self.now % (6 * 3600000)) / (6 * 3600000)
+
+
+class NoisyADC:
+    def __init__(self, plant, sigma):
+        self.plant = plant
+        self.sigma = sigma
+        self.conversions = 0
+
+    def read_u16(self):
+        self.conversions += 1
+        value = self.plant.water_level() + noise(self.sigma)
+        if random.random() < 0.01:
+            value += 5000 if random.random() < 0.5 else -5000
+        return max(0, min(65535, int(value)))
+
+
+class FlakyDHT11:
+    def __init__(self, plant):
+        self.plant = plant
+        self.reads = 0
+        self.temp = self.hum = 0
+
+    def measure(self):
+        self.reads += 1
+        if random.random() < 0.02:
+            raise OSError(110)
+        self.temp = int(self.plant.temperature() + noise(0.6) + 0.5)
+        self.hum = int(self.plant.humidity() + noise(0.8) + 0.5)
+        if random.random() < 0.01:
+            self.temp += 10
+
+    def temperature(self):
+        return self.temp
+
+    def humidity(self):
+        return self.hum
+
+
+def simulate(way, samples, sigma):
+    random.seed(3)
+    plant = Plant()
+    adc = NoisyADC(plant, sigma)
+    dht = FlakyDHT11(plant)
+    acquisition = Acquisition(dht, adc, aws_pico.DHT_INTERVAL_MS)
+    report_filter = ReportFilter(DEADBANDS, HEARTBEAT_MS)
+    errors = [0.0, 0.0, 0.0]
+    taken = lost = reports = 0
+    cpu = 0
+    for i in range(samples):
+        sample_time = i * SAMPLE_MS
+        if way == 'filtered':
+            # The acquire task's DHT11 reads since the last sample
+            t = sample_time - SAMPLE_MS + aws_pico.DHT_INTERVAL_MS
+            while t < sample_time:
+                plant.now = t
+                acquisition.poll(t)
+                t += aws_pico.DHT_INTERVAL_MS
+        plant.now = sample_time
+        started = ticks_us()
+        try:
+            if way == 'filtered':
+                reading = acquisition.read(sample_time)
+            else:
+                dht.measure()
+                reading = (dht.temperature(), dht.humidity(), adc.read_u16())
+        except OSError:
+            lost += 1
+            continue
+        finally:
+            cpu += ticks_diff(ticks_us(), started)
+        taken += 1
+        for k, truth in enumerate((plant.temperature(), plant.humidity(), plant.water_level())):
+            errors[k] += (reading[k] - truth) ** 2
+        if report_filter.check(sample_time, *reading) is not ReportFilter.SKIP:
+            reports += 1
+    rms = [math.sqrt(error / max(taken, 1)) for error in errors]
+    return rms, reports, lost, dht.reads, adc.conversions, cpu / samples
+
+
+def main():
+    hours = option('--hours', 24)
+    sigma = option('--noise', 150)
+    samples = hours * 3600 * 1000 // SAMPLE_MS
+    print('%d samples over %d h, ADC noise %d counts' % (samples, hours, sigma))
+    print('%9s %8s %8s %8s %8s %6s %9s %12s %10s' % ('way', 'temp', 'humid', 'water', 'reports', 'lost',
+                                                      'dht reads', 'conversions', 'us/sample'))
+    for way in ('single', 'filtered'):
+        rms, reports, lost, reads, conversions, cpu = simulate(way, samples, sigma)
+        print('%9s %8.2f %8.2f %8.0f %8d %6d %9d %12d %10.0f' % (way, rms[0], rms[1], rms[2], reports, lost,
+                                                                  reads, conversions, cpu))
+    print('temp, humid, water: RMS error against the true value')
+
+
+main()
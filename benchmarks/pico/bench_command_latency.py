@@ -0,0 +1,101 @@
+# Measure how fast the Pico firmware acts on pump commands.
+#
+# Runs the tasks of aws_pico.py against the stubs in stubs/ and feeds pump
+# commands to the stub MQTT client at random moments. The latency of a
+# command is the time from its arrival at the client to the pump pin being
+# switched. The sample times show whether sampling keeps its schedule.
+# For comparison, the old loop, which checked for messages once after each
+# 5 s sleep, is computed from the same arrival times. Runs under the
+# MicroPython unix port and CPython:
+#
+#     micropython benchmarks/pico/bench_command_latency.py --commands 60
+
+import sys
+
+base = sys.argv[0].rsplit('/', 1)[0] if '/' in sys.argv[0] else '.'
+sys.path.insert(0, base + '/stubs')
+sys.path.insert(0, base + '/../../controller')
+
+import random  # noqa: E402
+import time  # noqa: E402
+import aws_pico  # noqa: E402
+from aws_pico import asyncio  # noqa: E402
+
+try:
+    from time import ticks_us, ticks_diff
+except ImportError:
+    def ticks_us():
+        return int(time.perf_counter() * 1000000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+
+def option(name, default):
+    # argparse is not part of the unix port
+    if name in sys.argv:
+        return int(sys.argv[sys.argv.index(name) + 1])
+    return default
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def main():
+    commands = option('--commands', 60)
+    random.seed(1)
+    mqtt = aws_pico.MQTTClient('pico', 'localhost')
+    arrivals = []
+    latencies = []
+    samples = []
+
+    pumping = aws_pico.pumping
+
+    def timed_pumping(state):
+        pumping(state)
+        latencies.append(ticks_diff(ticks_us(), arrivals[len(latencies)]))
+    aws_pico.pumping = timed_pumping
+
+    read = aws_pico.sensors.read
+
+    def timed_read(now):
+        samples.append(ticks_us())
+        return read(now)
+    aws_pico.sensors.read = timed_read
+
+    async def feed():
+        # Deliver one command at a time, 100 to 600 ms apart
+        for i in range(commands):
+            await asyncio.sleep(random.randint(100, 600) / 1000)
+            arrivals.append(ticks_us())
+            mqtt.incoming.append((aws_pico.SUB_TOPIC, b'{"state": "on"}' if i % 2 else b'{"state": "off"}'))
+        while len(latencies) < commands:
+            await asyncio.sleep(0.01)
+
+    async def bench():
+        firmware = asyncio.create_task(aws_pico.run(mqtt))
+        start = ticks_us()
+        while not mqtt.connected:
+            await asyncio.sleep(0.01)
+        await feed()
+        firmware.cancel()
+        return start
+
+    start = asyncio.run(bench())
+
+    # The old loop took a reading and checked for messages every SAMPLE_INTERVAL
+    interval = aws_pico.SAMPLE_INTERVAL * 1000000
+    polled = [interval - ticks_diff(arrival, start) % interval for arrival in arrivals]
+    print('%d pump commands, %d readings taken' % (commands, len(samples)))
+    print('%12s %10s %10s %10s' % ('loop', 'p50 ms', 'p99 ms', 'max ms'))
+    for name, values in (('tasks', latencies), ('polling', polled)):
+        print('%12s %10.1f %10.1f %10.1f' % (name, percentile(values, 50) / 1000, percentile(values, 99) / 1000,
+                                             max(values) / 1000))
+    gaps = [ticks_diff(b, a) / 1000000 for a, b in zip(samples, samples[1:])]
+    if gaps:
+        print('sample interval: %.3f s to %.3f s' % (min(gaps), max(gaps)))
+
+
+main()
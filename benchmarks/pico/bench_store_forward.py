@@ -0,0 +1,141 @@
+# Simulate a day of the Pico W firmware with Wi-Fi outages, on a fake clock.
+#
+# Compares the old loop, one QoS 0 message per 5 s reading that is lost
+# while offline, with the store-and-forward buffer of aws_pico.py, sending
+# every reading or reporting by exception with deltas. The sensors change
+# slowly with some noise, like a DHT11 and a water level do. Uses the
+# firmware's own connect and encode functions against the stubs in stubs/.
+# Runs under the MicroPython unix port and CPython:
+#
+#     micropython benchmarks/pico/bench_store_forward.py
+#     python benchmarks/pico/bench_store_forward.py --hours 24 --outage 30 --every 240
+
+import sys
+
+base = sys.argv[0].rsplit('/', 1)[0] if '/' in sys.argv[0] else '.'
+sys.path.insert(0, base + '/stubs')
+sys.path.insert(0, base + '/../../controller')
+
+import gc  # noqa: E402
+import random  # noqa: E402
+import time  # noqa: E402
+import network  # noqa: E402
+import ujson  # noqa: E402
+import aws_pico  # noqa: E402
+from store_forward import (ReadingBuffer, Forwarder, ReportFilter, DeltaEncoder, encode_batch,  # noqa: E402
+                           BUFFER_CAPACITY, MAX_BATCH, DEADBANDS, HEARTBEAT_MS)
+
+SAMPLE_MS = aws_pico.SAMPLE_INTERVAL * 1000
+
+
+def option(name, default):
+    # argparse is not part of the unix port
+    if name in sys.argv:
+        return int(sys.argv[sys.argv.index(name) + 1])
+    return default
+
+
+def mem_alloc():
+    return gc.mem_alloc() if hasattr(gc, 'mem_alloc') else None
+
+
+def legacy_message(temperature, humidity, water_level):
+    return ujson.dumps({
+        "temperature": temperature,
+        "water_level": aws_pico.water_level_percent(water_level),
+        "humidity": humidity,
+        "date": "2024-1-1"
+    }).encode('utf-8')
+
+
+def sample(i):
+    # Temperature steps by a degree every hour, humidity and water level are noisy
+    temperature = 23 + (i // 720) % 2
+    humidity = 60 + (1 if random.random() < 0.05 else 0)
+    water_level = 34000 + random.randint(-200, 200) - (i % 4320) // 2
+    return temperature, humidity, water_level
+
+
+def simulate(mode, samples, outage_min, every_min, capacity):
+    # Returns the messages, bytes, readings delivered and lost, peak backlog and the buffer
+    random.seed(1)
+    readings = ReadingBuffer(capacity)
+    mqtt = aws_pico.MQTTClient('pico', 'localhost')
+    report_filter = encoder = None
+    if mode == 'exception':
+        report_filter = ReportFilter(DEADBANDS, HEARTBEAT_MS)
+        encoder = DeltaEncoder('plant_1', DEADBANDS, aws_pico.water_level_percent)
+        encode = encoder.encode
+    else:
+        encode = lambda buffer, n: encode_batch(buffer, n, 'plant_1', aws_pico.water_level_percent)  # noqa: E731
+    forwarder = Forwarder(
+        readings,
+        encode=lambda buffer, n: encode(buffer, n).encode('utf-8'),
+        publish=lambda message: mqtt.publish(topic=aws_pico.PUB_TOPIC, msg=message, qos=1),
+        connect=lambda: aws_pico.mqtt_connect(mqtt),
+        sent=encoder.sent if encoder else None,
+        now=0)
+
+    messages = sent_bytes = delivered = lost = peak_backlog = 0
+    for i in range(samples):
+        now = i * SAMPLE_MS
+        network.online = (now // 60000) % every_min >= outage_min
+        reading = sample(i)
+
+        if mode == 'per reading':
+            if network.online:
+                messages += 1
+                delivered += 1
+                sent_bytes += len(legacy_message(*reading))
+            else:
+                lost += 1
+            continue
+
+        kind = ReportFilter.FULL if report_filter is None else report_filter.check(now, *reading)
+        if kind is not ReportFilter.SKIP:
+            readings.append(1700000000 + now // 1000, *reading, full=kind)
+        forwarder.poll(now)
+        if forwarder.connected:
+            try:
+                mqtt.check_msg()
+            except OSError:
+                forwarder.disconnected(now)
+        peak_backlog = max(peak_backlog, readings.count)
+    if mode != 'per reading':
+        messages, delivered, lost = forwarder.messages, forwarder.sent, readings.dropped
+        sent_bytes = sum(len(message) for topic, message in mqtt.published)
+    return messages, sent_bytes, delivered, lost, peak_backlog, readings
+
+
+def main():
+    hours = option('--hours', 24)
+    outage_min = option('--outage', 30)
+    every_min = option('--every', 240)
+    capacity = option('--capacity', BUFFER_CAPACITY)
+    samples = hours * 3600 * 1000 // SAMPLE_MS
+    print('%d h of %d s samples, %d min outage every %d min, buffer of %d readings' % (
+        hours, aws_pico.SAMPLE_INTERVAL, outage_min, every_min, capacity))
+
+    gc.collect()
+    before = mem_alloc()
+    ReadingBuffer(capacity)
+    after = mem_alloc()
+
+    print('%16s %9s %9s %10s %6s %8s' % ('mode', 'messages', 'bytes', 'delivered', 'lost', 'backlog'))
+    start = time.time()
+    for mode in ('per reading', 'store-forward', 'exception'):
+        messages, sent_bytes, delivered, lost, peak_backlog, readings = simulate(
+            mode, samples, outage_min, every_min, capacity)
+        print('%16s %9d %9d %10d %6d %8d' % (mode, messages, sent_bytes, delivered, lost, peak_backlog))
+    elapsed = time.time() - start
+    print('buffer: %d bytes of arrays' % (capacity * 9))
+    if before is not None:
+        gc.collect()
+        base_alloc = mem_alloc()
+        encode_batch(readings, min(MAX_BATCH, readings.count), 'plant_1', aws_pico.water_level_percent)
+        print('heap: %d bytes for the buffer, %d bytes to encode one batch' % (
+            after - before, mem_alloc() - base_alloc))
+    print('simulated in %.1f s' % elapsed)
+
+
+main()
@@ -0,0 +1,39 @@
+# Stand-in for the MicroPython machine module, to run the firmware on the unix port or CPython
+
+
+class Pin:
+    OUT = 1
+    IN = 0
+    PULL_DOWN = 2
+
+    def __init__(self, id, mode=None, pull=None):
+        self.id = id
+        self.state = 0
+
+    def value(self, state=None):
+        if state is None:
+            return self.state
+        self.state = state
+
+    def high(self):
+        self.state = 1
+
+    def low(self):
+        self.state = 0
+
+    def on(self):
+        self.state = 1
+
+    def off(self):
+        self.state = 0
+
+
+class ADC:
+    # read_u16 returns value, set it to simulate a sensor
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.value = 34000
+
+    def read_u16(self):
+        return self.value
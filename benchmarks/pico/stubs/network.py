@@ -0,0 +1,21 @@
+# Stand-in for the MicroPython network module; set online to simulate Wi-Fi going down
+
+STA_IF = 0
+online = True
+
+
+class WLAN:
+    def __init__(self, interface):
+        self.interface = interface
+
+    def active(self, state=None):
+        return True
+
+    def connect(self, ssid, password):
+        pass
+
+    def isconnected(self):
+        return online
+
+    def ifconfig(self):
+        return ('192.168.0.2', '255.255.255.0', '192.168.0.1', '192.168.0.1')
@@ -0,0 +1,6 @@
+# Stand-in for the device's personal_arguments.py
+SSID = 'ssid'
+PASS = 'password'
+CLIENT_ID = 'pico'
+AWS_ENDPOINT = 'localhost'
+PLANT_ID = 'plant_1'
@@ -0,0 +1,2 @@
+# CPython stand-in for the MicroPython ubinascii module
+from binascii import *  # noqa: F401,F403
@@ -0,0 +1,2 @@
+# CPython stand-in for the MicroPython ujson module
+from json import *  # noqa: F401,F403
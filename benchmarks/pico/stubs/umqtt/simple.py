@@ -0,0 +1,46 @@
+# Stand-in for umqtt.simple: publishes are recorded, and fail like a lost
+# connection while network.online is False
+
+import network
+
+
+class MQTTClient:
+    def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0, ssl=False,
+                 ssl_params={}):
+        self.client_id = client_id
+        self.server = server
+        self.cb = None
+        self.connected = False
+        self.published = []
+        # Messages check_msg hands to the callback, as (topic, msg)
+        self.incoming = []
+
+    def set_callback(self, f):
+        self.cb = f
+
+    def _check(self):
+        if not network.online:
+            self.connected = False
+        if not self.connected:
+            raise OSError(-1)
+
+    def connect(self, clean_session=True):
+        if not network.online:
+            raise OSError(-1)
+        self.connected = True
+        return False
+
+    def disconnect(self):
+        self.connected = False
+
+    def subscribe(self, topic, qos=0):
+        self._check()
+
+    def publish(self, topic, msg, retain=False, qos=0):
+        self._check()
+        self.published.append((topic, msg))
+
+    def check_msg(self):
+        self._check()
+        if self.incoming:
+            self.cb(*self.incoming.pop(0))
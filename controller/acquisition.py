@@ -0,0 +1,171 @@
+# Sensor acquisition for the Pico W firmware
+#
+# Every ADC channel is created once and read in bursts: OVERSAMPLE
+# conversions go into a preallocated array, their median throws away spikes
+# and an EWMA over successive bursts smooths the noise that is left. The
+# DHT11 is read on its own schedule, never more often than its minimum
+# interval DHT11_MIN_INTERVAL_MS; the median of its last DHT_WINDOW good
+# reads drops a bad one before the same kind of EWMA. Readings leave here
+# filtered, so ReportFilter's deadbands see the signal rather than the noise
+# and fewer readings need to be sent.
+#
+# A sensor with a power pin is only powered for its burst. Nothing is
+# allocated per reading. Runs under MicroPython and CPython alike, the
+# sensors are passed in.
+
+from array import array
+from store_forward import ticks_diff
+
+try:
+    from time import sleep_us
+except ImportError:
+    from time import sleep
+
+    def sleep_us(us):
+        sleep(us / 1000000)
+
+
+# Conversions per burst, odd so the median is one of them
+OVERSAMPLE = 15
+# Weight of the newest burst or DHT11 read in the moving averages
+EWMA_ALPHA = 0.3
+# The DHT11 takes at most one measurement per second
+DHT11_MIN_INTERVAL_MS = 1000
+# Good DHT11 reads in its median filter
+DHT_WINDOW = 3
+# Filtered DHT11 values older than this are not reported
+DHT_MAX_AGE_MS = 30000
+# Time a sensor switched on by its power pin takes to settle
+SETTLE_US = 1000
+
+
+def median(values, n):
+    # Median of the first n values, sorted in place by insertion: no allocation
+    for i in range(1, n):
+        value = values[i]
+        j = i - 1
+        while j >= 0 and values[j] > value:
+            values[j + 1] = values[j]
+            j -= 1
+        values[j + 1] = value
+    return values[n // 2]
+
+
+class EWMA:
+    # Exponentially weighted moving average, starting at the first value
+
+    def __init__(self, alpha=EWMA_ALPHA):
+        self.alpha = alpha
+        self.value = None
+
+    def update(self, value):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+
+class OversampledADC:
+    # One ADC channel read in bursts, median then EWMA filtered, in raw read_u16() counts
+
+    def __init__(self, adc, samples=OVERSAMPLE, alpha=EWMA_ALPHA, power=None):
+        self.adc = adc
+        self.samples = samples
+        self.burst = array('H', bytes(2 * samples))
+        self.filter = EWMA(alpha)
+        self.power = power
+        if power is not None:
+            power.off()
+
+    def read_median(self):
+        # Median of one burst, without the EWMA
+        read = self.adc.read_u16
+        burst = self.burst
+        if self.power is not None:
+            self.power.on()
+            sleep_us(SETTLE_US)
+        for i in range(self.samples):
+            burst[i] = read()
+        if self.power is not None:
+            self.power.off()
+        return median(burst, self.samples)
+
+    def read(self):
+        return self.filter.update(self.read_median())
+
+
+class ScheduledDHT:
+    # A DHT11 read at most every interval_ms, no less than DHT11_MIN_INTERVAL_MS.
+    # temperature and humidity are the filtered values, None before the first good read
+
+    def __init__(self, sensor, interval_ms=DHT11_MIN_INTERVAL_MS, alpha=EWMA_ALPHA):
+        self.sensor = sensor
+        self.interval_ms = max(interval_ms, DHT11_MIN_INTERVAL_MS)
+        self.temperatures = array('f', bytes(4 * DHT_WINDOW))
+        self.humidities = array('f', bytes(4 * DHT_WINDOW))
+        self.scratch = array('f', bytes(4 * DHT_WINDOW))
+        self.temperature_filter = EWMA(alpha)
+        self.humidity_filter = EWMA(alpha)
+        self.temperature = self.humidity = None
+        # Good reads so far and failed ones, ticks of the last attempt and of the last good read
+        self.reads = 0
+        self.failures = 0
+        self.last_attempt = None
+        self.last_good = None
+
+    def due(self, now):
+        return self.last_attempt is None or ticks_diff(now, self.last_attempt) >= self.interval_ms
+
+    def poll(self, now):
+        # Reads the sensor if due, returns True on a good read
+        if not self.due(now):
+            return False
+        self.last_attempt = now
+        try:
+            self.sensor.measure()
+            temperature, humidity = self.sensor.temperature(), self.sensor.humidity()
+        except OSError:
+            self.failures += 1
+            return False
+        i = self.reads % DHT_WINDOW
+        self.temperatures[i] = temperature
+        self.humidities[i] = humidity
+        self.reads += 1
+        n = min(self.reads, DHT_WINDOW)
+        self.temperature = self.temperature_filter.update(self._median(self.temperatures, n))
+        self.humidity = self.humidity_filter.update(self._median(self.humidities, n))
+        self.last_good = now
+        return True
+
+    def _median(self, window, n):
+        # The window stays in arrival order, its median is taken on a copy
+        scratch = self.scratch
+        for i in range(n):
+            scratch[i] = window[i]
+        return median(scratch, n)
+
+    def fresh(self, now):
+        return self.last_good is not None and ticks_diff(now, self.last_good) <= DHT_MAX_AGE_MS
+
+
+class Acquisition:
+    # The plant's sensors: a DHT11 and the water level ADC. read(now) returns the
+    # filtered (temperature, humidity, water_level) the way ReadingBuffer keeps
+    # them: whole degrees, whole percent and raw counts
+
+    def __init__(self, dht, water_level_adc, dht_interval_ms=DHT11_MIN_INTERVAL_MS, samples=OVERSAMPLE,
+                 alpha=EWMA_ALPHA, water_level_power=None):
+        self.dht = ScheduledDHT(dht, dht_interval_ms, alpha)
+        self.water_level = OversampledADC(water_level_adc, samples, alpha, water_level_power)
+
+    def poll(self, now):
+        # Reads the DHT11 if due, call it often enough to keep its filters fed
+        return self.dht.poll(now)
+
+    def read(self, now):
+        # Raises OSError while there is no recent good DHT11 read
+        self.dht.poll(now)
+        if not self.dht.fresh(now):
+            raise OSError('no DHT11 reading for %d ms' % DHT_MAX_AGE_MS)
+        return round(self.dht.temperature), round(self.dht.humidity), round(self.water_level.read())
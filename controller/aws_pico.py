@@ -2,14 +2,33 @@
 # SPDX-License-Identifier: MIT-0
 
 # AWS IoT Core - RPi Pico W Demo
+#
+# The firmware runs as cooperative uasyncio tasks, but umqtt.simple is a
+# blocking client: a QoS 1 publish waits for its PUBACK and a connect blocks
+# through the TLS handshake. The publish task therefore sends one message
+# per step and yields in between, so a backlog flush delays a pump command
+# by at most one round trip. A reconnect still stalls every task for the
+# handshake, seconds at worst; no commands can arrive while disconnected
+# anyway, and sampling catches up on its own schedule afterwards.
 
 # Required imports
 import time
 import machine
+from machine import Pin, ADC
 import network
 import ujson
 import ubinascii
 from umqtt.simple import MQTTClient
+from personal_arguments import SSID, PASS, CLIENT_ID, AWS_ENDPOINT, PLANT_ID
+from store_forward import ReadingBuffer, Forwarder, ReportFilter, DeltaEncoder, encode_batch, DEADBANDS, HEARTBEAT_MS
+from store_forward import FLUSH_BURST
+from store_forward import ticks_ms, ticks_diff, ticks_add
+from acquisition import Acquisition, OversampledADC
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
 
 # DHT11
@@ -23,13 +42,32 @@ motor1A = Pin(14, Pin.OUT)
 motor2A = Pin(15, Pin.OUT)
 
 # Water level sensor setup
-water_level = ADC(28)
- 
+water_level_adc = ADC(28)
+
+# Seconds between two sensor readings
+SAMPLE_INTERVAL = 5
+# Milliseconds between two DHT11 reads, a few per reading for its median filter
+DHT_INTERVAL_MS = 2000
+
+# Filtered readings: the water level oversampled, the DHT11 on its own schedule
+sensors = Acquisition(sensor, water_level_adc, DHT_INTERVAL_MS)
+# RP2040 embedded temperature sensor
+rpi_temperature_adc = OversampledADC(ADC(4))
+# Seconds to wait for Wi-Fi before giving up until the next retry
+WIFI_TIMEOUT = 15
+# Seconds between two checks for commands, the worst case command latency
+COMMAND_POLL = 0.02
+# Seconds between two checks for batches due and for a lost connection
+PUBLISH_POLL = 1
+SUPERVISE_POLL = 0.5
+# Send only readings that moved by more than DEADBANDS, as deltas, with a
+# full report at least every HEARTBEAT_MS; False sends every reading in full
+REPORT_BY_EXCEPTION = True
 
 # AWS IoT Core publish topic
 PUB_TOPIC = b'sensor/data'
 # AWS IoT Core subscribe  topic
-SUB_TOPIC = b'/' + CLIENT_ID + '/light'
+SUB_TOPIC = ('/' + CLIENT_ID + '/light').encode()
 
 
 
@@ -41,24 +79,38 @@ light = machine.Pin("LED", machine.Pin.OUT)
 light.off()
 
 
-# Wifi Connection Setup
-def wifi_connect():
+# Readings wait here until they are published, also while the connection is down
+readings = ReadingBuffer()
+
+
+# Wifi Connection Setup, raises OSError if not connected within WIFI_TIMEOUT
+async def wifi_connect():
     print('Connecting to wifi...')
     wlan = network.WLAN(network.STA_IF)
     wlan.active(True)
+    if wlan.isconnected():
+        return
     wlan.connect(SSID, PASS)
-    while wlan.isconnected() == False:
+    for _ in range(WIFI_TIMEOUT):
+        if wlan.isconnected():
+            break
         light.on()
         print('Waiting for connection...')
-        time.sleep(0.5)
+        await asyncio.sleep(0.5)
         light.off()
-        time.sleep(0.5)
+        await asyncio.sleep(0.5)
+    else:
+        raise OSError('Wi-Fi connection timed out')
     print('Connection details: %s' % str(wlan.ifconfig()))
+    try:
+        # Readings are timestamped with the RTC, set it once we are online
+        import ntptime
+        ntptime.settime()
+    except (ImportError, OSError) as e:
+        print('Could not set the time:', e)
 
-def get_water_level():
+def water_level_percent(raw):
     # Example conversion for water level sensor, adjust the formula as needed
-    raw = water_level.read_u16()
-    # Example conversion, adjust according to your sensor
     level = (raw / 65535) * 100  # Convert to percentage
     return level
 
@@ -89,8 +141,7 @@ def mqtt_subscribe_callback(topic, msg):
 
 # Read current temperature from RP2040 embeded sensor
 def get_rpi_temperature():
-    sensor = machine.ADC(4)
-    voltage = sensor.read_u16() * (3.3 / 65535)
+    voltage = rpi_temperature_adc.read() * (3.3 / 65535)
     temperature = 27 - (voltage - 0.706) / 0.001721
     return temperature
 
@@ -102,52 +153,123 @@ def read_pem(file):
         base64_text = "".join(split_test[1:-1])
         return ubinascii.a2b_base64(base64_text)
 
-# Connect to wifi
-wifi_connect()
-
-# Set AWS IoT Core connection details
-mqtt = MQTTClient(
-    client_id=CLIENT_ID,
-    server=AWS_ENDPOINT,
-    port=8883,
-    keepalive=5000,
-    ssl=True,
-    ssl_params={'key':read_pem(DEV_KEY), 'cert':read_pem(DEV_CRT), 'server_side':False})
-
-# Establish connection to AWS IoT Core
-mqtt.connect()
-
-# Set callback for subscriptions
-mqtt.set_callback(mqtt_subscribe_callback)
-
-# Subscribe to topic
-mqtt.subscribe(SUB_TOPIC)
-
-
-# Main loop - with 5 sec delay
-while True:
-    sensor.measure()  # Trigger a measurement for DHT11
-    temperature = sensor.temperature()  # Get temperature from DHT11
-    humidity = sensor.humidity()  # Get humidity from DHT11
-    water_level = get_water_level()  # Get water level from ADC
-    current_time = time.localtime()  # Get the current time
-    date_string = "{year}-{month}-{day}".format(year=current_time[0], month=current_time[1], day=current_time[2])
-    
-    # Format the message as a JSON string
-    message = ujson.dumps({
-        "temperature": temperature,
-        "water_level": water_level,
-        "humidity": humidity,
-        "date": date_string
-    })
-    
-    # Convert the message to bytes
-    message_bytes = message.encode('utf-8')
-    
-    print('Publishing topic %s message %s' % (PUB_TOPIC, message_bytes))
-    mqtt.publish(topic=PUB_TOPIC, msg=message_bytes, qos=0)
-
-    # Check subscriptions for message
-    mqtt.check_msg()
-    time.sleep(5)
+def create_mqtt_client():
+    # Set AWS IoT Core connection details
+    return MQTTClient(
+        client_id=CLIENT_ID,
+        server=AWS_ENDPOINT,
+        port=8883,
+        keepalive=5000,
+        ssl=True,
+        ssl_params={'key':read_pem(DEV_KEY), 'cert':read_pem(DEV_CRT), 'server_side':False})
+
+
+def mqtt_connect(mqtt):
+    # Connect to AWS IoT Core once wifi is up, raises OSError on failure
+    mqtt.connect()
+    # Set callback for subscriptions and subscribe to topic
+    mqtt.set_callback(mqtt_subscribe_callback)
+    mqtt.subscribe(SUB_TOPIC)
+
+
+def create_forwarder(mqtt):
+    # Returns the forwarder of the readings buffer and the report filter, None to send every reading
+    # Batches are published with QoS 1: readings leave the buffer only once acknowledged
+    if REPORT_BY_EXCEPTION:
+        report_filter = ReportFilter(DEADBANDS, HEARTBEAT_MS)
+        encoder = DeltaEncoder(PLANT_ID, DEADBANDS, water_level_percent)
+        encode, sent = encoder.encode, encoder.sent
+    else:
+        report_filter = None
+        encode, sent = lambda buffer, n: encode_batch(buffer, n, PLANT_ID, water_level_percent), None
+    # No connect function: supervise() owns the connection
+    forwarder = Forwarder(
+        readings,
+        encode=lambda buffer, n: encode(buffer, n).encode('utf-8'),
+        publish=lambda message: mqtt.publish(topic=PUB_TOPIC, msg=message, qos=1),
+        connect=None,
+        sent=sent)
+    return forwarder, report_filter
+
+
+# The firmware runs as cooperative tasks, none of them may block for long
+
+
+async def supervise(mqtt, forwarder):
+    # Brings wifi and MQTT back up, with the forwarder's backoff between attempts
+    while True:
+        if not forwarder.connected and forwarder.retry_due():
+            try:
+                await wifi_connect()
+                mqtt_connect(mqtt)
+                forwarder.connected = True
+            except OSError as e:
+                print('Reconnect failed:', e)
+                forwarder.disconnected()
+        await asyncio.sleep(SUPERVISE_POLL)
+
+
+async def sample(report_filter, forwarder):
+    # A reading every SAMPLE_INTERVAL seconds, on its own schedule, into the buffer.
+    # Wait for the first connection, so the first reading gets the time from the network
+    for _ in range(2 * WIFI_TIMEOUT):
+        if forwarder.connected:
+            break
+        await asyncio.sleep(0.5)
+    next_sample = ticks_ms()
+    while True:
+        try:
+            reading = sensors.read(ticks_ms())
+            kind = ReportFilter.FULL if report_filter is None else report_filter.check(ticks_ms(), *reading)
+            if kind is not ReportFilter.SKIP:
+                readings.append(int(time.time()), *reading, full=kind)
+        except OSError as e:
+            print('Sensor read failed:', e)
+        next_sample = ticks_add(next_sample, SAMPLE_INTERVAL * 1000)
+        await asyncio.sleep(max(0, ticks_diff(next_sample, ticks_ms())) / 1000)
+
+
+async def acquire():
+    # Reads the DHT11 between samples, so every sample gets a filtered value
+    while True:
+        sensors.poll(ticks_ms())
+        await asyncio.sleep(DHT_INTERVAL_MS / 1000)
+
+
+async def publish(forwarder):
+    # Publishes the buffered readings in batches when they are due, one message
+    # per step: each blocks until its PUBACK, the other tasks run in between
+    while True:
+        sent = 0
+        while sent < FLUSH_BURST and forwarder.poll(burst=1):
+            sent += 1
+            await asyncio.sleep(0)
+        if sent:
+            print('Published %d batches, %d readings buffered, %d dropped' % (sent, readings.count, readings.dropped))
+        await asyncio.sleep(PUBLISH_POLL)
+
+
+async def handle_commands(mqtt, forwarder):
+    # Check subscriptions for message, mqtt_subscribe_callback acts on them right away
+    while True:
+        if forwarder.connected:
+            try:
+                mqtt.check_msg()
+            except OSError as e:
+                print('Connection lost:', e)
+                forwarder.disconnected()
+        await asyncio.sleep(COMMAND_POLL)
+
+
+async def run(mqtt):
+    forwarder, report_filter = create_forwarder(mqtt)
+    await asyncio.gather(supervise(mqtt, forwarder), acquire(), sample(report_filter, forwarder),
+                         publish(forwarder), handle_commands(mqtt, forwarder))
+
+
+def main():
+    asyncio.run(run(create_mqtt_client()))
+
 
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,13 @@ from machine import Pin, ADC
 from umqtt.simple import MQTTClient
 import json
 import random
+from store_forward import ReportFilter, DEADBANDS, HEARTBEAT_MS, BACKOFF_MIN_MS, BACKOFF_MAX_MS
+from acquisition import Acquisition
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
 # DHT11
 from dht import DHT11
@@ -17,6 +24,9 @@ motor2A = Pin(15, Pin.OUT)
 # Water level sensor setup
 water_level = ADC(28)
 
+# Filtered readings, the DHT11 is read at most once per sample
+sensors = Acquisition(sensor, water_level)
+
 # MQTT Broker Setup
 mqtt_server = 'mqtt-dashboard.com'
 client_id = 'Eliran'
@@ -25,6 +35,10 @@ client_id = 'Eliran'
 publish_topic = b'Test'
 control_topic = b'Test11'  # Topic to subscribe for ending the loop
 
+# Seconds between two readings, and between two checks for commands
+SAMPLE_INTERVAL = 2
+COMMAND_POLL = 0.02
+
 # Initialize MQTT client and connect
 client = MQTTClient(client_id, mqtt_server)
 client.connect()
@@ -58,23 +72,78 @@ client.set_callback(mqtt_callback)
 client.subscribe(control_topic)
 
 
+# Report-by-exception: only readings where a metric moved by more than its
+# deadband are published, and one at least every HEARTBEAT_MS
+report_filter = ReportFilter(DEADBANDS, HEARTBEAT_MS)
+
+
 def publish_sensor_data():
-    # sensor.measure()
+    try:
+        temperature, humidity, level = sensors.read(time.ticks_ms())
+    except OSError as e:
+        # A failed DHT11 read is skipped, OSError from here on means the connection is lost
+        print("Sensor read failed: {}".format(e))
+        return
+    if report_filter.check(time.ticks_ms(), temperature, humidity, level) is ReportFilter.SKIP:
+        return
     data = {
-        "temperature": sensor.temperature,
-        "humidity": sensor.humidity,
-        "water_level": water_level.read_u16()
+        "temperature": temperature,
+        "humidity": humidity,
+        "water_level": level,
         "date":  time.localtime()  
     }
     client.publish(publish_topic, json.dumps(data))
 
 
+# The loop runs as cooperative tasks: commands are handled within
+# COMMAND_POLL while sampling keeps its own schedule. A task hitting a lost
+# connection sets reconnect and the supervisor brings it back up.
+reconnect = asyncio.Event()
+
+
+async def sample():
+    while True:
+        try:
+            publish_sensor_data()
+        except OSError as e:
+            print("Publish failed: {}".format(e))
+            reconnect.set()
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+async def handle_commands():
+    while True:
+        if not reconnect.is_set():
+            try:
+                client.check_msg()  # Check for new messages on subscribed topics
+            except OSError as e:
+                print("Connection lost: {}".format(e))
+                reconnect.set()
+        await asyncio.sleep(COMMAND_POLL)
+
+
+async def supervise():
+    backoff = BACKOFF_MIN_MS
+    while True:
+        await reconnect.wait()
+        try:
+            client.connect()
+            client.subscribe(control_topic)
+            reconnect.clear()
+            backoff = BACKOFF_MIN_MS
+        except OSError as e:
+            print("Reconnect failed: {}".format(e))
+            await asyncio.sleep(backoff / 1000)
+            backoff = min(2 * backoff, BACKOFF_MAX_MS)
+
+
+async def run():
+    await asyncio.gather(sample(), handle_commands(), supervise())
+
+
 def main():
     print("Starting sensor data transmission")
-    while True:
-        publish_sensor_data()
-        client.check_msg()  # Check for new messages on subscribed topics
-        time.sleep(2)
+    asyncio.run(run())
 
 
 try:
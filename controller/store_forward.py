@@ -0,0 +1,261 @@
+# Store-and-forward of sensor readings for the Pico W firmware
+#
+# Readings are kept in a ring buffer of preallocated typed arrays (9 bytes
+# per reading) and published as one batch message every BATCH_SIZE readings
+# or BATCH_INTERVAL_MS, whichever comes first. While the connection is down
+# readings keep being buffered; once the buffer is full the oldest readings
+# are overwritten. Reconnects are retried with exponential backoff and the
+# backlog is flushed in batches of at most MAX_BATCH readings.
+#
+# With report-by-exception, ReportFilter keeps only the readings where a
+# metric moved by more than its deadband, plus a full report at least every
+# HEARTBEAT_MS. DeltaEncoder then sends every reading as a delta against the
+# last acknowledged full report: fields within the deadband of it are null,
+# and the receiver takes them from that report.
+#
+# Runs under MicroPython and CPython alike, nothing here touches hardware.
+
+from array import array
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+try:
+    from time import ticks_ms, ticks_diff, ticks_add
+except ImportError:
+    # CPython, for running the firmware logic on a PC
+    from time import monotonic
+
+    def ticks_ms():
+        return int(monotonic() * 1000)
+
+    def ticks_diff(a, b):
+        return a - b
+
+    def ticks_add(a, b):
+        return a + b
+
+
+# 1024 readings take 9 KB of RAM and hold 85 minutes of 5 s samples
+BUFFER_CAPACITY = 1024
+BATCH_SIZE = 12
+BATCH_INTERVAL_MS = 60000
+# Largest batch in one message, bounds the size of the payload built in RAM
+MAX_BATCH = 64
+# Batches sent per poll while flushing a backlog, so the main loop keeps running
+FLUSH_BURST = 4
+BACKOFF_MIN_MS = 1000
+BACKOFF_MAX_MS = 60000
+
+# Changes up to these are not reported: DHT11 degrees and percent, raw ADC counts
+DEADBANDS = {'temperature': 0.5, 'humidity': 1.5, 'water_level': 500}
+# Longest time without a full report
+HEARTBEAT_MS = 15 * 60000
+
+
+class ReadingBuffer:
+    # Fixed capacity ring buffer of readings, one typed array per field
+
+    def __init__(self, capacity=BUFFER_CAPACITY):
+        self.capacity = capacity
+        self.times = array('I', bytes(4 * capacity))  # seconds since the epoch
+        self.temperatures = array('b', bytes(capacity))  # DHT11, whole degrees
+        self.humidities = array('B', bytes(capacity))  # DHT11, whole percent
+        self.water_levels = array('H', bytes(2 * capacity))  # raw read_u16()
+        self.full = array('B', bytes(capacity))  # 1 for a full report
+        self.start = 0
+        self.count = 0
+        # Readings overwritten before they could be sent
+        self.dropped = 0
+
+    def append(self, t, temperature, humidity, water_level, full=0):
+        if self.count == self.capacity:
+            # Full: the newest reading replaces the oldest one
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+            self.dropped += 1
+        i = (self.start + self.count) % self.capacity
+        self.times[i] = t
+        self.temperatures[i] = temperature
+        self.humidities[i] = humidity
+        self.water_levels[i] = water_level
+        self.full[i] = full
+        self.count += 1
+
+    def indices(self, n):
+        # Positions of the n oldest readings
+        return [(self.start + k) % self.capacity for k in range(n)]
+
+    def discard(self, n):
+        # Forget the n oldest readings, once they were sent
+        self.start = (self.start + n) % self.capacity
+        self.count -= n
+
+
+def encode_batch(buffer, n, plant_id, water_level_scale=None):
+    # JSON batch of the n oldest readings: one plant, one column per field
+    # and one time per reading in nanoseconds, as the cloud side expects.
+    # water_level_scale converts the raw ADC value before it is sent.
+    idx = buffer.indices(n)
+    water_levels = [buffer.water_levels[i] for i in idx]
+    if water_level_scale is not None:
+        water_levels = [water_level_scale(w) for w in water_levels]
+    return '{"plant_id": "%s", "temperature": %s, "humidity": %s, "water_level": %s, "ts": %s}' % (
+        plant_id,
+        str([buffer.temperatures[i] for i in idx]),
+        str([buffer.humidities[i] for i in idx]),
+        str(water_levels),
+        str([buffer.times[i] * 1000000000 for i in idx]))
+
+
+class ReportFilter:
+    # Report-by-exception: check() tells whether a new reading is worth sending,
+    # compared to the last reading kept, and forces a full report every heartbeat_ms
+
+    SKIP = None
+    DELTA = 0
+    FULL = 1
+
+    def __init__(self, deadbands=DEADBANDS, heartbeat_ms=HEARTBEAT_MS):
+        self.deadbands = deadbands
+        self.heartbeat_ms = heartbeat_ms
+        self.last = None
+        self.last_full = 0
+        self.skipped = 0
+
+    def check(self, now, temperature, humidity, water_level):
+        values = (temperature, humidity, water_level)
+        if self.last is None or ticks_diff(now, self.last_full) >= self.heartbeat_ms:
+            self.last = values
+            self.last_full = now
+            return self.FULL
+        for value, last, name in zip(values, self.last, ('temperature', 'humidity', 'water_level')):
+            if abs(value - last) > self.deadbands[name]:
+                self.last = values
+                return self.DELTA
+        self.skipped += 1
+        return self.SKIP
+
+
+class DeltaEncoder:
+    # Encodes batches as deltas against the last acknowledged full report.
+    # A message names that report by its ts in "base" and lists the positions
+    # of its own full reports in "full"; a delta has null for every field
+    # within the deadband of the base. Until a full report is acknowledged
+    # every field is sent.
+
+    def __init__(self, plant_id, deadbands=DEADBANDS, water_level_scale=None):
+        self.plant_id = plant_id
+        self.deadbands = deadbands
+        self.water_level_scale = water_level_scale
+        self.base = None
+        self.base_ts = None
+
+    def encode(self, buffer, n):
+        idx = buffer.indices(n)
+        full = [k for k, i in enumerate(idx) if buffer.full[i]]
+        columns = {}
+        for name, column in (('temperature', buffer.temperatures), ('humidity', buffer.humidities),
+                             ('water_level', buffer.water_levels)):
+            values = [column[i] for i in idx]
+            if self.base is not None:
+                base = self.base[name]
+                deadband = self.deadbands[name]
+                values = [None if not buffer.full[i] and abs(v - base) <= deadband else v
+                          for i, v in zip(idx, values)]
+            if name == 'water_level' and self.water_level_scale is not None:
+                values = [None if v is None else self.water_level_scale(v) for v in values]
+            columns[name] = values
+        message = {'plant_id': self.plant_id, 'full': full, 'ts': [buffer.times[i] * 1000000000 for i in idx]}
+        if self.base_ts is not None:
+            message['base'] = self.base_ts
+        message.update(columns)
+        return json.dumps(message)
+
+    def sent(self, buffer, n):
+        # The batch was acknowledged: its last full report is the new base
+        for i in reversed(buffer.indices(n)):
+            if buffer.full[i]:
+                self.base = {'temperature': buffer.temperatures[i], 'humidity': buffer.humidities[i],
+                             'water_level': buffer.water_levels[i]}
+                self.base_ts = buffer.times[i] * 1000000000
+                return
+
+
+class Forwarder:
+    # Decides when to publish the buffered readings and handles reconnects.
+    # encode(buffer, n) builds a message, publish(msg) sends it and raises
+    # OSError when the connection is lost, connect() raises OSError on failure.
+    # With connect None the caller connects, checking retry_due() first, and
+    # sets connected. sent(buffer, n), if given, is called once a batch was published.
+    # now is the ticks_ms() the first batch interval and retry are counted from.
+
+    def __init__(self, buffer, encode, publish, connect, batch_size=BATCH_SIZE,
+                 batch_interval_ms=BATCH_INTERVAL_MS, max_batch=MAX_BATCH, sent=None, now=None):
+        self.buffer = buffer
+        self.encode = encode
+        self.on_sent = sent
+        self.publish = publish
+        self.connect = connect
+        self.batch_size = batch_size
+        self.batch_interval_ms = batch_interval_ms
+        self.max_batch = max_batch
+        self.connected = False
+        self.backoff_ms = BACKOFF_MIN_MS
+        now = ticks_ms() if now is None else now
+        self.retry_at = now
+        self.last_sent = now
+        self.messages = 0
+        self.sent = 0
+
+    def disconnected(self, now=None):
+        # Wait before the next attempt, twice as long after every failure
+        now = ticks_ms() if now is None else now
+        self.connected = False
+        self.retry_at = ticks_add(now, self.backoff_ms)
+        self.backoff_ms = min(2 * self.backoff_ms, BACKOFF_MAX_MS)
+
+    def retry_due(self, now=None):
+        return ticks_diff(ticks_ms() if now is None else now, self.retry_at) >= 0
+
+    def due(self, now):
+        return (self.buffer.count >= self.batch_size
+                or (self.buffer.count and ticks_diff(now, self.last_sent) >= self.batch_interval_ms))
+
+    def poll(self, now=None, burst=FLUSH_BURST):
+        # Call after every new reading; sends what is due, at most burst messages,
+        # and returns the number of messages sent
+        now = ticks_ms() if now is None else now
+        if not self.connected:
+            # Reconnect as soon as the backoff allows, commands arrive on the same connection
+            if self.connect is None or not self.retry_due(now):
+                return 0
+            try:
+                self.connect()
+            except OSError as e:
+                print('Reconnect failed:', e)
+                self.disconnected(now)
+                return 0
+            self.connected = True
+        if not self.due(now):
+            return 0
+        sent = 0
+        while self.buffer.count and sent < burst:
+            n = min(self.buffer.count, self.max_batch)
+            try:
+                self.publish(self.encode(self.buffer, n))
+            except OSError as e:
+                print('Publish failed:', e)
+                self.disconnected(now)
+                break
+            if self.on_sent is not None:
+                self.on_sent(self.buffer, n)
+            self.buffer.discard(n)
+            self.backoff_ms = BACKOFF_MIN_MS
+            self.last_sent = now
+            self.messages += 1
+            self.sent += n
+            sent += 1
+        return sent
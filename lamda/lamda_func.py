@@ -1,9 +1,17 @@
 import json
-import boto3
+import itertools
+import os
+import time
+import base64
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from rules import Rule, RuleEngine
 
 # Define the AWS IoT Core endpoint
-# You should replace 'your-endpoint' with your actual AWS IoT Core endpoint
-AWS_IOT_ENDPOINT = "your-endpoint.iot.your-region.amazonaws.com"
+# You should replace 'your-endpoint' with your actual AWS IoT Core endpoint,
+# or set it in the AWS_IOT_ENDPOINT environment variable
+AWS_IOT_ENDPOINT = os.environ.get('AWS_IOT_ENDPOINT', "your-endpoint.iot.your-region.amazonaws.com")
 
 # Define the MQTT topic to publish the command messages
 COMMAND_TOPIC = "sensor/command"
@@ -13,45 +21,189 @@ WATER_LEVEL_RANGE = (33000, 36000)  # Example range
 TEMP_RANGE = (23, 24)  # Example range
 HUMIDITY_RANGE = (60, 61)  # Example range
 
-# Initialize the boto3 IoT Data Plane client
-iot_client = boto3.client('iot-data', endpoint_url=f'https://{AWS_IOT_ENDPOINT}')
+# Seconds before an active rule sends its command to the same plant again
+COMMAND_REISSUE_INTERVAL = 60
 
-def lambda_handler(event, context):
-    # Extract the sensor data from the event
-    water_level = event.get('water_level')
-    temp = event.get('temp')
-    humidity = event.get('humidity')
+# Default rules, in the order their commands are sent. The hysteresis band is
+# how far back inside the range a value must come before the rule clears.
+RULES = (
+    Rule('water_level', 'water_level', 1, *WATER_LEVEL_RANGE,  # 1 is the command for adjusting water level
+         hysteresis=300, min_interval=COMMAND_REISSUE_INTERVAL),
+    Rule('temp_low', 'temp', "21", low=TEMP_RANGE[0],  # Command for low temp
+         hysteresis=0.2, min_interval=COMMAND_REISSUE_INTERVAL),
+    Rule('temp_high', 'temp', "22", high=TEMP_RANGE[1],  # Command for high temp
+         hysteresis=0.2, min_interval=COMMAND_REISSUE_INTERVAL),
+    Rule('humidity', 'humidity', "3", *HUMIDITY_RANGE,  # "3" is used for adjusting humidity
+         hysteresis=0.2, min_interval=COMMAND_REISSUE_INTERVAL),
+)
+
+# Per-plant overrides of the rule settings, as JSON in the PLANT_RULES environment variable:
+# {"plant_7": {"temp_high": {"high": 26, "min_interval": 300}}}
+PLANT_RULES = json.loads(os.environ.get('PLANT_RULES', '{}'))
+
+# Rules are compiled once per container; the plant state lives as long as
+# the container, so warm invocations keep their hysteresis and debouncing
+rule_engine = RuleEngine(RULES, PLANT_RULES)
+
+# Binary sensor format, version 1, as written by Simulation/payloads.py:
+# a header (magic byte, version, record count) followed by fixed records of
+# plant index, temperature, humidity, water level (float32) and epoch nanoseconds.
+# The IoT rule forwards binary payloads base64 encoded in the 'data' field.
+BINARY_MAGIC = 0xB7
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<BBH')
+BINARY_DTYPE = np.dtype([('plant', '<u4'), ('temp', '<f4'), ('humidity', '<f4'),
+                         ('water_level', '<f4'), ('ts', '<i8')])
+
+# Threads publishing the command messages of one invocation concurrently,
+# from the PUBLISH_WORKERS environment variable
+PUBLISH_WORKERS = int(os.environ.get('PUBLISH_WORKERS', '8'))
+
+# Sequence numbers of the command messages sent by this container
+command_seq = itertools.count()
 
-    messages_to_publish = []
+# Last full report of every device reporting by exception: plant id -> (ts, fields).
+# Like the rule state it lasts as long as the container.
+report_bases = {}
+DELTA_FIELDS = ('temperature', 'humidity', 'water_level')
 
-    # Check water level
-    if not WATER_LEVEL_RANGE[0] <= water_level <= WATER_LEVEL_RANGE[1]:
-        messages_to_publish.append(1)  # Assuming 1 is the command for adjusting water level
+# The boto3 IoT Data Plane client and the publishing threads are created on
+# the first command, not at import: a cold start only pays for boto3 when a
+# command is due, and warm invocations reuse both. NumPy is imported eagerly
+# all the same: every invocation decodes and evaluates its readings with it,
+# so deferring it would only move its import into the first invocation.
+# benchmarks/bench_lambda_coldstart.py times both, about 100 ms for NumPy
+# against 300 ms for importing boto3 and creating the client.
+iot_client = None
+publish_pool = None
 
-    # Check temperature
-    if temp < TEMP_RANGE[0]:
-        messages_to_publish.append("21")  # Command for low temp
-    elif temp > TEMP_RANGE[1]:
-        messages_to_publish.append("22")  # Command for high temp
 
-    # Check humidity
-    if not HUMIDITY_RANGE[0] <= humidity <= HUMIDITY_RANGE[1]:
-        messages_to_publish.append("3")  # Assuming "3" is also used for adjusting humidity
+def get_iot_client():
+    """Returns the container's IoT Data Plane client, created on first use."""
+    global iot_client
+    if iot_client is None:
+        import boto3
+        iot_client = boto3.client('iot-data', endpoint_url=f'https://{AWS_IOT_ENDPOINT}')
+    return iot_client
 
-    # Publish messages for each condition that's not met
-    for message in messages_to_publish:
-        publish_command(message)
+
+def lambda_handler(event, context):
+    plant_ids, water_levels, temps, humidities = decode_columns(event)
+
+    # Check every rule against the whole batch at once, then send each
+    # plant the commands of its rules that fired and are due again
+    commands = rule_engine.evaluate(
+        plant_ids, {'water_level': water_levels, 'temp': temps, 'humidity': humidities}, time.time())
+    publish_commands(commands)
 
     return {
         'statusCode': 200,
-        'body': json.dumps('Processed sensor data successfully.')
+        'body': json.dumps(f'Processed {len(plant_ids)} sensor readings successfully.')
     }
 
-def publish_command(command):
-    """Publishes a command message to the AWS IoT Core topic."""
-    response = iot_client.publish(
+
+def decode_columns(event):
+    """Returns the plant ids, water levels, temperatures and humidities of a sensor event as arrays.
+
+    An event is a single reading, a batch message, a binary payload (base64
+    encoded by the IoT rule), a list of any of these (batched IoT rule
+    action) or an SQS batch whose record bodies are any of these. Batch
+    messages and binary payloads are turned into arrays without going
+    through one dict per reading.
+    """
+    if isinstance(event, list) or 'Records' in event:
+        items = event if isinstance(event, list) else [json.loads(record['body']) for record in event['Records']]
+        parts = [decode_columns(item) for item in items]
+        if not parts:
+            return readings_to_columns([])
+        return tuple(np.concatenate(column) for column in zip(*parts))
+    if 'data' in event:
+        raw = base64.b64decode(event['data'])
+        magic, version, count = BINARY_HEADER.unpack_from(raw)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError(f"Unsupported binary payload version {version}")
+        records = np.frombuffer(raw, dtype=BINARY_DTYPE, count=count, offset=BINARY_HEADER.size)
+        plant_ids = np.char.add('plant_', records['plant'].astype(str)).astype(object)
+        return (plant_ids, records['water_level'].astype(np.float64), records['temp'].astype(np.float64),
+                records['humidity'].astype(np.float64))
+    if isinstance(event.get('water_level'), list):
+        if 'full' in event:
+            fill_deltas(event)
+        # A device batch names its plant once for all of its readings
+        plant_ids = event['plant_id']
+        if not isinstance(plant_ids, list):
+            plant_ids = [plant_ids] * len(event['water_level'])
+        return (np.array(plant_ids, dtype=object),
+                np.asarray(event['water_level'], dtype=np.float64),
+                np.asarray(event.get('temp', event.get('temperature')), dtype=np.float64),
+                np.asarray(event['humidity'], dtype=np.float64))
+    return readings_to_columns([event])
+
+
+def fill_deltas(event):
+    """Rebuilds, in place, the readings of a device reporting by exception.
+
+    Fields left null in a delta are taken from the full report named by
+    'base'; when that report is unknown, e.g. after a cold start, they are
+    NaN and the rule engine leaves their rules as they were. This mirrors
+    ReportState.fill in Simulation/payloads.py, which the lambda cannot import.
+    """
+    plant_id = event['plant_id']
+    known = report_bases.get(plant_id)
+    base = known[1] if known is not None and known[0] == event.get('base') else {}
+    for name in DELTA_FIELDS:
+        event[name] = [base.get(name, np.nan) if value is None else value for value in event[name]]
+    if event['full']:
+        last = event['full'][-1]
+        report_bases[plant_id] = (event['ts'][last], {name: event[name][last] for name in DELTA_FIELDS})
+
+
+def readings_to_columns(readings):
+    """Turns a list of single readings into the arrays the rule engine takes."""
+    count = len(readings)
+    # A reading without a plant id is kept under '', the rule engine returns it as None
+    return (np.array([r.get('plant_id') or '' for r in readings], dtype=object),
+            np.fromiter((r.get('water_level') for r in readings), dtype=np.float64, count=count),
+            np.fromiter((r.get('temp') for r in readings), dtype=np.float64, count=count),
+            np.fromiter((r.get('humidity') for r in readings), dtype=np.float64, count=count))
+
+
+def publish_command(commands, plant_id=None):
+    """Publishes one command message for a plant to the AWS IoT Core topic.
+
+    The message carries its sequence number and send time in nanoseconds
+    since the epoch, so receivers can measure loss and latency.
+    """
+    message = {"commands": commands, "seq": next(command_seq), "ts": time.time_ns()}
+    if plant_id is not None:
+        message["plant_id"] = plant_id
+    response = get_iot_client().publish(
         topic=COMMAND_TOPIC,
         qos=1,
-        payload=json.dumps({"command": command})
+        payload=json.dumps(message)
     )
     return response
+
+
+def publish_commands(commands):
+    """Publishes the command message of every plant in {plant_id: [commands]}.
+
+    The messages are sent concurrently on at most PUBLISH_WORKERS threads,
+    so an invocation waits about one round trip per PUBLISH_WORKERS plants
+    instead of one per plant. Every message is attempted; the first error,
+    if any, is raised once all are done so the invocation is retried.
+    """
+    global publish_pool
+    if len(commands) <= 1 or PUBLISH_WORKERS <= 1:
+        return [publish_command(plant_commands, plant_id) for plant_id, plant_commands in commands.items()]
+    # Created here rather than in the pool's threads, boto3 client creation is not thread safe
+    get_iot_client()
+    if publish_pool is None:
+        publish_pool = ThreadPoolExecutor(PUBLISH_WORKERS, thread_name_prefix='publish')
+    futures = [publish_pool.submit(publish_command, plant_commands, plant_id)
+               for plant_id, plant_commands in commands.items()]
+    errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [future.result() for future in futures]
@@ -0,0 +1,141 @@
+"""Stateful rule engine deciding which commands a plant needs.
+
+A rule watches one metric and fires its command while the value is below
+its low or above its high threshold. Two things keep it from flooding the
+command topic:
+
+* hysteresis: once firing, a rule stays active until the value is back
+  inside the range by at least the hysteresis band, so a value hovering
+  around a threshold does not switch the rule on and off;
+* minimum re-issue interval: an active rule sends its command again only
+  after min_interval seconds since it last sent it.
+
+Thresholds are per plant: every plant starts from the rule defaults and
+can override any of them. Rules are compiled once into arrays with one row
+per plant and one column per rule, and the state (active flags, time of the
+last command) is kept in the same layout, so a batch of readings is
+evaluated with array operations.
+"""
+import math
+import numpy as np
+
+
+class Rule:
+    """One threshold rule; low or high may be None for a one-sided rule."""
+
+    def __init__(self, name, metric, command, low=None, high=None, hysteresis=0.0, min_interval=0.0):
+        self.name = name
+        self.metric = metric
+        self.command = command
+        self.low = low
+        self.high = high
+        self.hysteresis = hysteresis
+        self.min_interval = min_interval
+
+    def settings(self):
+        return {
+            'low': -math.inf if self.low is None else self.low,
+            'high': math.inf if self.high is None else self.high,
+            'hysteresis': self.hysteresis,
+            'min_interval': self.min_interval,
+        }
+
+
+class RuleEngine:
+    """Compiled rules with per-plant thresholds and per-plant state.
+
+    overrides maps a plant id to {rule name: {setting: value}}, settings are
+    low, high, hysteresis and min_interval. An unknown rule or setting
+    raises ValueError.
+    """
+
+    SETTINGS = ('low', 'high', 'hysteresis', 'min_interval')
+
+    def __init__(self, rules, overrides=None, capacity=1024):
+        self.rules = list(rules)
+        self.overrides = overrides or {}
+        self._check_overrides()
+        self.defaults = np.array([[rule.settings()[name] for rule in self.rules] for name in self.SETTINGS])
+        self.rows = {}
+        self.size = 0
+        # thresholds[setting] has one row per plant and one column per rule
+        self.thresholds = {name: np.empty((capacity, len(self.rules))) for name in self.SETTINGS}
+        self.active = np.zeros((capacity, len(self.rules)), dtype=bool)
+        self.last_sent = np.full((capacity, len(self.rules)), -math.inf)
+        # Command lists for every combination of rules sending at once
+        self.command_lists = [[rule.command for i, rule in enumerate(self.rules) if mask >> i & 1]
+                              for mask in range(1 << len(self.rules))]
+
+    def _check_overrides(self):
+        # A bad override fails here, at cold start, rather than on the plant's first reading
+        names = {rule.name for rule in self.rules}
+        for plant_id, rules in self.overrides.items():
+            if not isinstance(rules, dict):
+                raise ValueError(f"overrides of {plant_id} must map rule names to settings, got {rules!r}")
+            for name, settings in rules.items():
+                if name not in names:
+                    raise ValueError(f"unknown rule {name!r} in the overrides of {plant_id}, "
+                                     f"rules are {sorted(names)}")
+                if not isinstance(settings, dict):
+                    raise ValueError(f"settings of {name} for {plant_id} must be a dict, got {settings!r}")
+                unknown = set(settings) - set(self.SETTINGS)
+                if unknown:
+                    raise ValueError(f"unknown settings {sorted(unknown)} of {name} for {plant_id}, "
+                                     f"settings are {list(self.SETTINGS)}")
+
+    def _add_plant(self, plant_id):
+        if self.size == len(self.active):
+            grow = len(self.active)
+            for name in self.SETTINGS:
+                self.thresholds[name] = np.concatenate([self.thresholds[name], np.empty((grow, len(self.rules)))])
+            self.active = np.concatenate([self.active, np.zeros((grow, len(self.rules)), dtype=bool)])
+            self.last_sent = np.concatenate([self.last_sent, np.full((grow, len(self.rules)), -math.inf)])
+        row = self.size
+        self.size += 1
+        for i, name in enumerate(self.SETTINGS):
+            self.thresholds[name][row] = self.defaults[i]
+        for column, rule in enumerate(self.rules):
+            for name, value in self.overrides.get(plant_id, {}).get(rule.name, {}).items():
+                bound = {'low': -math.inf, 'high': math.inf}.get(name, 0.0)
+                self.thresholds[name][row, column] = bound if value is None else value
+        self.rows[plant_id] = row
+        return row
+
+    def evaluate(self, plant_ids, metrics, now):
+        """Update the state of the plants in a batch and return the commands to send.
+
+        plant_ids is an array of plant ids and metrics maps a metric name to
+        an array of values in the same order; NaN means not measured and
+        leaves the rule as it was. When a plant appears more than once, its
+        last reading is used. Returns {plant_id: [commands]} for the plants
+        with at least one command due.
+        """
+        if not len(plant_ids):
+            return {}
+        # Keep the last reading of every plant
+        unique_ids, last = np.unique(plant_ids[::-1].astype(str), return_index=True)
+        readings = len(plant_ids) - 1 - last
+        unique_ids = unique_ids.tolist()
+        rows = np.array([self.rows[plant_id] if plant_id in self.rows else self._add_plant(plant_id)
+                         for plant_id in unique_ids], dtype=np.int64)
+        values = np.stack([np.asarray(metrics[rule.metric], dtype=np.float64)[readings] for rule in self.rules],
+                          axis=1)
+
+        low = self.thresholds['low'][rows]
+        high = self.thresholds['high'][rows]
+        band = self.thresholds['hysteresis'][rows]
+        outside = (values < low) | (values > high)
+        cleared = (values >= low + band) & (values <= high - band)
+        active = outside | (self.active[rows] & ~cleared)
+        last_sent = self.last_sent[rows]
+        send = active & (now - last_sent >= self.thresholds['min_interval'][rows])
+
+        self.active[rows] = active
+        self.last_sent[rows] = np.where(send, now, last_sent)
+
+        masks = send @ (1 << np.arange(len(self.rules)))
+        due = np.flatnonzero(masks)
+        return {
+            unique_ids[i] or None: self.command_lists[mask][:]
+            for i, mask in zip(due.tolist(), masks[due].tolist())
+        }